@@ -1,12 +1,11 @@
 
 import glob
+import importlib
 import logging
 import os
 import subprocess
 import sys
 
-subprocess.check_call([sys.executable, '-m', 'pip', 'install', 'sagemaker'])
-
 from zipfile import ZipFile
 # from time import gmtime, strftime
 import socket
@@ -15,47 +14,238 @@ import json
 import time
 import argparse
 import boto3
+import concurrent.futures
+import contextlib
+import hashlib
+import queue
+import random
+import resource
+import tempfile
+import threading
 import uuid
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 
 n_cores = os.cpu_count()
 # host_name = socket.gethostname()
 # print(host_name)
 # print(os.environ)
 
-# Install geopandas dependency before including pandas
-subprocess.check_call([sys.executable, "-m", "pip", "install", "geopandas==0.9.0"])
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 
-import pandas as pd  # noqa: E402
-import geopandas as gpd  # noqa: E402
-from sklearn.model_selection import train_test_split  # noqa: E402
 
-import sagemaker
-from sagemaker.feature_store.feature_group import FeatureGroup
+def require(module_name: str, requirement: str):
+    """Imports module_name, installing requirement with pip only if the image lacks it.
 
-def get_session(region, default_bucket):
-    """Gets the sagemaker session based on the region.
+    Prebuilt processing images that ship the package never run pip. With --wheelhouse,
+    missing packages are installed offline from a directory of vendored wheels, e.g.
+    one built with `pip download sagemaker geopandas==0.9.0 -d wheelhouse`.
     """
+    try:
+        return importlib.import_module(module_name)
+    except ImportError:
+        logger.info(f"Installing {requirement}")
+        subprocess.check_call([sys.executable, "-m", "pip", "install", requirement])
+        importlib.invalidate_caches()
+        return importlib.import_module(module_name)
 
-    boto_session = boto3.Session(region_name=region)
 
-    sagemaker_client = boto_session.client("sagemaker")
-    return sagemaker.session.Session(
-        boto_session=boto_session,
-        sagemaker_client=sagemaker_client,
-        default_bucket=default_bucket,
-    )
+def get_session(region):
+    """Gets the boto3 session based on the region.
+
+    The feature group is described and written with its boto3 clients, so a run with a
+    feature group starts without importing, or installing, the sagemaker package.
+    """
+    return boto3.Session(region_name=region)
 
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 logger.addHandler(logging.StreamHandler())
 
+
+def _cpu_seconds():
+    """CPU time of this process and its waited for children, e.g. pip installs."""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def _peak_rss_mb():
+    """Peak resident set size in MiB since the last _reset_peak_rss()."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _reset_peak_rss():
+    """Resets the kernel's peak RSS of this process to its current RSS, where Linux allows it."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+class StageReport:
+    """Collects the wall time, CPU time, peak RSS and rows in/out of named stages.
+
+    A stage entered more than once, e.g. once per streamed batch, is reported once with
+    its totals. Peak RSS is reset on entering each stage, so it is the stage's own peak
+    where /proc/self/clear_refs is writable and the process peak so far elsewhere. CPU
+    time is process wide, so stages running in parallel threads each count it all.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = _cpu_seconds()
+
+    def _open_stages(self):
+        if not hasattr(self.local, "open_stages"):
+            self.local.open_stages = []
+        return self.local.open_stages
+
+    def _fold_peak(self, open_stages):
+        peak = _peak_rss_mb()
+        for stage in open_stages:
+            stage["peak_rss_mb"] = max(stage["peak_rss_mb"], peak)
+        _reset_peak_rss()
+
+    @contextlib.contextmanager
+    def stage(self, name: str, rows_in=None):
+        """Measures the enclosed block as stage name. Set rows_out on the yielded dict.
+
+        A stage nested in a stage of the same name is timed by the outer one only, and
+        adds its rows to it.
+        """
+        open_stages = self._open_stages()
+        outer = next((stage for stage in open_stages if stage["name"] == name), None)
+        if outer is not None:
+            nested = {"rows_in": rows_in, "rows_out": None}
+            try:
+                yield nested
+            finally:
+                for key in ["rows_in", "rows_out"]:
+                    if nested[key] is not None:
+                        outer[key] = (outer[key] or 0) + int(nested[key])
+            return
+        current = {"name": name, "rows_in": rows_in, "rows_out": None, "peak_rss_mb": 0.0}
+        self._fold_peak(open_stages)
+        open_stages.append(current)
+        start_wall, start_cpu = time.perf_counter(), _cpu_seconds()
+        try:
+            yield current
+        finally:
+            wall, cpu = time.perf_counter() - start_wall, _cpu_seconds() - start_cpu
+            self._fold_peak(open_stages)
+            open_stages.pop()
+            with self.lock:
+                totals = self.stages.setdefault(name, {
+                    "calls": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0, "peak_rss_mb": 0.0,
+                    "rows_in": None, "rows_out": None,
+                })
+                totals["calls"] += 1
+                totals["wall_seconds"] += wall
+                totals["cpu_seconds"] += cpu
+                totals["peak_rss_mb"] = max(totals["peak_rss_mb"], current["peak_rss_mb"])
+                for key in ["rows_in", "rows_out"]:
+                    if current[key] is not None:
+                        totals[key] = (totals[key] or 0) + int(current[key])
+
+    def to_dict(self):
+        with self.lock:
+            stages = [dict(stage=name, **totals) for name, totals in self.stages.items()]
+        return {
+            "wall_seconds": time.perf_counter() - self.start_wall,
+            "cpu_seconds": _cpu_seconds() - self.start_cpu,
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "stages": stages,
+        }
+
+
+# Stage measurements of this run, written out by instrumented()
+report = StageReport()
+
+
 def parse_args() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument('--ingest_featuregroup_name', type=str, default=None)
     parser.add_argument('--region', type=str)
     parser.add_argument('--bucket', type=str)
     parser.add_argument('--base_dir', type=str, default="/opt/ml/processing")
+    # JSON object of the Hive partition values of the input to read, e.g. '{"type": ["green"],
+    # "pickup_year": [2018]}' for the partitioned dataset of glue/taxi_etl.py. Other partitions are skipped
+    parser.add_argument('--input_partitions', type=str, default=None)
+    # Directory of vendored wheels to install missing packages from without network access
+    parser.add_argument('--wheelhouse', type=str, default=None)
+    # Local directory or s3:// prefix caching zone matrices by the hash of taxi_zones.zip
+    parser.add_argument('--zone_cache', type=str, default=None)
+    # Build the zone pair matrix, and the zone centroid table of glue/taxi_etl.py --enrich, next to the
+    # given taxi_zones.zip and exit
+    parser.add_argument('--build_zone_matrix', type=str, default=None)
+    # The input was enriched and cleaned by glue/taxi_etl.py --enrich, so it is only split and written
+    parser.add_argument('--input_enriched', action='store_true')
+    # Process the input in record batches of this many rows instead of loading it all at once
+    parser.add_argument('--stream_batch_size', type=int, default=None)
+    # Load, enrich and clean parquet row groups in this many processes (0 uses every core)
+    parser.add_argument('--num_workers', type=int, default=1)
+    # "pandas" or "duckdb", which runs load, zone join, calendar features and filters as one query
+    # on every core and spills to disk instead of holding the input in memory
+    parser.add_argument('--engine', type=str, choices=["pandas", "duckdb"], default="pandas")
+    # Memory DuckDB may use before spilling, e.g. "8GB", by default 80% of the instance memory
+    parser.add_argument('--duckdb_memory_limit', type=str, default=None)
+    # Local directory keeping the loaded and enriched tables of the in-memory mode as Arrow files, e.g.
+    # one persisted with a ProcessingInput and ProcessingOutput. Reruns on the same input files, zones
+    # and script resume from the last stage checkpointed. The streaming, parallel, DuckDB and
+    # --input_enriched modes refuse it
+    parser.add_argument('--checkpoint_dir', type=str, default=None)
+    # JSON object overriding outlier_bounds, e.g. '{"fare_amount": [0, 150]}'
+    parser.add_argument('--outlier_bounds', type=str, default=None)
+    # Skip row groups and rows failing the raw column outlier bounds while reading the parquet files
+    parser.add_argument('--pushdown_filters', action='store_true')
+    # Threads sending PutRecord requests to the feature group, 0 for 4 per core
+    parser.add_argument('--ingest_workers', type=int, default=0)
+    # Rows waiting to be ingested before producers block
+    parser.add_argument('--ingest_queue_rows', type=int, default=20000)
+    # Attempts per row for throttled or transiently failing PutRecord requests
+    parser.add_argument('--ingest_max_attempts', type=int, default=8)
+    # Ingest into the feature group while the train/validation/test files are written, not after
+    parser.add_argument('--overlap_ingestion', action='store_true')
+    # "online" ingests with PutRecord, "offline" bulk writes Parquet straight to the offline store.
+    # "offline" only supports the default Glue table format, not Iceberg
+    parser.add_argument('--ingest_mode', type=str, choices=["online", "offline"], default="online")
+    # Offline store location to write to instead of the feature group's resolved S3 URI,
+    # e.g. a local directory
+    parser.add_argument('--offline_store_uri', type=str, default=None)
+    # How rows are split into train/validation/test: "random" draws the split with train_test_split,
+    # "hash" assigns each row from a hash of its values, consistently across batches and hosts
+    parser.add_argument('--split_method', type=str, choices=["random", "hash"], default="random")
+    # Format of the train/validation/test files: csv, parquet, libsvm or recordio-protobuf
+    parser.add_argument('--output_format', type=str, choices=["csv", "parquet", "libsvm", "recordio-protobuf"],
+                        default="csv")
+    # Compression codec of parquet output files
+    parser.add_argument('--parquet_compression', type=str, choices=["snappy", "zstd"], default="snappy")
+    # Spread each split over this many files in total, divided between the hosts, with the row
+    # counts of a host's files differing by at most one. Each host writes at least one file
+    parser.add_argument('--num_shards', type=int, default=1)
+    # Roll each split over to a new file once it reaches about this many bytes, instead of --num_shards
+    parser.add_argument('--shard_bytes', type=int, default=None)
+    # Directory the per stage timing and memory report is written to, by default {base_dir}/report
+    parser.add_argument('--report_dir', type=str, default=None)
+    # Profile the whole run with cProfile or pyinstrument and write the profile next to the report
+    parser.add_argument('--profile', type=str, choices=["cprofile", "pyinstrument"], default=None)
     args, _ = parser.parse_known_args()
     return args
 
@@ -66,6 +256,9 @@ def extract_zones(zones_file: str, zones_dir: str):
 
 
 def load_zones(zones_dir: str):
+    # Imported here so that runs reusing a cached zone matrix never load geopandas
+    gpd = require("geopandas", "geopandas==0.9.0")
+
     logging.info(f"Loading zones from {zones_dir}")
     # Load the shape file and get the geometry and lat/lon
     zone_df = gpd.read_file(os.path.join(zones_dir, "taxi_zones.shp"))
@@ -77,146 +270,1240 @@ def load_zones(zones_dir: str):
     return zone_df
 
 
-def load_data(file_list: list):
-    # Define dates, and columns to use
-    use_cols = [
-        "fare_amount",
-        "lpep_pickup_datetime",
-        "lpep_dropoff_datetime",
-        "passenger_count",
-        "PULocationID",
-        "DOLocationID",
+def build_zone_lookup(zone_df: pd.DataFrame):
+    """Copies the zone coordinates enrich_data needs into NumPy arrays.
+
+    Position i of each array holds the zone row that trip location ID i joins to
+    (the zone table index), and one trailing NaN entry stands in for IDs with no zone.
+    """
+    size = zone_df.index.max() + 1
+    positions = zone_df.index.to_numpy()
+    columns = {
+        "latitude": zone_df["latitude"].to_numpy(dtype="float64"),
+        "longitude": zone_df["longitude"].to_numpy(dtype="float64"),
+        "centroid_x": zone_df["centroid"].x.to_numpy(dtype="float64"),
+        "centroid_y": zone_df["centroid"].y.to_numpy(dtype="float64"),
+    }
+    zone_lookup = {}
+    for name, values in columns.items():
+        zone_lookup[name] = np.full(size + 1, np.nan)
+        zone_lookup[name][positions] = values
+    return zone_lookup
+
+
+# Zone pair features, stored as float32 for every (pickup, drop off) location pair.
+# Bump zone_matrix_version when the layout or derivation changes to invalidate caches.
+zone_matrix_file_name = "zone_matrix.npy"
+zone_matrix_version = 1
+zone_matrix_dtype = np.dtype([
+    ("geo_distance", "float32"),
+    ("pickup_latitude", "float32"),
+    ("pickup_longitude", "float32"),
+    ("dropoff_latitude", "float32"),
+    ("dropoff_longitude", "float32"),
+])
+
+
+def build_zone_matrix(zone_lookup: dict):
+    """Precomputes the zone features of every pickup and drop off location pair.
+
+    matrix[pickup, dropoff] holds the centroid distance in km and the coordinates of
+    both zones, indexed like the zone_lookup arrays (including the NaN entry).
+    """
+    size = len(zone_lookup["latitude"])
+    matrix = np.empty((size, size), dtype=zone_matrix_dtype)
+    # Distance in km between the zone centroids
+    delta_x = zone_lookup["centroid_x"][np.newaxis, :] - zone_lookup["centroid_x"][:, np.newaxis]
+    delta_y = zone_lookup["centroid_y"][np.newaxis, :] - zone_lookup["centroid_y"][:, np.newaxis]
+    matrix["geo_distance"] = np.sqrt(delta_x * delta_x + delta_y * delta_y) / 1000
+    matrix["pickup_latitude"] = zone_lookup["latitude"][:, np.newaxis]
+    matrix["pickup_longitude"] = zone_lookup["longitude"][:, np.newaxis]
+    matrix["dropoff_latitude"] = zone_lookup["latitude"][np.newaxis, :]
+    matrix["dropoff_longitude"] = zone_lookup["longitude"][np.newaxis, :]
+    return matrix
+
+
+def save_zone_matrix(zone_matrix: np.ndarray, zone_matrix_file: str):
+    logger.info(f"Writing zone matrix: {zone_matrix_file}")
+    # Write to a temporary file first so concurrent readers never see a partial matrix
+    tmp_file = f"{zone_matrix_file}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(tmp_file, "wb") as f:
+        np.save(f, zone_matrix, allow_pickle=False)
+    os.replace(tmp_file, zone_matrix_file)
+
+
+# Zone centroids the Glue ETL job joins on the trip location IDs, glue/taxi_etl.py --enrich
+zone_centroids_file_name = "zone_centroids.csv"
+
+
+def save_zone_centroids(zone_lookup: dict, zone_centroids_file: str):
+    """Writes the zone_lookup entries of known zones as a CSV table keyed by location_id.
+
+    location_id is the zone_lookup position, so joining it on the trip location IDs
+    gives the zone features enrich_data looks up in the zone matrix.
+    """
+    logger.info(f"Writing zone centroids: {zone_centroids_file}")
+    zone_centroids = pd.DataFrame(zone_lookup)
+    zone_centroids.index.name = "location_id"
+    zone_centroids.dropna().to_csv(zone_centroids_file)
+
+
+def load_zone_matrix(zone_matrix_file: str):
+    """Opens a zone matrix written by save_zone_matrix as a read only memory map."""
+    logger.info(f"Loading zone matrix: {zone_matrix_file}")
+    zone_matrix = np.load(zone_matrix_file, mmap_mode="r", allow_pickle=False)
+    if zone_matrix.dtype != zone_matrix_dtype or zone_matrix.ndim != 2:
+        raise Exception(f"Zone matrix {zone_matrix_file} has unexpected layout {zone_matrix.dtype}")
+    return zone_matrix
+
+
+def zone_positions(location_ids, zone_matrix: np.ndarray):
+    """Maps location IDs to zone_matrix positions, sending unknown IDs to the NaN entry."""
+    sentinel = len(zone_matrix) - 1
+    ids = np.asarray(location_ids, dtype="float64")
+    known = (ids >= 0) & (ids < sentinel)
+    return np.where(known, ids, sentinel).astype(np.int64)
+
+
+def zone_pair_features(zone_matrix: np.ndarray, pickup_location_ids, dropoff_location_ids):
+    """Looks up the zone features for pickup/drop off location ID pairs.
+
+    Shared by enrich_data and online feature code so both read the same values.
+    Returns a dict of float32 arrays keyed by feature name.
+    """
+    pairs = zone_matrix[
+        zone_positions(pickup_location_ids, zone_matrix),
+        zone_positions(dropoff_location_ids, zone_matrix),
     ]
+    return {name: pairs[name] for name in zone_matrix_dtype.names}
+
+
+# Compact dtypes of the trip table, applied after every stage to roughly halve its memory.
+# Integer dtypes are only applied once a column has no missing values left.
+dtype_plan = {
+    "fare_amount": "float32",
+    "passenger_count": "int8",
+    "PULocationID": "int16",
+    "DOLocationID": "int16",
+    "pickup_latitude": "float32",
+    "pickup_longitude": "float32",
+    "dropoff_latitude": "float32",
+    "dropoff_longitude": "float32",
+    "geo_distance": "float32",
+    "hour": "int8",
+    "weekday": "int8",
+    "month": "int8",
+    "duration_minutes": "float32",
+}
+
+
+def compact_dtypes(df: pd.DataFrame):
+    """Casts the columns of df named in dtype_plan in place, one column at a time."""
+    for column, dtype in dtype_plan.items():
+        if column not in df.columns or df[column].dtype == dtype:
+            continue
+        if np.issubdtype(np.dtype(dtype), np.integer) and df[column].isna().any():
+            continue
+        df[column] = df[column].astype(dtype)
+    return df
+
+
+# Define dates, and columns to use
+use_cols = [
+    "fare_amount",
+    "lpep_pickup_datetime",
+    "lpep_dropoff_datetime",
+    "passenger_count",
+    "PULocationID",
+    "DOLocationID",
+]
+
+# Names of use_cols in the dataset written by the Glue ETL job, glue/taxi_etl.py
+column_aliases = {
+    "pickup_datetime": "lpep_pickup_datetime",
+    "dropoff_datetime": "lpep_dropoff_datetime",
+    "pulocationid": "PULocationID",
+    "dolocationid": "DOLocationID",
+}
+
+
+def source_columns(names):
+    """Maps each of use_cols to its name among the column names of an input file."""
+    columns = {}
+    for column in use_cols:
+        aliases = [alias for alias, target in column_aliases.items() if target == column and alias in names]
+        columns[column] = aliases[0] if column not in names and aliases else column
+    return columns
+
+
+def input_files(input_dir: str, partitions=None):
+    """Lists the parquet files in input_dir and its Hive style key=value partition directories.
+
+    partitions is a JSON object of the values to keep per partition key, e.g.
+    '{"pickup_year": [2018]}', and the files of other partitions are never opened.
+    Files outside the directories of a key are kept.
+    """
+    selected = {key: {str(value) for value in values} for key, values in json.loads(partitions or "{}").items()}
+    files = []
+    for file in glob.glob(f"{input_dir}/**/*.parquet", recursive=True):
+        directories = os.path.relpath(os.path.dirname(file), input_dir).split(os.sep)
+        values = dict(directory.split("=", 1) for directory in directories if "=" in directory)
+        if all(values[key] in allowed for key, allowed in selected.items() if key in values):
+            files.append(file)
+    return files
+
+
+# Outliers removed by clean_data, as exclusive (lower, upper) bounds checked in this order.
+# None leaves that side unbounded.
+outlier_bounds = {
+    "fare_amount": (0, 200),
+    "passenger_count": (0, None),
+    "duration_minutes": (0, 120),
+    "geo_distance": (0, 121),
+}
+
+
+def get_outlier_bounds(overrides=None):
+    bounds = dict(outlier_bounds)
+    for column, (lower, upper) in json.loads(overrides or "{}").items():
+        if column not in bounds:
+            raise Exception(f"Unknown outlier bound column {column}")
+        bounds[column] = (lower, upper)
+    return bounds
+
+
+def _bounded(values, lower, upper):
+    conditions = []
+    if lower is not None:
+        conditions.append(values > lower)
+    if upper is not None:
+        conditions.append(values < upper)
+    return conditions
+
+
+def pushdown_filter(bounds: dict, schema: pa.Schema):
+    """Translates the outlier bounds on raw columns into a pyarrow dataset filter.
+
+    The filter keeps a superset of the rows clean_data keeps, so clean_data still has
+    the final say. load_data fills null fares and passenger counts with 0, so nulls
+    are kept whenever 0 is within the bounds. Passenger counts are truncated to
+    integers there, so their bounds are widened by one. duration_minutes is derived
+    from the timestamps with the same seconds-of-day arithmetic as enrich_data, and
+    rows with a null timestamp are kept.
+    """
+    columns = source_columns(schema.names)
+    conditions = []
+    for column, widen in (("fare_amount", 0), ("passenger_count", 1)):
+        lower, upper = bounds[column]
+        field_conditions = _bounded(
+            ds.field(columns[column]),
+            None if lower is None else lower - widen,
+            None if upper is None else upper + widen,
+        )
+        if not field_conditions:
+            continue
+        condition = field_conditions[0]
+        for field_condition in field_conditions[1:]:
+            condition = condition & field_condition
+        if all(_bounded(0, lower, upper)):
+            condition = condition | ds.field(columns[column]).is_null()
+        conditions.append(condition)
+
+    timestamp_cols = [columns["lpep_pickup_datetime"], columns["lpep_dropoff_datetime"]]
+    if all(column in schema.names and pa.types.is_timestamp(schema.field(column).type)
+           for column in timestamp_cols):
+        pickup, dropoff = [
+            ds.field(column).cast(pa.timestamp("us"), safe=False).cast(pa.int64()) for column in timestamp_cols
+        ]
+        seconds = pc.floor(pc.divide(pc.subtract(dropoff, pickup).cast(pa.float64()), 1e6))
+        # Seconds component of the timedelta, like pandas Series.dt.seconds
+        day_seconds = pc.subtract(seconds, pc.multiply(pc.floor(pc.divide(seconds, 86400)), 86400))
+        duration_conditions = _bounded(pc.divide(day_seconds, 60), *bounds["duration_minutes"])
+        if duration_conditions:
+            duration_condition = duration_conditions[0]
+            for condition in duration_conditions[1:]:
+                duration_condition = duration_condition & condition
+            conditions.append(
+                duration_condition | ds.field(timestamp_cols[0]).is_null() | ds.field(timestamp_cols[1]).is_null()
+            )
+
+    row_filter = None
+    for condition in conditions:
+        row_filter = condition if row_filter is None else row_filter & condition
+    return row_filter
+
+
+def row_group_tasks(file_list: list, row_filter=None):
+    """Lists (file, row group, position of its first row) for the input files.
+
+    With a row_filter, row groups whose statistics rule out every row are skipped.
+    Positions always count every input row, so FS_ID values do not depend on pruning.
+    """
+    tasks = []
+    row_offset = 0
+    for file in file_list:
+        metadata = pq.ParquetFile(file).metadata
+        row_groups = range(metadata.num_row_groups)
+        if row_filter is not None:
+            fragment = next(iter(ds.dataset(file, format="parquet").get_fragments()))
+            kept = {info.id for split in fragment.split_by_row_group(row_filter) for info in split.row_groups}
+            row_groups = [row_group for row_group in row_groups if row_group in kept]
+            logger.info(f"Reading {len(row_groups)} of {metadata.num_row_groups} row groups of {file}")
+        starts = np.cumsum([0] + [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)])
+        for row_group in row_groups:
+            tasks.append((file, row_group, row_offset + int(starts[row_group])))
+        row_offset += metadata.num_rows
+    return tasks
+
+
+def iter_row_group(file: str, row_group: int, row_offset: int, batch_size=None, row_filter=None):
+    """Yields the rows of one row group as DataFrames indexed by their position in the input.
+
+    Rows failing row_filter are dropped before they are converted to pandas.
+    """
+    parquet_file = pq.ParquetFile(file)
+    if batch_size is None:
+        batch_size = parquet_file.metadata.row_group(row_group).num_rows
+    columns = source_columns(parquet_file.schema_arrow.names)
+    renames = {source: column for column, source in columns.items()}
+    batches = parquet_file.iter_batches(batch_size=batch_size, row_groups=[row_group],
+                                        columns=list(columns.values()))
+    while True:
+        # The stage ends before the yield, so it does not time the consumer of the batch
+        with report.stage("read") as stage:
+            batch = next(batches, None)
+            if batch is None:
+                return
+            positions = np.arange(row_offset, row_offset + batch.num_rows)
+            row_offset += batch.num_rows
+            if row_filter is None:
+                df = batch.to_pandas()
+            else:
+                table = pa.Table.from_batches([batch]).append_column("__position", pa.array(positions))
+                table = ds.dataset(table).to_table(filter=row_filter)
+                positions = table.column("__position").to_numpy()
+                df = table.drop(["__position"]).to_pandas()
+            df = df.rename(columns=renames)[use_cols].fillna(0)
+            df['passenger_count'] = df['passenger_count'].astype('int64')
+            df.index = pd.Index(positions)
+            df = compact_dtypes(df)
+            stage["rows_in"] = batch.num_rows
+            stage["rows_out"] = len(df)
+        yield df
+
+
+def load_data(file_list: list, row_filter=None):
+    if row_filter is not None:
+        tasks = row_group_tasks(file_list, row_filter)
+        dfs = [df for task in tasks for df in iter_row_group(*task, row_filter=row_filter)]
+        if not dfs:
+            raise Exception("No input rows pass the pushed down filters")
+        with report.stage("read"):
+            return pd.concat(dfs)
+
     # Concat input files with select columns
-    dfs = []
+    with report.stage("read") as stage:
+        dfs = []
+        for file in file_list:
+            columns = source_columns(pq.read_schema(file).names)
+            df = pd.read_parquet(file, engine='pyarrow', columns=list(columns.values()))
+            df = df.rename(columns={source: column for column, source in columns.items()}).fillna(0)
+            df['passenger_count'] = df['passenger_count'].astype('int64')
+            dfs.append(compact_dtypes(df))
+        data_df = pd.concat(dfs, ignore_index=True)
+        stage["rows_in"] = stage["rows_out"] = len(data_df)
+    return data_df
+
+
+def iter_cleaned(file_list: list, batch_size=None, current_time_sec=None):
+    """Yields the feature group rows of input files enriched and cleaned by the Glue ETL job.
+
+    The files already hold the cols features, so the rows only get their FS_ID from
+    their position in the input and this run's FS_time. Batches are row groups, or
+    at most batch_size rows.
+    """
+    if current_time_sec is None:
+        current_time_sec = int(round(time.time()))
+    row_offset = 0
     for file in file_list:
-        df = pd.read_parquet(file, engine='pyarrow', columns=use_cols)
-        df = df.fillna(0)
-        df['passenger_count'] = df['passenger_count'].astype('int64')
-        dfs.append(df)
-    return pd.concat(dfs, ignore_index=True)
-
-
-def enrich_data(trip_df: pd.DataFrame, zone_df: pd.DataFrame):
-    # Join trip DF to zones for poth pickup and drop off locations
-    trip_df = gpd.GeoDataFrame(
-        trip_df.join(zone_df, on="PULocationID").join(
-            zone_df, on="DOLocationID", rsuffix="_DO", lsuffix="_PU"
-        )
-    )
-    trip_df["geo_distance"] = (
-        trip_df["centroid_PU"].distance(trip_df["centroid_DO"]) / 1000
+        parquet_file = pq.ParquetFile(file)
+        batches = parquet_file.iter_batches(batch_size=batch_size or parquet_file.metadata.num_rows or 1,
+                                            columns=cols)
+        while True:
+            with report.stage("read") as stage:
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                df = batch.to_pandas()
+                df.index = pd.RangeIndex(row_offset, row_offset + len(df))
+                row_offset += len(df)
+                df["FS_ID"] = df.index + 1000
+                df["FS_time"] = pd.Categorical.from_codes(
+                    np.zeros(len(df), dtype=np.int8), categories=[float(current_time_sec)]
+                )
+                df = compact_dtypes(df)[cols_fg]
+                stage["rows_in"] = stage["rows_out"] = len(df)
+            yield df
+
+
+def load_cleaned(file_list: list, current_time_sec=None):
+    """Loads input files enriched and cleaned by the Glue ETL job, like clean_data returns them."""
+    dfs = list(iter_cleaned(file_list, current_time_sec=current_time_sec))
+    if not dfs:
+        raise Exception("No rows in the enriched input files")
+    with report.stage("read"):
+        data_fg = pd.concat(dfs)
+    return data_fg[cols], data_fg
+
+
+def iter_data(file_list: list, batch_size: int, row_filter=None):
+    """Yields the rows load_data would return as DataFrames of at most batch_size rows.
+
+    Each batch keeps the index it would have had in the concatenated frame, so
+    FS_ID values match the non streaming path.
+    """
+    for task in row_group_tasks(file_list, row_filter):
+        yield from iter_row_group(*task, batch_size=batch_size, row_filter=row_filter)
+
+
+# Timestamp format of the TLC trip files
+datetime_format = "%Y-%m-%d %H:%M:%S"
+
+
+def parse_datetimes(values: pd.Series):
+    """Parses timestamps with datetime_format, inferring the format only if that fails."""
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    try:
+        return pd.to_datetime(values, format=datetime_format)
+    except (TypeError, ValueError):
+        logger.warning(f"Timestamps do not match {datetime_format}, inferring their format")
+        return pd.to_datetime(values)
+
+
+ns_per_day = 86400 * 10**9
+ns_per_hour = 3600 * 10**9
+
+
+def calendar_features(pickup: pd.Series, dropoff: pd.Series):
+    """Derives hour, weekday, month and duration_minutes from datetime columns.
+
+    Works on the int64 nanoseconds directly instead of separate Series.dt passes.
+    duration_minutes is the seconds component of the dropoff - pickup timedelta
+    (Series.dt.seconds) in minutes, and missing timestamps give NaN, as before.
+    """
+    pickup_ns = pickup.to_numpy(dtype="datetime64[ns]")
+    dropoff_ns = dropoff.to_numpy(dtype="datetime64[ns]")
+    pickup_int = pickup_ns.view("int64")
+
+    days, day_ns = np.divmod(pickup_int, ns_per_day)
+    features = {
+        "hour": day_ns // ns_per_hour,
+        # 1970-01-01 was a Thursday
+        "weekday": (days + 3) % 7,
+        "month": pickup_ns.astype("datetime64[M]").view("int64") % 12 + 1,
+        "duration_minutes": (dropoff_ns.view("int64") - pickup_int) // 10**9 % 86400 / 60,
+    }
+
+    missing_pickup = np.isnat(pickup_ns)
+    missing = missing_pickup | np.isnat(dropoff_ns)
+    if missing.any():
+        for name in ["hour", "weekday", "month"]:
+            features[name] = np.where(missing_pickup, np.nan, features[name])
+        features["duration_minutes"] = np.where(missing, np.nan, features["duration_minutes"])
+    return features
+
+
+def enrich_data(trip_df: pd.DataFrame, zone_matrix: np.ndarray, current_time_sec=None):
+    # Look up zone coordinates and distance for the pickup and drop off locations
+    with report.stage("join", rows_in=len(trip_df)) as stage:
+        features = zone_pair_features(zone_matrix, trip_df["PULocationID"], trip_df["DOLocationID"])
+        for name, values in features.items():
+            trip_df[name] = values
+        stage["rows_out"] = len(trip_df)
+
+    # Add date parts and calculated duration in minutes
+    with report.stage("datetime", rows_in=len(trip_df)) as stage:
+        trip_df["lpep_pickup_datetime"] = parse_datetimes(trip_df["lpep_pickup_datetime"])
+        trip_df["lpep_dropoff_datetime"] = parse_datetimes(trip_df["lpep_dropoff_datetime"])
+        features = calendar_features(trip_df["lpep_pickup_datetime"], trip_df["lpep_dropoff_datetime"])
+        for name, values in features.items():
+            trip_df[name] = values
+        stage["rows_out"] = len(trip_df)
+
+    trip_df['FS_ID'] = trip_df.index + 1000
+    if current_time_sec is None:
+        current_time_sec = int(round(time.time()))
+    # One event time for every row, stored as a single category instead of a float per row
+    trip_df["FS_time"] = pd.Categorical.from_codes(
+        np.zeros(len(trip_df), dtype=np.int8), categories=[float(current_time_sec)]
     )
+    return compact_dtypes(trip_df)
+
+
+# Filter columns
+cols = [
+    "fare_amount",
+    "passenger_count",
+    "pickup_latitude",
+    "pickup_longitude",
+    "dropoff_latitude",
+    "dropoff_longitude",
+    "geo_distance",
+    "hour",
+    "weekday",
+    "month",
+]
+
+cols_fg = [
+    "fare_amount",
+    "passenger_count",
+    "pickup_latitude",
+    "pickup_longitude",
+    "dropoff_latitude",
+    "dropoff_longitude",
+    "geo_distance",
+    "hour",
+    "weekday",
+    "month",
+    "FS_ID",
+    "FS_time"
+]
+
+
+def clean_data(trip_df: pd.DataFrame, bounds=None):
+    # Remove outliers
+    with report.stage("filter", rows_in=len(trip_df)) as stage:
+        keep = np.ones(len(trip_df), dtype=bool)
+        for column, (lower, upper) in (bounds or outlier_bounds).items():
+            for condition in _bounded(trip_df[column], lower, upper):
+                keep &= condition.to_numpy()
+        trip_df = compact_dtypes(trip_df[keep].dropna())
+        stage["rows_out"] = len(trip_df)
+
+    return trip_df[cols], trip_df[cols_fg]
+
+class FeatureStoreIngester:
+    """Streams rows into a feature group with PutRecord requests from a pool of threads.
+
+    submit() takes DataFrame batches as they are produced. Their rows wait in a queue
+    of at most queue_rows rows, so a producer that outpaces ingestion blocks instead
+    of buffering the dataset. Throttled and transiently failing requests are retried
+    with jittered exponential backoff. client is a sagemaker-featurestore-runtime
+    client or anything with the same put_record method.
+
+    Any other exception in a worker stops ingestion. Workers then drain the queue
+    without sending, so a blocked submit() returns, and submit() and close() raise
+    the error.
+    """
+    retryable_errors = {"ThrottlingException", "ServiceUnavailable", "InternalFailure"}
+    chunk_rows = 100
+
+    def __init__(self, fg_name: str, client, num_workers=0, queue_rows=20000, max_attempts=8,
+                 base_backoff=0.05, max_backoff=5.0):
+        self.fg_name = fg_name
+        self.client = client
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.queue = queue.Queue(maxsize=max(1, queue_rows // self.chunk_rows))
+        self.lock = threading.Lock()
+        self.num_records = 0
+        self.num_retries = 0
+        self.failed_rows = []
+        self.latencies = []
+        self.error = None
+        self.start = time.perf_counter()
+        self.threads = [
+            threading.Thread(target=self._work, daemon=True) for _ in range(num_workers or 4 * n_cores)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, data_fg: pd.DataFrame):
+        self._raise_error()
+        columns = list(data_fg.columns)
+        values = [data_fg[name].astype(str).to_numpy() for name in columns]
+        missing = data_fg.isna().to_numpy()
+        chunk = []
+        for i, index in enumerate(data_fg.index):
+            # Like FeatureGroup.ingest, missing values are left out of the record
+            record = [
+                {"FeatureName": name, "ValueAsString": values[j][i]}
+                for j, name in enumerate(columns) if not missing[i, j]
+            ]
+            chunk.append((index, record))
+            if len(chunk) == self.chunk_rows:
+                self.queue.put(chunk)
+                chunk = []
+        if chunk:
+            self.queue.put(chunk)
 
-    # Add date parts
-    trip_df["lpep_pickup_datetime"] = pd.to_datetime(trip_df["lpep_pickup_datetime"])
-    trip_df["hour"] = trip_df["lpep_pickup_datetime"].dt.hour
-    trip_df["weekday"] = trip_df["lpep_pickup_datetime"].dt.weekday
-    trip_df["month"] = trip_df["lpep_pickup_datetime"].dt.month
-
-    # Get calculated duration in minutes
-    trip_df["lpep_dropoff_datetime"] = pd.to_datetime(trip_df["lpep_dropoff_datetime"])
-    trip_df["duration_minutes"] = (
-        trip_df["lpep_dropoff_datetime"] - trip_df["lpep_pickup_datetime"]
-    ).dt.seconds / 60
-
-    # Rename and filter cols
-    trip_df = trip_df.rename(
-        columns={
-            "latitude_PU": "pickup_latitude",
-            "longitude_PU": "pickup_longitude",
-            "latitude_DO": "dropoff_latitude",
-            "longitude_DO": "dropoff_longitude",
+    def _work(self):
+        latencies = []
+        with self.lock:
+            self.latencies.append(latencies)
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                return
+            try:
+                for index, record in chunk:
+                    if self.error is not None:
+                        break
+                    self._put_record(index, record, latencies)
+            except Exception as e:
+                logger.error(f"Ingestion into {self.fg_name} stopped: {e!r}")
+                with self.lock:
+                    if self.error is None:
+                        self.error = e
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise Exception(f"Ingestion into {self.fg_name} stopped") from self.error
+
+    def _put_record(self, index, record: list, latencies: list):
+        for attempt in range(self.max_attempts):
+            start = time.perf_counter()
+            try:
+                self.client.put_record(FeatureGroupName=self.fg_name, Record=record)
+            except (ClientError, BotoCoreError) as e:
+                code = e.response["Error"]["Code"] if isinstance(e, ClientError) else type(e).__name__
+                retryable = isinstance(e, BotoCoreError) or code in self.retryable_errors
+                if not retryable or attempt == self.max_attempts - 1:
+                    logger.warning(f"PutRecord failed for row {index}: {code}")
+                    with self.lock:
+                        self.failed_rows.append(index)
+                    return
+                with self.lock:
+                    self.num_retries += 1
+                time.sleep(random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt)))
+            else:
+                latencies.append(time.perf_counter() - start)
+                with self.lock:
+                    self.num_records += 1
+                return
+
+    def close(self):
+        """Waits for the queued rows and returns the ingestion metrics.
+
+        Raises when a worker stopped ingestion or rows are left that could not be ingested.
+        """
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        seconds = time.perf_counter() - self.start
+        latencies = np.concatenate([np.asarray(values) for values in self.latencies]) * 1000
+        metrics = {
+            "records": self.num_records,
+            "failed_records": len(self.failed_rows),
+            "retries": self.num_retries,
+            "seconds": seconds,
+            "records_per_sec": self.num_records / seconds if seconds > 0 else 0.0,
+            "p50_latency_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+            "p99_latency_ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+        }
+        logger.info(f"Feature group [{self.fg_name}] ingestion: {metrics}")
+        self._raise_error()
+        if self.failed_rows:
+            raise Exception(f"{len(self.failed_rows)} rows failed to be ingested into {self.fg_name}")
+        return metrics
+
+
+class OfflineStoreWriter:
+    """Writes feature group rows straight to its offline store as partitioned Parquet.
+
+    Files follow the layout the feature store writes itself. They are partitioned by
+    the year, month, day and hour of each record's event time, and carry the
+    write_time, api_invocation_time and is_deleted columns. Nothing goes through
+    PutRecord or the online store. offline_uri is the ResolvedOutputS3Uri of the
+    feature group or a local directory. submit() and close() work like
+    FeatureStoreIngester's.
+
+    Only offline stores in the Glue table format are supported. Files written under
+    an Iceberg table's location are not in its metadata, so its queries never see them.
+    """
+
+    def __init__(self, fg_name: str, offline_uri: str, event_time_feature="FS_time"):
+        self.fg_name = fg_name
+        self.offline_uri = offline_uri
+        self.event_time_feature = event_time_feature
+        self.staging_dir = tempfile.mkdtemp() if offline_uri.startswith("s3://") else None
+        self.num_records = 0
+        self.num_files = 0
+        self.start = time.perf_counter()
+
+    def to_table(self, data_fg: pd.DataFrame):
+        # Integral, Fractional and String features are stored as bigint, double and string
+        columns = {}
+        for name in data_fg.columns:
+            values = np.asarray(data_fg[name])
+            if np.issubdtype(values.dtype, np.integer):
+                columns[name] = pa.array(values.astype(np.int64))
+            elif values.dtype == np.float32:
+                # Parsed from the same shortest repr PutRecord sends, e.g. 40.7128 and not
+                # 40.71279907226562, so both ingest modes store the same doubles
+                columns[name] = pa.array(data_fg[name].astype(str).to_numpy().astype(np.float64))
+            elif np.issubdtype(values.dtype, np.floating):
+                columns[name] = pa.array(values.astype(np.float64))
+            else:
+                columns[name] = pa.array(values.astype(str))
+        now = np.datetime64(int(time.time() * 1000), "ms")
+        columns["write_time"] = pa.array(np.full(len(data_fg), now), pa.timestamp("ms", tz="UTC"))
+        columns["api_invocation_time"] = columns["write_time"]
+        columns["is_deleted"] = pa.array(np.zeros(len(data_fg), dtype=bool))
+        return pa.table(columns)
+
+    def submit(self, data_fg: pd.DataFrame):
+        if len(data_fg) == 0:
+            return
+        table = self.to_table(data_fg)
+        event_hours = (np.asarray(data_fg[self.event_time_feature], dtype=np.float64) // 3600).astype(np.int64)
+        for event_hour in np.unique(event_hours):
+            partition = time.strftime("year=%Y/month=%m/day=%d/hour=%H", time.gmtime(event_hour * 3600))
+            self.write_file(partition, table.filter(pa.array(event_hours == event_hour)))
+        self.num_records += len(data_fg)
+
+    def write_file(self, partition: str, table: pa.Table):
+        name = f"{time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())}_{uuid.uuid4().hex[:16]}.parquet"
+        if self.staging_dir is None:
+            os.makedirs(os.path.join(self.offline_uri, partition), exist_ok=True)
+            pq.write_table(table, os.path.join(self.offline_uri, partition, name))
+        else:
+            bucket, prefix = _split_s3_uri(self.offline_uri)
+            staged_file = os.path.join(self.staging_dir, name)
+            pq.write_table(table, staged_file)
+            boto3.client("s3").upload_file(staged_file, bucket, os.path.join(prefix, partition, name))
+            os.remove(staged_file)
+        self.num_files += 1
+
+    def close(self):
+        if self.staging_dir is not None:
+            shutil.rmtree(self.staging_dir, ignore_errors=True)
+        seconds = time.perf_counter() - self.start
+        metrics = {
+            "records": self.num_records,
+            "files": self.num_files,
+            "seconds": seconds,
+            "records_per_sec": self.num_records / seconds if seconds > 0 else 0.0,
         }
+        logger.info(f"Feature group [{self.fg_name}] offline store write to {self.offline_uri}: {metrics}")
+        return metrics
+
+
+def open_ingester(fg_name: str, boto_session, ingest_options=None):
+    ingest_options = dict(ingest_options or {})
+    mode = ingest_options.pop("mode", "online")
+    offline_store_uri = ingest_options.pop("offline_store_uri", None)
+    if mode == "offline":
+        if not offline_store_uri:
+            description = boto_session.client("sagemaker").describe_feature_group(FeatureGroupName=fg_name)
+            offline_store_config = description["OfflineStoreConfig"]
+            if offline_store_config.get("TableFormat") == "Iceberg":
+                raise Exception(f"Feature group {fg_name} has an Iceberg offline store, which the offline "
+                                f"ingest mode does not support. Use --ingest_mode online")
+            offline_store_uri = offline_store_config["S3StorageConfig"]["ResolvedOutputS3Uri"]
+        logger.info(f"Writing feature group [{fg_name}] straight to its offline store at {offline_store_uri}")
+        return OfflineStoreWriter(fg_name, offline_store_uri)
+
+    # Retries are left to the ingester, which backs off with jitter, so botocore makes a
+    # single attempt. Every worker gets its own pooled connection instead of waiting for one
+    # of the default 10
+    ingest_options["num_workers"] = ingest_options.get("num_workers") or 4 * n_cores
+    client = boto_session.client(
+        "sagemaker-featurestore-runtime",
+        config=Config(retries={"total_max_attempts": 1}, max_pool_connections=ingest_options["num_workers"]),
     )
-    
-    trip_df['FS_ID'] = trip_df.index + 1000
-    current_time_sec = int(round(time.time()))
-    trip_df["FS_time"] = pd.Series([current_time_sec]*len(trip_df), dtype="float64")
-    return trip_df
+    ingester = FeatureStoreIngester(fg_name, client, **ingest_options)
+    logger.info(f"Ingesting into feature group [{fg_name}] using {len(ingester.threads)} workers")
+    return ingester
 
 
-def clean_data(trip_df: pd.DataFrame):
-    # Remove outliers
-    trip_df = trip_df[
-        (trip_df.fare_amount > 0)
-        & (trip_df.fare_amount < 200)
-        & (trip_df.passenger_count > 0)
-        & (trip_df.duration_minutes > 0)
-        & (trip_df.duration_minutes < 120)
-        & (trip_df.geo_distance > 0)
-        & (trip_df.geo_distance < 121)
-    ].dropna()
-
-    # Filter columns
-    cols = [
-        "fare_amount",
-        "passenger_count",
-        "pickup_latitude",
-        "pickup_longitude",
-        "dropoff_latitude",
-        "dropoff_longitude",
-        "geo_distance",
-        "hour",
-        "weekday",
-        "month",
-    ]
-    
-    cols_fg = [
-        "fare_amount",
-        "passenger_count",
-        "pickup_latitude",
-        "pickup_longitude",
-        "dropoff_latitude",
-        "dropoff_longitude",
-        "geo_distance",
-        "hour",
-        "weekday",
-        "month",
-        "FS_ID",
-        "FS_time"
+def ingest_data(data_fg: pd.DataFrame, fg_name: str, boto_session, ingest_options=None) -> None:
+    ingester = open_ingester(fg_name, boto_session, ingest_options)
+    ingester.submit(data_fg)
+    ingester.close()
+
+
+class CsvOutput:
+    """Headerless CSV with the label in the first column."""
+    extension = "csv"
+    content_type = "text/csv"
+
+    def __init__(self, path: str, compression=None):
+        self.file = open(path, "w")
+
+    def write(self, data_df: pd.DataFrame):
+        data_df.to_csv(self.file, header=False, index=False)
+
+    def size(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetOutput:
+    """Parquet with the label in the first column, compressed with snappy or zstd."""
+    extension = "parquet"
+    content_type = "application/x-parquet"
+
+    def __init__(self, path: str, compression="snappy"):
+        self.path = path
+        self.compression = compression
+        self.writer = None
+
+    def write(self, data_df: pd.DataFrame):
+        table = pa.Table.from_pandas(data_df, preserve_index=False)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path, table.schema, compression=self.compression)
+        self.writer.write_table(table)
+
+    def size(self):
+        # Each write_table call flushes its row groups to the file
+        return os.path.getsize(self.path) if self.writer is not None else 0
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class LibsvmOutput:
+    """libsvm text with zero based feature indices, which line up with the CSV columns.
+
+    Zero values are written out, as libsvm readers treat absent features as missing.
+    """
+    extension = "libsvm"
+    content_type = "text/libsvm"
+
+    def __init__(self, path: str, compression=None):
+        self.file = open(path, "w")
+
+    def write(self, data_df: pd.DataFrame):
+        columns = {0: data_df.iloc[:, 0]}
+        for i in range(1, data_df.shape[1]):
+            columns[i] = f"{i - 1}:" + data_df.iloc[:, i].astype(str)
+        pd.DataFrame(columns).to_csv(self.file, sep=" ", header=False, index=False)
+
+    def size(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+class RecordioProtobufOutput:
+    """RecordIO-wrapped protobuf records with dense float32 features and label."""
+    extension = "recordio"
+    content_type = "application/x-recordio-protobuf"
+
+    def __init__(self, path: str, compression=None):
+        require("sagemaker", "sagemaker")
+        from sagemaker.amazon.common import write_numpy_to_dense_tensor
+
+        self.write_numpy_to_dense_tensor = write_numpy_to_dense_tensor
+        self.file = open(path, "wb")
+
+    def write(self, data_df: pd.DataFrame):
+        if len(data_df) > 0:
+            values = data_df.to_numpy(dtype=np.float32)
+            self.write_numpy_to_dense_tensor(self.file, values[:, 1:], values[:, 0])
+
+    def size(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+output_formats = {
+    "csv": CsvOutput,
+    "parquet": ParquetOutput,
+    "libsvm": LibsvmOutput,
+    "recordio-protobuf": RecordioProtobufOutput,
+}
+
+
+def host_shards(num_shards: int, hosts: list, current_host: str):
+    """The number of shards current_host writes, so that the hosts write num_shards in total."""
+    position = sorted(hosts).index(current_host)
+    return max(1, num_shards // len(hosts) + int(position < num_shards % len(hosts)))
+
+
+class ShardedOutput:
+    """Spreads the rows written to one split over several output files.
+
+    With num_shards the rows go round robin over that many files, so their row
+    counts differ by at most one. With shard_bytes a file is closed once it reaches
+    about that size and the next one is started, sizing each write from the bytes
+    per row written so far.
+    """
+    probe_rows = 1000
+
+    def __init__(self, path_prefix: str, output_class, compression="snappy", num_shards=1, shard_bytes=None):
+        self.path_prefix = path_prefix
+        self.output_class = output_class
+        self.compression = compression
+        self.shard_bytes = shard_bytes
+        self.sharded = bool(shard_bytes) or num_shards > 1
+        self.num_opened = 0
+        self.num_rows = 0
+        self.shard_rows = 0
+        self.bytes_per_row = None
+        self.outputs = [self.open_next() for _ in range(1 if shard_bytes else num_shards)]
+
+    def open_next(self):
+        suffix = f"_{self.num_opened:05d}" if self.sharded else ""
+        self.num_opened += 1
+        return self.output_class(f"{self.path_prefix}{suffix}.{self.output_class.extension}", self.compression)
+
+    def write(self, data_df: pd.DataFrame):
+        if self.shard_bytes:
+            self.write_rolling(data_df)
+        elif len(self.outputs) == 1:
+            self.outputs[0].write(data_df)
+        else:
+            shards = (self.num_rows + np.arange(len(data_df))) % len(self.outputs)
+            for shard, output in enumerate(self.outputs):
+                output.write(data_df[shards == shard])
+        self.num_rows += len(data_df)
+
+    def write_rolling(self, data_df: pd.DataFrame):
+        start = 0
+        while start < len(data_df):
+            output = self.outputs[0]
+            if output.size() >= self.shard_bytes:
+                output.close()
+                self.outputs = [self.open_next()]
+                self.shard_rows = 0
+                continue
+            rows = self.probe_rows
+            if self.bytes_per_row:
+                rows = max(1, int((self.shard_bytes - output.size()) / self.bytes_per_row))
+            stop = min(len(data_df), start + rows)
+            output.write(data_df.iloc[start:stop])
+            self.shard_rows += stop - start
+            if output.size() > 0:
+                self.bytes_per_row = output.size() / self.shard_rows
+            start = stop
+
+    def close(self):
+        for output in self.outputs:
+            output.close()
+
+
+def open_split_outputs(base_dir: str, current_host=None, output_format="csv", compression="snappy",
+                       num_shards=1, shard_bytes=None):
+    """Opens the train, validation and test outputs of output_format, see ShardedOutput for the sharding."""
+    output_class = output_formats[output_format]
+    tmp_id = uuid.uuid4().hex[:8]
+    return [
+        ShardedOutput(f"{base_dir}/{split}/{split}_{current_host}_{tmp_id}", output_class, compression,
+                      num_shards, shard_bytes)
+        for split in ["train", "validation", "test"]
     ]
-    return trip_df[cols], trip_df[cols_fg]
 
-def ingest_data(data_fg: pd.DataFrame, fg_name: str, sagemaker_session) -> None:
-    
-    # 4 threads per python process
-    num_workers = 4
-    num_processes = n_cores
-    logger.info(f'Ingesting into feature group [{fg_name}] using {num_processes} processes and {num_workers} workers')
-    fg = FeatureGroup(name=fg_name, sagemaker_session=sagemaker_session)
-    response = fg.ingest(data_frame=data_fg, max_processes=num_processes, max_workers=num_workers, wait=True)
+
+def hash_split_labels(data_df: pd.DataFrame, val_size=0.2, test_size=0.05):
+    """Assigns rows to train (0), validation (1) or test (2) from a hash of their values.
+
+    A row's label only depends on the row itself, so it is the same whether the rows
+    are split at once, in streamed batches or across any number of hosts. Like the
+    two train_test_split calls, val_size of the rows are held out and test_size of
+    those go to test.
     """
-    The ingest call above returns an IngestionManagerPandas instance as a response. Zero based indices of rows 
-    that failed to be ingested are captured via failed_rows in this response. By asserting this count to be 0,
-    we validated that all rows were successfully ingested without a failure.
+    positions = pd.util.hash_pandas_object(data_df, index=False).to_numpy() / 2.0**64
+    labels = np.zeros(len(data_df), dtype=np.int8)
+    labels[positions < val_size] = 1
+    labels[positions < val_size * test_size] = 2
+    return labels
+
+
+def run_stages(write, ingest=None, overlap_ingestion=False):
+    """Runs the dataset writing and feature ingestion stages and logs their wall times.
+
+    With overlap_ingestion, ingest runs in a thread alongside write. Both stages only
+    read the data, and the job then takes as long as the slower of the two instead
+    of their sum. The thread is a daemon that is only joined once write succeeds, so
+    a failed write raises at once instead of waiting for the ingestion to finish.
     """
-    assert len(response.failed_rows) == 0
+    timings = {}
+    ingest_errors = []
+
+    def timed(name, stage):
+        start = time.perf_counter()
+        with report.stage(name):
+            stage()
+        timings[name] = time.perf_counter() - start
+
+    def timed_ingest():
+        try:
+            timed("ingest", ingest)
+        except BaseException as e:
+            ingest_errors.append(e)
+
+    start = time.perf_counter()
+    ingestion = None
+    if ingest and overlap_ingestion:
+        ingestion = threading.Thread(target=timed_ingest, daemon=True)
+        ingestion.start()
+    timed("write", write)
+    if ingestion:
+        ingestion.join()
+        if ingest_errors:
+            raise ingest_errors[0]
+    elif ingest:
+        timed("ingest", ingest)
+    timings["total"] = time.perf_counter() - start
+    logger.info(f"Stage timings in seconds: {timings}")
+    return timings
 
 
 def save_files(base_dir: str, data_df: pd.DataFrame, data_fg: pd.DataFrame, fg_name: str, 
-               val_size=0.2, test_size=0.05, current_host=None, sagemaker_session=None):
-        
+               val_size=0.2, test_size=0.05, current_host=None, boto_session=None, split_method="random",
+               output_options=None, ingest_options=None, overlap_ingestion=False):
+
     logger.info(f"Splitting {len(data_df)} rows of data into train, val, test.")
 
-    train_df, val_df = train_test_split(data_df, test_size=val_size, random_state=42)
-    val_df, test_df = train_test_split(val_df, test_size=test_size, random_state=42)
+    with report.stage("split", rows_in=len(data_df)) as stage:
+        if split_method == "hash":
+            labels = hash_split_labels(data_df, val_size, test_size)
+            train_df, val_df, test_df = (data_df[labels == label] for label in range(3))
+        else:
+            from sklearn.model_selection import train_test_split
 
-    logger.info(f"Writing out datasets to {base_dir}")
-    tmp_id = uuid.uuid4().hex[:8]
-    train_df.to_csv(f"{base_dir}/train/train_{current_host}_{tmp_id}.csv", header=False, index=False)
-    val_df.to_csv(f"{base_dir}/validation/validation_{current_host}_{tmp_id}.csv", header=False, index=False)
+            train_df, val_df = train_test_split(data_df, test_size=val_size, random_state=42)
+            val_df, test_df = train_test_split(val_df, test_size=test_size, random_state=42)
+        stage["rows_out"] = len(train_df) + len(val_df) + len(test_df)
 
-    # Save test data without header
-    test_df.to_csv(f"{base_dir}/test/test_{current_host}_{tmp_id}.csv", header=False, index=False)
+    def write():
+        logger.info(f"Writing out datasets to {base_dir}")
+        outputs = open_split_outputs(base_dir, current_host, **(output_options or {}))
+        with report.stage("write", rows_in=len(data_df)) as stage:
+            stage["rows_out"] = 0
+            for output, split_df in zip(outputs, [train_df, val_df, test_df]):
+                output.write(split_df)
+                output.close()
+                stage["rows_out"] += len(split_df)
 
-    
-    if fg_name:
+    def ingest():
         # batch ingestion to the feature group of all the data
-        ingest_data(data_fg, fg_name, sagemaker_session)
+        with report.stage("ingest", rows_in=len(data_fg)) as stage:
+            ingest_data(data_fg, fg_name, boto_session, ingest_options)
+            stage["rows_out"] = len(data_fg)
 
+    run_stages(write, ingest if fg_name else None, overlap_ingestion)
     return
 
+def spill_batches(batches, spill_file: str):
+    """Appends DataFrame batches to an Arrow IPC file and returns the number of rows written.
+
+    No file is created when every batch is empty.
+    """
+    num_rows = 0
+    writer = None
+    for df in batches:
+        if len(df) == 0:
+            continue
+        with report.stage("spill", rows_in=len(df)) as stage:
+            record_batch = pa.RecordBatch.from_pandas(df, preserve_index=False)
+            if writer is None:
+                writer = pa.ipc.new_file(spill_file, record_batch.schema)
+            writer.write_batch(record_batch)
+            num_rows += len(df)
+            stage["rows_out"] = len(df)
+    if writer is not None:
+        writer.close()
+    return num_rows
+
+
+def iter_spilled_batches(spill_files: list):
+    """Yields the batches of spill files in order, read from memory maps."""
+    for spill_file in spill_files:
+        if not os.path.exists(spill_file):
+            continue
+        with pa.memory_map(spill_file) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                yield reader.get_batch(i).to_pandas()
+
+
+def read_spilled(spill_files: list):
+    """Concatenates spill files into one DataFrame, copying the memory mapped data only once."""
+    tables = []
+    for spill_file in spill_files:
+        if os.path.exists(spill_file):
+            tables.append(pa.ipc.open_file(pa.memory_map(spill_file)).read_all())
+    if not tables:
+        raise Exception("No rows left after cleaning the input files")
+    return pa.concat_tables(tables).to_pandas()
+
+
+def append_split_batches(base_dir: str, batches, split_labels, current_host=None, output_options=None):
+    """Appends the rows of each batch to the train, validation and test files.
+
+    split_labels(data_df) returns the split label of every row of a batch, as in
+    hash_split_labels. Returns the number of rows written.
+    """
+    logger.info(f"Writing out datasets to {base_dir}")
+    outputs = open_split_outputs(base_dir, current_host, **(output_options or {}))
+    num_rows = 0
+    try:
+        for data_fg in batches:
+            data_df = data_fg[cols]
+            with report.stage("split", rows_in=len(data_df)) as stage:
+                labels = split_labels(data_df)
+                stage["rows_out"] = len(labels)
+            with report.stage("write", rows_in=len(data_df)) as stage:
+                for label, output in enumerate(outputs):
+                    output.write(data_df[labels == label])
+                stage["rows_out"] = len(data_df)
+            num_rows += len(data_df)
+    finally:
+        for output in outputs:
+            output.close()
+    return num_rows
+
+
+def save_spilled_files(base_dir: str, spill_files: list, num_rows: int,
+                       val_size=0.2, test_size=0.05, current_host=None, split_method="random",
+                       output_options=None):
+    """Splits and writes spilled batches without holding the dataset in memory.
+
+    With the random split method the same train/val/test split as save_files is
+    drawn over the row positions, and the only per-row state kept in memory is one
+    split label byte. Rows within each output file keep their input order instead of
+    the shuffled order save_files writes them in.
+    """
+    if num_rows == 0:
+        raise Exception("No rows left after cleaning the input files")
+
+    logger.info(f"Splitting {num_rows} rows of data into train, val, test.")
+    if split_method == "hash":
+        def split_labels(data_df):
+            return hash_split_labels(data_df, val_size, test_size)
+    else:
+        from sklearn.model_selection import train_test_split
+
+        train_idx, val_idx = train_test_split(np.arange(num_rows), test_size=val_size, random_state=42)
+        val_idx, test_idx = train_test_split(val_idx, test_size=test_size, random_state=42)
+        del train_idx
+        labels = np.zeros(num_rows, dtype=np.int8)
+        labels[val_idx] = 1
+        labels[test_idx] = 2
+        del val_idx, test_idx
+        offset = 0
+
+        def split_labels(data_df):
+            nonlocal offset
+            offset += len(data_df)
+            return labels[offset - len(data_df):offset]
+
+    append_split_batches(base_dir, iter_spilled_batches(spill_files), split_labels, current_host,
+                         output_options)
+
+
+def save_files_streaming(base_dir: str, batches, fg_name: str, spill_dir: str,
+                         val_size=0.2, test_size=0.05, current_host=None, boto_session=None,
+                         split_method="random", output_options=None, ingest_options=None):
+    """Ingests, splits and writes cleaned batches without holding the dataset in memory.
+
+    The hash split method writes each batch out as it arrives. Otherwise the batches
+    are spilled to an Arrow file in spill_dir while they are counted and then written
+    out by save_spilled_files. Batches are ingested in the background while the
+    following ones are produced, and the stage timings show how long ingestion ran
+    on after the last batch was written.
+    """
+    ingester = open_ingester(fg_name, boto_session, ingest_options) if fg_name else None
+    start = time.perf_counter()
+
+    def ingested(batches):
+        for data_fg in batches:
+            if ingester and len(data_fg) > 0:
+                # Counts the time producers are held back by a full ingestion queue
+                with report.stage("ingest", rows_in=len(data_fg)):
+                    ingester.submit(data_fg)
+            yield data_fg
+        if ingester:
+            timings = {"write": time.perf_counter() - start}
+            with report.stage("ingest") as stage:
+                stage["rows_out"] = ingester.close()["records"]
+            timings["ingest_drain"] = time.perf_counter() - start - timings["write"]
+            logger.info(f"Stage timings in seconds: {timings}")
+
+    if split_method == "hash":
+        num_rows = append_split_batches(
+            base_dir, ingested(batches), lambda data_df: hash_split_labels(data_df, val_size, test_size),
+            current_host, output_options,
+        )
+        if num_rows == 0:
+            raise Exception("No rows left after cleaning the input files")
+        logger.info(f"Split {num_rows} rows of data into train, val, test.")
+        return
+
+    spill_file = os.path.join(spill_dir, "cleaned.arrow")
+    num_rows = spill_batches(ingested(batches), spill_file)
+    save_spilled_files(base_dir, [spill_file], num_rows, val_size, test_size, current_host,
+                       output_options=output_options)
+
+
+# Zone matrix of a process pool worker, attached once by _init_worker
+_worker_zone_matrix = None
+
+
+def _init_worker(zone_matrix_file: str):
+    global _worker_zone_matrix
+    _worker_zone_matrix = load_zone_matrix(zone_matrix_file)
+
+
+def _process_row_group(task):
+    file, row_group, row_offset, batch_size, bounds, row_filter, current_time_sec, spill_file = task
+    batches = (
+        clean_data(enrich_data(batch_df, _worker_zone_matrix, current_time_sec), bounds)[1]
+        for batch_df in iter_row_group(file, row_group, row_offset, batch_size, row_filter)
+    )
+    return spill_batches(batches, spill_file)
+
+
+def process_parallel(file_list: list, zone_matrix: np.ndarray, spill_dir: str, num_workers: int,
+                     batch_size=None, current_time_sec=None, bounds=None, row_filter=None):
+    """Loads, enriches and cleans the input row groups in a pool of worker processes.
+
+    Every parquet row group is one task. Workers memory map the zone matrix, so one
+    read only copy is shared by all of them, and write their cleaned rows to their own
+    Arrow spill file. Returns the spill files, in input order, and their total row count.
+    """
+    if current_time_sec is None:
+        current_time_sec = int(round(time.time()))
+
+    zone_matrix_file = getattr(zone_matrix, "filename", None)
+    if zone_matrix_file is None:
+        # Place a built matrix in shared memory when available
+        shm_dir = "/dev/shm" if os.path.isdir("/dev/shm") else spill_dir
+        zone_matrix_file = os.path.join(shm_dir, f"zone_matrix_{uuid.uuid4().hex[:8]}.npy")
+        save_zone_matrix(zone_matrix, zone_matrix_file)
+
+    tasks = [
+        (file, row_group, row_offset, batch_size, bounds, row_filter, current_time_sec,
+         os.path.join(spill_dir, f"part_{i:05d}.arrow"))
+        for i, (file, row_group, row_offset) in enumerate(row_group_tasks(file_list, row_filter))
+    ]
+
+    logger.info(f"Processing {len(tasks)} row groups with {num_workers} workers")
+    try:
+        # The workers' own read, join, datetime and filter stages are not reported
+        with report.stage("process_parallel") as stage, concurrent.futures.ProcessPoolExecutor(
+            max_workers=num_workers, initializer=_init_worker, initargs=(zone_matrix_file,)
+        ) as executor:
+            num_rows = sum(executor.map(_process_row_group, tasks))
+            stage["rows_out"] = num_rows
+    finally:
+        if zone_matrix_file.startswith("/dev/shm/"):
+            os.remove(zone_matrix_file)
+    return [task[-1] for task in tasks], num_rows
+
+
 def _read_json(path):  # type: (str) -> dict
     """Read a JSON file.
     Args:
@@ -227,10 +1514,361 @@ def _read_json(path):  # type: (str) -> dict
     with open(path, "r") as f:
         return json.load(f)
 
+def file_sha256(path: str):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def zone_cache_key(zones_file: str):
+    """Names the cached zone matrix after the content hash of the zones file."""
+    return f"zone_matrix_v{zone_matrix_version}_{file_sha256(zones_file)}.npy"
+
+
+def _split_s3_uri(s3_uri: str):
+    bucket, _, prefix = s3_uri[len("s3://"):].partition("/")
+    return bucket, prefix
+
+
+def fetch_cached_zone_matrix(zone_cache: str, cache_key: str, zones_dir: str):
+    """Returns the local path of the cached zone matrix, or None on a cache miss."""
+    if not zone_cache.startswith("s3://"):
+        cached_file = os.path.join(zone_cache, cache_key)
+        return cached_file if os.path.exists(cached_file) else None
+
+    bucket, prefix = _split_s3_uri(zone_cache)
+    cached_file = os.path.join(zones_dir, cache_key)
+    try:
+        boto3.client("s3").download_file(bucket, os.path.join(prefix, cache_key), cached_file)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return None
+        raise
+    return cached_file
+
+
+def store_cached_zone_matrix(zone_matrix: np.ndarray, zone_cache: str, cache_key: str, zones_dir: str):
+    if not zone_cache.startswith("s3://"):
+        os.makedirs(zone_cache, exist_ok=True)
+        save_zone_matrix(zone_matrix, os.path.join(zone_cache, cache_key))
+        return
+
+    bucket, prefix = _split_s3_uri(zone_cache)
+    cached_file = os.path.join(zones_dir, cache_key)
+    save_zone_matrix(zone_matrix, cached_file)
+    logger.info(f"Uploading zone matrix to {zone_cache}")
+    boto3.client("s3").upload_file(cached_file, bucket, os.path.join(prefix, cache_key))
+
+
+def get_zone_matrix(zones_file: str, zone_cache=None):
+    """Loads the zone matrix for the zones file.
+
+    A zone_matrix.npy shipped next to the zones file wins. Otherwise the matrix is
+    looked up in zone_cache by the hash of the zones file, and only on a miss is the
+    zip extracted and the shapefile parsed, after which the cache is filled.
+    """
+    zones_dir = os.path.dirname(zones_file)
+    zone_matrix_file = os.path.join(zones_dir, zone_matrix_file_name)
+    if os.path.exists(zone_matrix_file):
+        return load_zone_matrix(zone_matrix_file)
+
+    if not os.path.exists(zones_file):
+        raise Exception(f"Zones file {zones_file} does not exist")
+
+    if zone_cache:
+        with report.stage("zone_cache"):
+            cache_key = zone_cache_key(zones_file)
+            cached_file = fetch_cached_zone_matrix(zone_cache, cache_key, zones_dir)
+        if cached_file:
+            return load_zone_matrix(cached_file)
+        logger.info(f"Zone matrix {cache_key} not found in {zone_cache}")
+
+    # Extract and load taxi zones geopandas dataframe
+    with report.stage("unzip"):
+        extract_zones(zones_file, zones_dir)
+    with report.stage("load_zones") as stage:
+        zone_df = load_zones(zones_dir)
+        stage["rows_out"] = len(zone_df)
+    with report.stage("zone_matrix", rows_in=len(zone_df)) as stage:
+        zone_matrix = build_zone_matrix(build_zone_lookup(zone_df))
+        stage["rows_out"] = len(zone_matrix)
+
+    if zone_cache:
+        store_cached_zone_matrix(zone_matrix, zone_cache, cache_key, zones_dir)
+    return zone_matrix
+
+
+def process_spilled(base_dir: str, input_file_list: list, zone_matrix: np.ndarray, fg_name: str,
+                    spill_dir: str, num_workers: int, stream_batch_size=None, current_host=None,
+                    boto_session=None, bounds=None, row_filter=None, split_method="random",
+                    output_options=None, ingest_options=None, overlap_ingestion=False):
+    """Runs the streaming and/or multi process modes, keeping intermediate data in spill_dir."""
+    current_time_sec = int(round(time.time()))
+    if num_workers <= 1:
+        # Load, enrich and clean one record batch at a time
+        logger.info(f"Streaming input files in batches of {stream_batch_size} rows")
+        batches = (
+            clean_data(enrich_data(batch_df, zone_matrix, current_time_sec), bounds)[1]
+            for batch_df in iter_data(input_file_list, stream_batch_size, row_filter)
+        )
+        return save_files_streaming(base_dir, batches, fg_name, spill_dir, current_host=current_host,
+                                    boto_session=boto_session, split_method=split_method,
+                                    output_options=output_options, ingest_options=ingest_options)
+
+    spill_files, num_rows = process_parallel(input_file_list, zone_matrix, spill_dir, num_workers,
+                                             stream_batch_size, current_time_sec, bounds, row_filter)
+    if stream_batch_size:
+        def write():
+            save_spilled_files(base_dir, spill_files, num_rows, current_host=current_host,
+                               split_method=split_method, output_options=output_options)
+
+        def ingest():
+            ingester = open_ingester(fg_name, boto_session, ingest_options)
+            with report.stage("ingest", rows_in=num_rows) as stage:
+                for data_fg in iter_spilled_batches(spill_files):
+                    ingester.submit(data_fg)
+                stage["rows_out"] = ingester.close()["records"]
+
+        run_stages(write, ingest if fg_name else None, overlap_ingestion)
+        return
+
+    data_fg = read_spilled(spill_files)
+    return save_files(base_dir, data_fg[cols], data_fg, fg_name, current_host=current_host,
+                      boto_session=boto_session, split_method=split_method,
+                      output_options=output_options, ingest_options=ingest_options,
+                      overlap_ingestion=overlap_ingestion)
+
+
+checkpoint_version = 1
+
+
+def checkpoint_key(*parts):
+    sha256 = hashlib.sha256()
+    for part in parts:
+        sha256.update(str(part).encode())
+        sha256.update(b"\0")
+    return sha256.hexdigest()[:16]
+
+
+def write_checkpoint(df: pd.DataFrame, checkpoint_dir: str, stage: str, key: str):
+    """Writes df as the Arrow IPC checkpoint of stage, replacing the stage's older checkpoints."""
+    checkpoint_file = os.path.join(checkpoint_dir, f"{stage}_{key}.arrow")
+    with report.stage("checkpoint", rows_in=len(df)):
+        try:
+            table = pa.Table.from_pandas(df)
+        except pa.ArrowException as e:
+            logger.warning(f"Not checkpointing {stage} rows: {e}")
+            return
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        # Write to a temporary file first so an interrupted run never leaves a partial checkpoint
+        tmp_file = f"{checkpoint_file}.{uuid.uuid4().hex[:8]}.tmp"
+        with pa.OSFile(tmp_file, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        os.replace(tmp_file, checkpoint_file)
+    for old_file in glob.glob(os.path.join(checkpoint_dir, f"{stage}_*.arrow")):
+        if old_file != checkpoint_file:
+            os.remove(old_file)
+    logger.info(f"Wrote {stage} checkpoint {checkpoint_file}")
+
+
+def read_checkpoint(checkpoint_dir: str, stage: str, key: str):
+    """Opens the checkpoint of stage memory mapped, or returns None if there is no valid one.
+
+    Numeric columns of the returned DataFrame are read only views of the memory map.
+    """
+    checkpoint_file = os.path.join(checkpoint_dir, f"{stage}_{key}.arrow")
+    if not os.path.exists(checkpoint_file):
+        return None
+    with report.stage("checkpoint") as stage_report:
+        try:
+            table = pa.ipc.open_file(pa.memory_map(checkpoint_file)).read_all()
+        except (OSError, pa.ArrowException) as e:
+            logger.warning(f"Ignoring unreadable checkpoint {checkpoint_file}: {e}")
+            return None
+        df = table.to_pandas(split_blocks=True)
+        stage_report["rows_out"] = len(df)
+    logger.info(f"Resuming from {stage} checkpoint {checkpoint_file}")
+    return df
+
+
+def load_enriched(input_file_list: list, zone_matrix: np.ndarray, checkpoint_dir: str, row_filter=None):
+    """Returns enrich_data(load_data(...)), resuming from the checkpoints in checkpoint_dir.
+
+    The loaded checkpoint is keyed on the content of the input files, their order,
+    the pushed down filter and this script, and the enriched checkpoint on those and
+    the zone matrix as well. A rerun that only changes the outlier bounds, split or
+    output options therefore starts from the enriched rows, with this run's FS_time.
+    """
+    code_version = file_sha256(os.path.abspath(__file__))
+    inputs = [(os.path.basename(file), file_sha256(file)) for file in input_file_list]
+    loaded_key = checkpoint_key(checkpoint_version, code_version, inputs, row_filter)
+    zones_digest = hashlib.sha256(np.ascontiguousarray(zone_matrix).tobytes()).hexdigest()
+    enriched_key = checkpoint_key(loaded_key, zones_digest)
+
+    data_df = read_checkpoint(checkpoint_dir, "enriched", enriched_key)
+    if data_df is not None:
+        # Features are ingested with the event time of this run
+        data_df["FS_time"] = pd.Categorical.from_codes(
+            np.zeros(len(data_df), dtype=np.int8), categories=[float(int(round(time.time())))]
+        )
+        return data_df
+
+    data_df = read_checkpoint(checkpoint_dir, "loaded", loaded_key)
+    if data_df is None:
+        data_df = load_data(input_file_list, row_filter)
+        write_checkpoint(data_df, checkpoint_dir, "loaded", loaded_key)
+    data_df = enrich_data(data_df, zone_matrix)
+    write_checkpoint(data_df, checkpoint_dir, "enriched", enriched_key)
+    return data_df
+
+
+def _sql_string(value: str):
+    return "'" + value.replace("'", "''") + "'"
+
+
+def duckdb_zone_pairs(zone_matrix: np.ndarray):
+    """The zone matrix as a table with one row per pickup and drop off position pair."""
+    size = len(zone_matrix)
+    pairs = pd.DataFrame({name: np.asarray(zone_matrix[name]).ravel() for name in zone_matrix_dtype.names})
+    pairs.insert(0, "pickup_position", np.repeat(np.arange(size), size))
+    pairs.insert(1, "dropoff_position", np.tile(np.arange(size), size))
+    return pairs
+
+
+def duckdb_query(file_list: list, sentinel: int, bounds: dict):
+    """SQL doing what load_data, enrich_data and clean_data do to the input files.
+
+    Rows keep their position in the concatenated input, which FS_ID is derived from,
+    and come out in that order. Values are computed in the dtypes the pandas engine
+    compares them in, so the same rows pass the outlier bounds. Like fillna(0) in
+    load_data, missing values become 0 and missing timestamps 1970-01-01.
+    DuckDB orders NaN above every number, so rows of unknown zones are dropped
+    explicitly, as dropna does.
+    """
+    offsets = []
+    row_offset = 0
+    for file in file_list:
+        offsets.append(f"WHEN {_sql_string(file)} THEN {row_offset}")
+        row_offset += pq.ParquetFile(file).metadata.num_rows
+    columns = {column: f'"{source}"' for column, source in source_columns(pq.read_schema(file_list[0]).names).items()}
+
+    def position(column):
+        return (f"CASE WHEN {column} >= 0 AND {column} < {sentinel} "
+                f"THEN CAST(trunc({column}) AS BIGINT) ELSE {sentinel} END")
+
+    def timestamp(column):
+        return f"epoch_ns(coalesce(CAST({column} AS TIMESTAMP), TIMESTAMP '1970-01-01'))"
+
+    conditions = []
+    for column, (lower, upper) in bounds.items():
+        if lower is not None:
+            conditions.append(f"{column} > {lower}")
+        if upper is not None:
+            conditions.append(f"{column} < {upper}")
+    conditions += [f"NOT isnan({name})" for name in zone_matrix_dtype.names]
+
+    # Floor division and modulo, which DuckDB truncates towards zero for negative durations
+    return f"""
+    WITH trips AS (
+        SELECT
+            CASE filename {" ".join(offsets)} END + file_row_number AS position,
+            CAST(coalesce({columns["fare_amount"]}, 0) AS FLOAT) AS fare_amount,
+            CAST(trunc(coalesce({columns["passenger_count"]}, 0)) AS BIGINT) AS passenger_count,
+            {position(f"coalesce({columns['PULocationID']}, 0)")} AS pickup_position,
+            {position(f"coalesce({columns['DOLocationID']}, 0)")} AS dropoff_position,
+            make_timestamp_ns({timestamp(columns["lpep_pickup_datetime"])}) AS pickup,
+            {timestamp(columns["lpep_dropoff_datetime"])} - {timestamp(columns["lpep_pickup_datetime"])} AS duration_ns
+        FROM read_parquet(
+            [{", ".join(_sql_string(file) for file in file_list)}],
+            filename = true, file_row_number = true, union_by_name = true, hive_partitioning = false
+        )
+    ),
+    enriched AS (
+        SELECT
+            position, fare_amount, passenger_count,
+            {", ".join(f"zone_pairs.{name}" for name in zone_matrix_dtype.names)},
+            hour(pickup) AS hour,
+            isodow(pickup) - 1 AS weekday,
+            month(pickup) AS month,
+            CAST(((duration_ns - (duration_ns % 1000000000 + 1000000000) % 1000000000) // 1000000000
+                  % 86400 + 86400) % 86400 / 60 AS FLOAT) AS duration_minutes
+        FROM trips JOIN zone_pairs USING (pickup_position, dropoff_position)
+    )
+    SELECT position, {", ".join(cols)}
+    FROM enriched
+    WHERE {" AND ".join(conditions)}
+    ORDER BY position
+    """
+
+
+def iter_duckdb(file_list: list, zone_matrix: np.ndarray, spill_dir: str, batch_size=None, bounds=None,
+                current_time_sec=None, memory_limit=None):
+    """Yields the cleaned feature group rows of the input files, queried with DuckDB.
+
+    The batches hold the rows and dtypes clean_data(enrich_data(load_data(...)))[1]
+    would return, in input order. DuckDB runs the query on every core and spills
+    to spill_dir when it needs more than memory_limit.
+    """
+    duckdb = require("duckdb", "duckdb")
+    if current_time_sec is None:
+        current_time_sec = int(round(time.time()))
+
+    con = duckdb.connect(config={"temp_directory": spill_dir, "preserve_insertion_order": True})
+    if memory_limit:
+        con.execute(f"SET memory_limit = {_sql_string(memory_limit)}")
+    con.register("zone_pairs", duckdb_zone_pairs(zone_matrix))
+    try:
+        reader = con.execute(
+            duckdb_query(file_list, len(zone_matrix) - 1, bounds or outlier_bounds)
+        ).fetch_record_batch(batch_size or 1000000)
+        while True:
+            with report.stage("duckdb") as stage:
+                batch = next(reader, None)
+                if batch is None:
+                    return
+                df = batch.to_pandas()
+                df.index = pd.Index(df.pop("position"))
+                df["FS_ID"] = df.index + 1000
+                df["FS_time"] = pd.Categorical.from_codes(
+                    np.zeros(len(df), dtype=np.int8), categories=[float(current_time_sec)]
+                )
+                df = compact_dtypes(df)[cols_fg]
+                stage["rows_out"] = len(df)
+            yield df
+    finally:
+        con.close()
+
+
+def process_duckdb(base_dir: str, input_file_list: list, zone_matrix: np.ndarray, fg_name: str,
+                   spill_dir: str, stream_batch_size=None, current_host=None, boto_session=None,
+                   bounds=None, split_method="random", output_options=None, ingest_options=None,
+                   memory_limit=None):
+    """Runs the duckdb engine, writing its batches like the streaming mode does.
+
+    With the hash split method the outputs are byte for byte those of the pandas
+    engine. The random split method puts the same rows in each split, in input order
+    as in the streaming mode.
+    """
+    logger.info(f"Querying {len(input_file_list)} input files with DuckDB")
+    batches = iter_duckdb(input_file_list, zone_matrix, spill_dir, stream_batch_size, bounds,
+                          memory_limit=memory_limit)
+    return save_files_streaming(base_dir, batches, fg_name, spill_dir, current_host=current_host,
+                                boto_session=boto_session, split_method=split_method,
+                                output_options=output_options, ingest_options=ingest_options)
+
+
 def main(base_dir: str, args: argparse.Namespace):
+    num_workers = args.num_workers or n_cores
+    in_memory = not (args.input_enriched or args.engine == "duckdb" or args.stream_batch_size or num_workers > 1)
+    if args.checkpoint_dir and not in_memory:
+        raise Exception("--checkpoint_dir only checkpoints the in-memory mode, so it cannot be combined with "
+                        "--input_enriched, --stream_batch_size, --engine duckdb or --num_workers other than 1")
+
     # Input data files
     input_dir = os.path.join(base_dir, "input/data")
-    input_file_list = glob.glob(f"{input_dir}/*.parquet")
+    input_file_list = input_files(input_dir, args.input_partitions)
     logger.info(f"Input file list: {input_file_list}")
     
     if len(input_file_list) == 0:
@@ -246,28 +1884,134 @@ def main(base_dir: str, args: argparse.Namespace):
     # Input zones file
     zones_dir = os.path.join(base_dir, "input/zones")
     zones_file = os.path.join(zones_dir, "taxi_zones.zip")
-    if not os.path.exists(zones_file):
-        raise Exception(f"Zones file {zones_file} does not exist")
 
-    # Extract and load taxi zones geopandas dataframe
-    extract_zones(zones_file, zones_dir)
-    zone_df = load_zones(zones_dir)
+    # Input enriched by the Glue ETL job already has its zone features
+    zone_matrix = None if args.input_enriched else get_zone_matrix(zones_file, args.zone_cache)
 
-    # Load input files
-    data_df = load_data(input_file_list)
-    data_df = enrich_data(data_df, zone_df)
-    data_df, data_fg = clean_data(data_df)
-    
     fg_name = args.ingest_featuregroup_name
     
-    sagemaker_session = get_session(args.region, args.bucket)
+    boto_session = get_session(args.region) if fg_name else None
+
+    bounds = get_outlier_bounds(args.outlier_bounds)
+    row_filter = None
+    if args.pushdown_filters:
+        row_filter = pushdown_filter(bounds, ds.dataset(input_file_list, format="parquet").schema)
+        logger.info("Pushing the fare_amount, passenger_count and duration_minutes bounds into the parquet scan")
+
+    output_options = {
+        "output_format": args.output_format,
+        "compression": args.parquet_compression,
+        "num_shards": host_shards(args.num_shards, hosts["hosts"], current_host),
+        "shard_bytes": args.shard_bytes,
+    }
+    ingest_options = {
+        "num_workers": args.ingest_workers,
+        "queue_rows": args.ingest_queue_rows,
+        "max_attempts": args.ingest_max_attempts,
+        "mode": args.ingest_mode,
+        "offline_store_uri": args.offline_store_uri,
+    }
+    if args.input_enriched:
+        if args.stream_batch_size:
+            spill_dir = os.path.join(base_dir, f"spill_{uuid.uuid4().hex[:8]}")
+            os.makedirs(spill_dir)
+            try:
+                return save_files_streaming(base_dir, iter_cleaned(input_file_list, args.stream_batch_size), fg_name,
+                                            spill_dir, current_host=current_host,
+                                            boto_session=boto_session, split_method=args.split_method,
+                                            output_options=output_options, ingest_options=ingest_options)
+            finally:
+                shutil.rmtree(spill_dir, ignore_errors=True)
+        data_df, data_fg = load_cleaned(input_file_list)
+        return save_files(base_dir, data_df, data_fg, fg_name, current_host=current_host,
+                          boto_session=boto_session, split_method=args.split_method,
+                          output_options=output_options, ingest_options=ingest_options,
+                          overlap_ingestion=args.overlap_ingestion)
+
+    if args.engine == "duckdb" or args.stream_batch_size or num_workers > 1:
+        spill_dir = os.path.join(base_dir, f"spill_{uuid.uuid4().hex[:8]}")
+        os.makedirs(spill_dir)
+        try:
+            if args.engine == "duckdb":
+                return process_duckdb(base_dir, input_file_list, zone_matrix, fg_name, spill_dir,
+                                      args.stream_batch_size, current_host, boto_session, bounds,
+                                      args.split_method, output_options, ingest_options, args.duckdb_memory_limit)
+            return process_spilled(base_dir, input_file_list, zone_matrix, fg_name, spill_dir, num_workers,
+                                   args.stream_batch_size, current_host, boto_session, bounds, row_filter,
+                                   args.split_method, output_options, ingest_options, args.overlap_ingestion)
+        finally:
+            shutil.rmtree(spill_dir, ignore_errors=True)
+
+    # Load input files
+    if args.checkpoint_dir:
+        data_df = load_enriched(input_file_list, zone_matrix, args.checkpoint_dir, row_filter)
+    else:
+        data_df = load_data(input_file_list, row_filter)
+        data_df = enrich_data(data_df, zone_matrix)
+    data_df, data_fg = clean_data(data_df, bounds)
     
-    return save_files(base_dir, data_df, data_fg, fg_name, current_host=current_host, sagemaker_session=sagemaker_session)
+    return save_files(base_dir, data_df, data_fg, fg_name, current_host=current_host,
+                      boto_session=boto_session, split_method=args.split_method,
+                      output_options=output_options, ingest_options=ingest_options,
+                      overlap_ingestion=args.overlap_ingestion)
+
+
+@contextlib.contextmanager
+def instrumented(report_dir: str, current_host=None, profile=None, run_args=None):
+    """Writes the stage report of the enclosed run, and its profile if requested, to report_dir.
+
+    The files are written even when the run fails, as report_{current_host}.json and
+    profile_{current_host}.prof/.txt for cProfile or profile_{current_host}.html for
+    pyinstrument.
+    """
+    profiler = None
+    if profile == "cprofile":
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif profile == "pyinstrument":
+        profiler = require("pyinstrument", "pyinstrument").Profiler()
+        profiler.start()
+    try:
+        yield report
+    finally:
+        os.makedirs(report_dir, exist_ok=True)
+        if profile == "cprofile":
+            import pstats
+
+            profiler.disable()
+            profiler.dump_stats(os.path.join(report_dir, f"profile_{current_host}.prof"))
+            with open(os.path.join(report_dir, f"profile_{current_host}.txt"), "w") as f:
+                pstats.Stats(profiler, stream=f).sort_stats("cumulative").print_stats(50)
+        elif profile == "pyinstrument":
+            profiler.stop()
+            with open(os.path.join(report_dir, f"profile_{current_host}.html"), "w") as f:
+                f.write(profiler.output_html())
+        run_report = dict(host=current_host, args=run_args, **report.to_dict())
+        report_file = os.path.join(report_dir, f"report_{current_host}.json")
+        with open(report_file, "w") as f:
+            json.dump(run_report, f, indent=2)
+        logger.info(f"Wrote stage report to {report_file}")
 
 
 if __name__ == "__main__":
     logger.info("Starting preprocessing.")
     args = parse_args()
-    base_dir = args.base_dir
-    main(base_dir, args)
+    if args.wheelhouse:
+        # pip reads these for every install, so missing packages never reach out to PyPI
+        os.environ["PIP_NO_INDEX"] = "1"
+        os.environ["PIP_FIND_LINKS"] = args.wheelhouse
+    if args.build_zone_matrix:
+        zones_dir = os.path.dirname(os.path.abspath(args.build_zone_matrix))
+        extract_zones(args.build_zone_matrix, zones_dir)
+        zone_lookup = build_zone_lookup(load_zones(zones_dir))
+        save_zone_matrix(build_zone_matrix(zone_lookup), os.path.join(zones_dir, zone_matrix_file_name))
+        save_zone_centroids(zone_lookup, os.path.join(zones_dir, zone_centroids_file_name))
+    else:
+        base_dir = args.base_dir
+        current_host = _read_json("/opt/ml/config/resourceconfig.json")["current_host"]
+        with instrumented(args.report_dir or os.path.join(base_dir, "report"), current_host, args.profile,
+                          vars(args)):
+            main(base_dir, args)
     logger.info("Done")
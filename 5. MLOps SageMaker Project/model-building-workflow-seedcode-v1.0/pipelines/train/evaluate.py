@@ -1,8 +1,11 @@
 """Evaluation script for measuring mean squared error."""
 import json
 import logging
+import os
 import pathlib
 import pickle
+import subprocess
+import sys
 import tarfile
 
 import numpy as np
@@ -17,10 +20,63 @@ logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 logger.addHandler(logging.StreamHandler())
 
+
+def read_csv(files):
+    df = pd.concat([pd.read_csv(f, index_col=None, header=None) for f in files], axis=0, ignore_index=True)
+    return df.iloc[:, 0].values, df.iloc[:, 1:].values
+
+
+def read_parquet(files):
+    df = pd.concat([pd.read_parquet(f) for f in files], axis=0, ignore_index=True)
+    return df.iloc[:, 0].values, df.iloc[:, 1:].values
+
+
+def read_libsvm(files):
+    from scipy.sparse import vstack
+    from sklearn.datasets import load_svmlight_files
+
+    # The preprocess script writes zero based indices and every feature of every row
+    loaded = load_svmlight_files(files, zero_based=True)
+    return np.concatenate(loaded[1::2]), vstack(loaded[0::2]).toarray()
+
+
+def read_recordio_protobuf(files):
+    try:
+        from sagemaker.amazon.common import read_records
+    except ImportError:
+        subprocess.check_call([sys.executable, "-m", "pip", "install", "sagemaker"])
+        from sagemaker.amazon.common import read_records
+
+    labels, features = [], []
+    for filename in files:
+        with open(filename, "rb") as f:
+            for record in read_records(f):
+                labels.append(record.label["values"].float32_tensor.values[0])
+                features.append(record.features["values"].float32_tensor.values)
+    return np.array(labels), np.array(features)
+
+
+# Reader of each file extension the preprocess script can write
+readers = {
+    ".csv": read_csv,
+    ".parquet": read_parquet,
+    ".libsvm": read_libsvm,
+    ".recordio": read_recordio_protobuf,
+}
+
+
+def read_test_data(test_path):
+    """Reads the test labels and features in whichever format the preprocess script wrote them."""
+    for extension, reader in readers.items():
+        files = sorted(glob.glob(os.path.join(test_path, f"*{extension}")))
+        if files:
+            logger.info("Reading %d %s test files.", len(files), extension)
+            return reader(files)
+    raise Exception(f"No test files found in {test_path}")
+
 if __name__ == "__main__":
     logger.debug("Starting evaluation.")
     
-    import os
     for file in os.listdir("/opt/ml/processing/model"):
         logger.info(file)
         
@@ -36,18 +92,8 @@ if __name__ == "__main__":
 
     logger.debug("Reading test data.")
     test_path = "/opt/ml/processing/test/"
-    all_files = glob.glob(test_path + "/*.csv")
-    tmp = []
-    for filename in all_files:
-        df_tmp = pd.read_csv(filename, index_col=None, header=None)
-        tmp.append(df_tmp)
-
-    df = pd.concat(tmp, axis=0, ignore_index=True)
-
-    logger.debug("Reading test data.")
-    y_test = df.iloc[:, 0].values
-    df.drop(df.columns[0], axis=1, inplace=True)
-    X_test = xgboost.DMatrix(df.values)
+    y_test, features = read_test_data(test_path)
+    X_test = xgboost.DMatrix(features)
 
     logger.info("Performing predictions against test data.")
     predictions = model.predict(X_test)
@@ -46,6 +46,14 @@ from sagemaker.workflow.step_collections import RegisterModel
 
 BASE_DIR = os.path.dirname(os.path.realpath(__file__))
 
+# Training content type of each output format of the preprocess pipeline
+CONTENT_TYPES = {
+    "csv": "text/csv",
+    "parquet": "application/x-parquet",
+    "libsvm": "text/libsvm",
+    "recordio-protobuf": "application/x-recordio-protobuf",
+}
+
 def get_sagemaker_client(region):
     """Gets the sagemaker client.
 
@@ -104,6 +112,7 @@ def get_pipeline(
     model_package_group_name="DYCTaxiPackageGroup",
     pipeline_name="DYCTrainPipeline",
     base_job_prefix="DYCTaxiTrain",
+    data_format="csv",
 ):
     """Gets a SageMaker ML Pipeline instance working with on abalone data.
 
@@ -111,6 +120,9 @@ def get_pipeline(
         region: AWS region to create and run the pipeline.
         role: IAM role to create and run steps and pipeline.
         default_bucket: the bucket to use for storing the artifacts
+        data_format: format the preprocess pipeline wrote the train/validation/test
+            files in, one of csv, parquet, libsvm or recordio-protobuf. Its content type
+            is the default of the DataContentType parameter, which each execution can set
 
     Returns:
         an instance of a pipeline
@@ -129,6 +141,11 @@ def get_pipeline(
     model_approval_status = ParameterString(
         name="ModelApprovalStatus", default_value="PendingManualApproval"
     )
+    # content type of the train/validation files, the one of CONTENT_TYPES matching the
+    # --output_format of the preprocess run, e.g. application/x-parquet for parquet
+    data_content_type = ParameterString(
+        name="DataContentType", default_value=CONTENT_TYPES[data_format]
+    )
 
 
     # training step for generating model artifacts
@@ -167,11 +184,11 @@ def get_pipeline(
         inputs={
             "train": TrainingInput(
                 s3_data=f"s3://{default_bucket}/{base_job_prefix}/input/train/",
-                content_type="text/csv",
+                content_type=data_content_type,
             ),
             "validation": TrainingInput(
                 s3_data=f"s3://{default_bucket}/{base_job_prefix}/input/validation/",
-                content_type="text/csv",
+                content_type=data_content_type,
             ),
         },
     )
@@ -256,6 +273,7 @@ def get_pipeline(
             processing_instance_type,
             training_instance_type,
             model_approval_status,
+            data_content_type,
         ],
         steps=[step_train, step_eval, step_cond],
         sagemaker_session=sagemaker_session,
@@ -86,6 +86,8 @@ def get_pipeline(
     default_bucket=None,
     pipeline_name="preprocess",
     base_job_prefix="NYCTaxipreprocess",
+    data_format="csv",
+    wheelhouse_uri=None,
 ):
     """Gets a SageMaker ML Pipeline instance working with on NYC Taxi data.
 
@@ -93,6 +95,12 @@ def get_pipeline(
         region: AWS region to create and run the pipeline.
         role: IAM role to create and run steps and pipeline.
         default_bucket: the bucket to use for storing the artifacts
+        data_format: format of the train/validation/test files, one of csv, parquet,
+            libsvm or recordio-protobuf. The DataContentType parameter of the train
+            pipeline takes the matching content type.
+        wheelhouse_uri: S3 prefix of wheels, e.g. built with `pip download geopandas==0.9.0
+            --platform manylinux2014_x86_64 --python-version 3.7 --only-binary=:all: -d wheelhouse`,
+            that the processing job installs missing packages from instead of PyPI
 
     Returns:
         an instance of a pipeline
@@ -117,6 +125,17 @@ def get_pipeline(
         name="InputZonesUrl",
         default_value = f"s3://sagemaker-{region}-{account_id}/sagemaker/DEMO-xgboost-tripfare/input/zones/taxi_zones.zip",
     )
+    # zone matrices derived from the zones file, reused by every run with the same file
+    zone_cache = ParameterString(
+        name="ZoneCacheUrl",
+        default_value=f"s3://{default_bucket}/{base_job_prefix}/zone-cache/",
+    )
+    # manifest of the processed input files, e.g. s3://<bucket>/<prefix>/manifest/, so runs only
+    # process new or changed files; empty, the default, processes all of InputDataUrl
+    manifest = ParameterString(name="ManifestUrl", default_value="")
+    # "random" draws the train/validation/test split, "hash" assigns each row from a hash of its
+    # values, the same on any instance count and run
+    split_method = ParameterString(name="SplitMethod", default_value="random")
 
     # processing step for feature engineering
     sklearn_processor = SKLearnProcessor(
@@ -127,6 +146,14 @@ def get_pipeline(
         sagemaker_session=sagemaker_session,
         role=role,
     )
+    wheelhouse_inputs, wheelhouse_arguments = [], []
+    if wheelhouse_uri:
+        wheelhouse_inputs.append(ProcessingInput(
+            source=wheelhouse_uri,
+            destination="/opt/ml/processing/input/wheelhouse",
+            s3_data_distribution_type="FullyReplicated",
+        ))
+        wheelhouse_arguments = ["--wheelhouse", "/opt/ml/processing/input/wheelhouse"]
     step_process = ProcessingStep(
         name="PreprocessNYCTaxiData",
         processor=sklearn_processor,
@@ -141,7 +168,7 @@ def get_pipeline(
                 destination="/opt/ml/processing/input/zones",
                 s3_data_distribution_type="FullyReplicated",
             ),
-        ],
+        ] + wheelhouse_inputs,
         outputs=[
             ProcessingOutput(output_name="train", 
                              source="/opt/ml/processing/train", 
@@ -155,9 +182,20 @@ def get_pipeline(
                              source="/opt/ml/processing/test",
                              destination=f"s3://{default_bucket}/{base_job_prefix}/input/test/"
                             ),
+            # Per stage wall time, CPU time, peak memory and row counts of the run
+            ProcessingOutput(output_name="report",
+                             source="/opt/ml/processing/report",
+                             destination=f"s3://{default_bucket}/{base_job_prefix}/report/"
+                            ),
         ],
         code=os.path.join(BASE_DIR, "preprocess.py"),
-#         job_arguments=["--input-data", input_data],
+        job_arguments=[
+            "--zone_cache", zone_cache,
+            "--split_method", split_method,
+            "--output_format", data_format,
+            "--manifest", manifest,
+            "--output_uri", f"s3://{default_bucket}/{base_job_prefix}/input/",
+        ] + wheelhouse_arguments,
     )
 
     # pipeline instance
@@ -167,7 +205,10 @@ def get_pipeline(
             processing_instance_type,
             processing_instance_count,
             input_data,
-            input_zones
+            input_zones,
+            zone_cache,
+            manifest,
+            split_method,
         ],
         steps=[step_process],
         sagemaker_session=sagemaker_session,
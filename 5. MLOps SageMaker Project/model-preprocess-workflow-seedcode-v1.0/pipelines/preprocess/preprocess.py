@@ -1,10 +1,10 @@
 """Feature engineers the NYC taxi dataset."""
 import glob
+import importlib
 import logging
 import os
 import subprocess
 import sys
-subprocess.check_call([sys.executable, '-m', 'pip', 'install', 'sagemaker'])
 
 from zipfile import ZipFile
 # from time import gmtime, strftime
@@ -14,26 +14,180 @@ import json
 import time
 import argparse
 import boto3
+import contextlib
+import hashlib
+import resource
+import threading
 import uuid
+from botocore.exceptions import ClientError
 
-
-# Install geopandas dependency before including pandas
-subprocess.check_call([sys.executable, "-m", "pip", "install", "geopandas==0.9.0"])
-
-import pandas as pd  # noqa: E402
-import geopandas as gpd  # noqa: E402
-from sklearn.model_selection import train_test_split  # noqa: E402
-
-import sagemaker
+import numpy as np
+import pandas as pd
 
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 logger.addHandler(logging.StreamHandler())
 
+
+def _cpu_seconds():
+    """CPU time of this process and its waited for children, e.g. pip installs."""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def _peak_rss_mb():
+    """Peak resident set size in MiB since the last _reset_peak_rss()."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _reset_peak_rss():
+    """Resets the kernel's peak RSS of this process to its current RSS, where Linux allows it."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+class StageReport:
+    """Collects the wall time, CPU time, peak RSS and rows in/out of named stages.
+
+    A stage entered more than once, e.g. once per streamed batch, is reported once with
+    its totals. Peak RSS is reset on entering each stage, so it is the stage's own peak
+    where /proc/self/clear_refs is writable and the process peak so far elsewhere. CPU
+    time is process wide, so stages running in parallel threads each count it all.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = _cpu_seconds()
+
+    def _open_stages(self):
+        if not hasattr(self.local, "open_stages"):
+            self.local.open_stages = []
+        return self.local.open_stages
+
+    def _fold_peak(self, open_stages):
+        peak = _peak_rss_mb()
+        for stage in open_stages:
+            stage["peak_rss_mb"] = max(stage["peak_rss_mb"], peak)
+        _reset_peak_rss()
+
+    @contextlib.contextmanager
+    def stage(self, name: str, rows_in=None):
+        """Measures the enclosed block as stage name. Set rows_out on the yielded dict.
+
+        A stage nested in a stage of the same name is timed by the outer one only, and
+        adds its rows to it.
+        """
+        open_stages = self._open_stages()
+        outer = next((stage for stage in open_stages if stage["name"] == name), None)
+        if outer is not None:
+            nested = {"rows_in": rows_in, "rows_out": None}
+            try:
+                yield nested
+            finally:
+                for key in ["rows_in", "rows_out"]:
+                    if nested[key] is not None:
+                        outer[key] = (outer[key] or 0) + int(nested[key])
+            return
+        current = {"name": name, "rows_in": rows_in, "rows_out": None, "peak_rss_mb": 0.0}
+        self._fold_peak(open_stages)
+        open_stages.append(current)
+        start_wall, start_cpu = time.perf_counter(), _cpu_seconds()
+        try:
+            yield current
+        finally:
+            wall, cpu = time.perf_counter() - start_wall, _cpu_seconds() - start_cpu
+            self._fold_peak(open_stages)
+            open_stages.pop()
+            with self.lock:
+                totals = self.stages.setdefault(name, {
+                    "calls": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0, "peak_rss_mb": 0.0,
+                    "rows_in": None, "rows_out": None,
+                })
+                totals["calls"] += 1
+                totals["wall_seconds"] += wall
+                totals["cpu_seconds"] += cpu
+                totals["peak_rss_mb"] = max(totals["peak_rss_mb"], current["peak_rss_mb"])
+                for key in ["rows_in", "rows_out"]:
+                    if current[key] is not None:
+                        totals[key] = (totals[key] or 0) + int(current[key])
+
+    def to_dict(self):
+        with self.lock:
+            stages = [dict(stage=name, **totals) for name, totals in self.stages.items()]
+        return {
+            "wall_seconds": time.perf_counter() - self.start_wall,
+            "cpu_seconds": _cpu_seconds() - self.start_cpu,
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "stages": stages,
+        }
+
+
+# Stage measurements of this run, written out by instrumented()
+report = StageReport()
+
+
+def require(module_name: str, requirement: str):
+    """Imports module_name, installing requirement with pip only if the image lacks it.
+
+    Prebuilt processing images that ship the package never run pip. With --wheelhouse,
+    missing packages are installed offline from a directory of vendored wheels, e.g.
+    one built with `pip download geopandas==0.9.0 -d wheelhouse`.
+    """
+    try:
+        return importlib.import_module(module_name)
+    except ImportError:
+        logger.info(f"Installing {requirement}")
+        subprocess.check_call([sys.executable, "-m", "pip", "install", requirement])
+        importlib.invalidate_caches()
+        return importlib.import_module(module_name)
+
+
 def parse_args() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument('--base_dir', type=str, default="/opt/ml/processing")
+    # Directory of vendored wheels to install missing packages from without network access
+    parser.add_argument('--wheelhouse', type=str, default=None)
+    # Local directory or s3:// prefix caching zone matrices by the hash of taxi_zones.zip
+    parser.add_argument('--zone_cache', type=str, default=None)
+    # Build the zone pair matrix next to the given taxi_zones.zip and exit
+    parser.add_argument('--build_zone_matrix', type=str, default=None)
+    # How rows are split into train/validation/test: "random" draws the split with train_test_split,
+    # "hash" assigns each row from a hash of its values, consistently across batches and hosts
+    parser.add_argument('--split_method', type=str, choices=["random", "hash"], default="random")
+    # Format of the train/validation/test files: csv, parquet, libsvm or recordio-protobuf
+    parser.add_argument('--output_format', type=str, choices=["csv", "parquet", "libsvm", "recordio-protobuf"],
+                        default="csv")
+    # Compression codec of parquet output files
+    parser.add_argument('--parquet_compression', type=str, choices=["snappy", "zstd"], default="snappy")
+    # Spread each split over this many files in total, divided between the hosts, with the row
+    # counts of a host's files differing by at most one. Each host writes at least one file
+    parser.add_argument('--num_shards', type=int, default=1)
+    # Roll each split over to a new file once it reaches about this many bytes, instead of --num_shards
+    parser.add_argument('--shard_bytes', type=int, default=None)
+    # Local directory or s3:// prefix of the processed-input manifest. When set, only input files
+    # that are new or changed since earlier runs are processed
+    parser.add_argument('--manifest', type=str, default=None)
+    # Local directory or s3:// prefix the train/validation/test directories are uploaded to, used to
+    # delete the output shards of changed input files
+    parser.add_argument('--output_uri', type=str, default=None)
+    # Directory the per stage timing and memory report is written to, by default {base_dir}/report
+    parser.add_argument('--report_dir', type=str, default=None)
+    # Profile the whole run with cProfile or pyinstrument and write the profile next to the report
+    parser.add_argument('--profile', type=str, choices=["cprofile", "pyinstrument"], default=None)
     args, _ = parser.parse_known_args()
     return args
 
@@ -44,6 +198,9 @@ def extract_zones(zones_file: str, zones_dir: str):
 
 
 def load_zones(zones_dir: str):
+    # Imported here so that runs reusing a cached zone matrix never load geopandas
+    gpd = require("geopandas", "geopandas==0.9.0")
+
     logging.info(f"Loading zones from {zones_dir}")
     # Load the shape file and get the geometry and lat/lon
     zone_df = gpd.read_file(os.path.join(zones_dir, "taxi_zones.shp"))
@@ -55,6 +212,128 @@ def load_zones(zones_dir: str):
     return zone_df
 
 
+def build_zone_lookup(zone_df: pd.DataFrame):
+    """Copies the zone coordinates enrich_data needs into NumPy arrays.
+
+    Position i of each array holds the zone row that trip location ID i joins to
+    (the zone table index), and one trailing NaN entry stands in for IDs with no zone.
+    """
+    size = zone_df.index.max() + 1
+    positions = zone_df.index.to_numpy()
+    columns = {
+        "latitude": zone_df["latitude"].to_numpy(dtype="float64"),
+        "longitude": zone_df["longitude"].to_numpy(dtype="float64"),
+        "centroid_x": zone_df["centroid"].x.to_numpy(dtype="float64"),
+        "centroid_y": zone_df["centroid"].y.to_numpy(dtype="float64"),
+    }
+    zone_lookup = {}
+    for name, values in columns.items():
+        zone_lookup[name] = np.full(size + 1, np.nan)
+        zone_lookup[name][positions] = values
+    return zone_lookup
+
+
+# Zone pair features, stored as float32 for every (pickup, drop off) location pair.
+# Bump zone_matrix_version when the layout or derivation changes to invalidate caches.
+zone_matrix_file_name = "zone_matrix.npy"
+zone_matrix_version = 1
+zone_matrix_dtype = np.dtype([
+    ("geo_distance", "float32"),
+    ("pickup_latitude", "float32"),
+    ("pickup_longitude", "float32"),
+    ("dropoff_latitude", "float32"),
+    ("dropoff_longitude", "float32"),
+])
+
+
+def build_zone_matrix(zone_lookup: dict):
+    """Precomputes the zone features of every pickup and drop off location pair.
+
+    matrix[pickup, dropoff] holds the centroid distance in km and the coordinates of
+    both zones, indexed like the zone_lookup arrays (including the NaN entry).
+    """
+    size = len(zone_lookup["latitude"])
+    matrix = np.empty((size, size), dtype=zone_matrix_dtype)
+    # Distance in km between the zone centroids
+    delta_x = zone_lookup["centroid_x"][np.newaxis, :] - zone_lookup["centroid_x"][:, np.newaxis]
+    delta_y = zone_lookup["centroid_y"][np.newaxis, :] - zone_lookup["centroid_y"][:, np.newaxis]
+    matrix["geo_distance"] = np.sqrt(delta_x * delta_x + delta_y * delta_y) / 1000
+    matrix["pickup_latitude"] = zone_lookup["latitude"][:, np.newaxis]
+    matrix["pickup_longitude"] = zone_lookup["longitude"][:, np.newaxis]
+    matrix["dropoff_latitude"] = zone_lookup["latitude"][np.newaxis, :]
+    matrix["dropoff_longitude"] = zone_lookup["longitude"][np.newaxis, :]
+    return matrix
+
+
+def save_zone_matrix(zone_matrix: np.ndarray, zone_matrix_file: str):
+    logger.info(f"Writing zone matrix: {zone_matrix_file}")
+    # Write to a temporary file first so concurrent readers never see a partial matrix
+    tmp_file = f"{zone_matrix_file}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(tmp_file, "wb") as f:
+        np.save(f, zone_matrix, allow_pickle=False)
+    os.replace(tmp_file, zone_matrix_file)
+
+
+def load_zone_matrix(zone_matrix_file: str):
+    """Opens a zone matrix written by save_zone_matrix as a read only memory map."""
+    logger.info(f"Loading zone matrix: {zone_matrix_file}")
+    zone_matrix = np.load(zone_matrix_file, mmap_mode="r", allow_pickle=False)
+    if zone_matrix.dtype != zone_matrix_dtype or zone_matrix.ndim != 2:
+        raise Exception(f"Zone matrix {zone_matrix_file} has unexpected layout {zone_matrix.dtype}")
+    return zone_matrix
+
+
+def zone_positions(location_ids, zone_matrix: np.ndarray):
+    """Maps location IDs to zone_matrix positions, sending unknown IDs to the NaN entry."""
+    sentinel = len(zone_matrix) - 1
+    ids = np.asarray(location_ids, dtype="float64")
+    known = (ids >= 0) & (ids < sentinel)
+    return np.where(known, ids, sentinel).astype(np.int64)
+
+
+def zone_pair_features(zone_matrix: np.ndarray, pickup_location_ids, dropoff_location_ids):
+    """Looks up the zone features for pickup/drop off location ID pairs.
+
+    Shared by enrich_data and online feature code so both read the same values.
+    Returns a dict of float32 arrays keyed by feature name.
+    """
+    pairs = zone_matrix[
+        zone_positions(pickup_location_ids, zone_matrix),
+        zone_positions(dropoff_location_ids, zone_matrix),
+    ]
+    return {name: pairs[name] for name in zone_matrix_dtype.names}
+
+
+# Compact dtypes of the trip table, applied after every stage to roughly halve its memory.
+# Integer dtypes are only applied once a column has no missing values left.
+dtype_plan = {
+    "fare_amount": "float32",
+    "passenger_count": "int8",
+    "PULocationID": "int16",
+    "DOLocationID": "int16",
+    "pickup_latitude": "float32",
+    "pickup_longitude": "float32",
+    "dropoff_latitude": "float32",
+    "dropoff_longitude": "float32",
+    "geo_distance": "float32",
+    "hour": "int8",
+    "weekday": "int8",
+    "month": "int8",
+    "duration_minutes": "float32",
+}
+
+
+def compact_dtypes(df: pd.DataFrame):
+    """Casts the columns of df named in dtype_plan in place, one column at a time."""
+    for column, dtype in dtype_plan.items():
+        if column not in df.columns or df[column].dtype == dtype:
+            continue
+        if np.issubdtype(np.dtype(dtype), np.integer) and df[column].isna().any():
+            continue
+        df[column] = df[column].astype(dtype)
+    return df
+
+
 def load_data(file_list: list):
     # Define dates, and columns to use
     use_cols = [
@@ -65,63 +344,108 @@ def load_data(file_list: list):
         "PULocationID",
         "DOLocationID",
     ]
+    # Arrow reads the timestamps as datetime64 columns, several times faster than
+    # pandas reading them as strings that parse_datetimes then parses
+    pa_csv = require("pyarrow.csv", "pyarrow")
+    convert_options = pa_csv.ConvertOptions(include_columns=use_cols)
     # Concat input files with select columns
-    dfs = []
-    for file in file_list:
-        dfs.append(pd.read_csv(file, usecols=use_cols))
-    return pd.concat(dfs, ignore_index=True)
-
-
-def enrich_data(trip_df: pd.DataFrame, zone_df: pd.DataFrame):
-    # Join trip DF to zones for poth pickup and drop off locations
-    trip_df = gpd.GeoDataFrame(
-        trip_df.join(zone_df, on="PULocationID").join(
-            zone_df, on="DOLocationID", rsuffix="_DO", lsuffix="_PU"
-        )
-    )
-    trip_df["geo_distance"] = (
-        trip_df["centroid_PU"].distance(trip_df["centroid_DO"]) / 1000
-    )
+    with report.stage("read") as stage:
+        dfs = []
+        for file in file_list:
+            dfs.append(compact_dtypes(pa_csv.read_csv(file, convert_options=convert_options).to_pandas()))
+        data_df = pd.concat(dfs, ignore_index=True)
+        stage["rows_in"] = stage["rows_out"] = len(data_df)
+    return data_df
+
+
+# Timestamp format of the TLC trip files
+datetime_format = "%Y-%m-%d %H:%M:%S"
+
+
+def parse_datetimes(values: pd.Series):
+    """Parses timestamps with datetime_format, inferring the format only if that fails."""
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    try:
+        return pd.to_datetime(values, format=datetime_format)
+    except (TypeError, ValueError):
+        logger.warning(f"Timestamps do not match {datetime_format}, inferring their format")
+        return pd.to_datetime(values)
+
+
+ns_per_day = 86400 * 10**9
+ns_per_hour = 3600 * 10**9
+
+
+def calendar_features(pickup: pd.Series, dropoff: pd.Series):
+    """Derives hour, weekday, month and duration_minutes from datetime columns.
+
+    Works on the int64 nanoseconds directly instead of separate Series.dt passes.
+    duration_minutes is the seconds component of the dropoff - pickup timedelta
+    (Series.dt.seconds) in minutes, and missing timestamps give NaN, as before.
+    """
+    pickup_ns = pickup.to_numpy(dtype="datetime64[ns]")
+    dropoff_ns = dropoff.to_numpy(dtype="datetime64[ns]")
+    pickup_int = pickup_ns.view("int64")
+
+    days, day_ns = np.divmod(pickup_int, ns_per_day)
+    features = {
+        "hour": day_ns // ns_per_hour,
+        # 1970-01-01 was a Thursday
+        "weekday": (days + 3) % 7,
+        "month": pickup_ns.astype("datetime64[M]").view("int64") % 12 + 1,
+        "duration_minutes": (dropoff_ns.view("int64") - pickup_int) // 10**9 % 86400 / 60,
+    }
+
+    missing_pickup = np.isnat(pickup_ns)
+    missing = missing_pickup | np.isnat(dropoff_ns)
+    if missing.any():
+        for name in ["hour", "weekday", "month"]:
+            features[name] = np.where(missing_pickup, np.nan, features[name])
+        features["duration_minutes"] = np.where(missing, np.nan, features["duration_minutes"])
+    return features
+
+
+def enrich_data(trip_df: pd.DataFrame, zone_matrix: np.ndarray):
+    # Look up zone coordinates and distance for the pickup and drop off locations
+    with report.stage("join", rows_in=len(trip_df)) as stage:
+        features = zone_pair_features(zone_matrix, trip_df["PULocationID"], trip_df["DOLocationID"])
+        for name, values in features.items():
+            trip_df[name] = values
+        stage["rows_out"] = len(trip_df)
+
+    # Add date parts and calculated duration in minutes
+    with report.stage("datetime", rows_in=len(trip_df)) as stage:
+        trip_df["lpep_pickup_datetime"] = parse_datetimes(trip_df["lpep_pickup_datetime"])
+        trip_df["lpep_dropoff_datetime"] = parse_datetimes(trip_df["lpep_dropoff_datetime"])
+        features = calendar_features(trip_df["lpep_pickup_datetime"], trip_df["lpep_dropoff_datetime"])
+        for name, values in features.items():
+            trip_df[name] = values
+        stage["rows_out"] = len(trip_df)
 
-    # Add date parts
-    trip_df["lpep_pickup_datetime"] = pd.to_datetime(trip_df["lpep_pickup_datetime"])
-    trip_df["hour"] = trip_df["lpep_pickup_datetime"].dt.hour
-    trip_df["weekday"] = trip_df["lpep_pickup_datetime"].dt.weekday
-    trip_df["month"] = trip_df["lpep_pickup_datetime"].dt.month
-
-    # Get calculated duration in minutes
-    trip_df["lpep_dropoff_datetime"] = pd.to_datetime(trip_df["lpep_dropoff_datetime"])
-    trip_df["duration_minutes"] = (
-        trip_df["lpep_dropoff_datetime"] - trip_df["lpep_pickup_datetime"]
-    ).dt.seconds / 60
-
-    # Rename and filter cols
-    trip_df = trip_df.rename(
-        columns={
-            "latitude_PU": "pickup_latitude",
-            "longitude_PU": "pickup_longitude",
-            "latitude_DO": "dropoff_latitude",
-            "longitude_DO": "dropoff_longitude",
-        }
-    )
-    
     trip_df['FS_ID'] = trip_df.index + 1000
     current_time_sec = int(round(time.time()))
-    trip_df["FS_time"] = pd.Series([current_time_sec]*len(trip_df), dtype="float64")
-    return trip_df
+    # One event time for every row, stored as a single category instead of a float per row
+    trip_df["FS_time"] = pd.Categorical.from_codes(
+        np.zeros(len(trip_df), dtype=np.int8), categories=[float(current_time_sec)]
+    )
+    return compact_dtypes(trip_df)
 
 
 def clean_data(trip_df: pd.DataFrame):
     # Remove outliers
-    trip_df = trip_df[
-        (trip_df.fare_amount > 0)
-        & (trip_df.fare_amount < 200)
-        & (trip_df.passenger_count > 0)
-        & (trip_df.duration_minutes > 0)
-        & (trip_df.duration_minutes < 120)
-        & (trip_df.geo_distance > 0)
-        & (trip_df.geo_distance < 121)
-    ].dropna()
+    with report.stage("filter", rows_in=len(trip_df)) as stage:
+        trip_df = trip_df[
+            (trip_df.fare_amount > 0)
+            & (trip_df.fare_amount < 200)
+            & (trip_df.passenger_count > 0)
+            & (trip_df.duration_minutes > 0)
+            & (trip_df.duration_minutes < 120)
+            & (trip_df.geo_distance > 0)
+            & (trip_df.geo_distance < 121)
+        ].dropna()
+        compact_dtypes(trip_df)
+        stage["rows_out"] = len(trip_df)
 
     # Filter columns
     cols = [
@@ -155,23 +479,232 @@ def clean_data(trip_df: pd.DataFrame):
 
 
 
+class CsvOutput:
+    """Headerless CSV with the label in the first column."""
+    extension = "csv"
+    content_type = "text/csv"
+
+    def __init__(self, path: str, compression=None):
+        self.file = open(path, "w")
+
+    def write(self, data_df: pd.DataFrame):
+        data_df.to_csv(self.file, header=False, index=False)
+
+    def size(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetOutput:
+    """Parquet with the label in the first column, compressed with snappy or zstd."""
+    extension = "parquet"
+    content_type = "application/x-parquet"
+
+    def __init__(self, path: str, compression="snappy"):
+        self.pa = require("pyarrow", "pyarrow")
+        self.pq = require("pyarrow.parquet", "pyarrow")
+        self.path = path
+        self.compression = compression
+        self.writer = None
+
+    def write(self, data_df: pd.DataFrame):
+        table = self.pa.Table.from_pandas(data_df, preserve_index=False)
+        if self.writer is None:
+            self.writer = self.pq.ParquetWriter(self.path, table.schema, compression=self.compression)
+        self.writer.write_table(table)
+
+    def size(self):
+        # Each write_table call flushes its row groups to the file
+        return os.path.getsize(self.path) if self.writer is not None else 0
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class LibsvmOutput:
+    """libsvm text with zero based feature indices, which line up with the CSV columns.
+
+    Zero values are written out, as libsvm readers treat absent features as missing.
+    """
+    extension = "libsvm"
+    content_type = "text/libsvm"
+
+    def __init__(self, path: str, compression=None):
+        self.file = open(path, "w")
+
+    def write(self, data_df: pd.DataFrame):
+        columns = {0: data_df.iloc[:, 0]}
+        for i in range(1, data_df.shape[1]):
+            columns[i] = f"{i - 1}:" + data_df.iloc[:, i].astype(str)
+        pd.DataFrame(columns).to_csv(self.file, sep=" ", header=False, index=False)
+
+    def size(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+class RecordioProtobufOutput:
+    """RecordIO-wrapped protobuf records with dense float32 features and label."""
+    extension = "recordio"
+    content_type = "application/x-recordio-protobuf"
+
+    def __init__(self, path: str, compression=None):
+        require("sagemaker", "sagemaker")
+        from sagemaker.amazon.common import write_numpy_to_dense_tensor
+
+        self.write_numpy_to_dense_tensor = write_numpy_to_dense_tensor
+        self.file = open(path, "wb")
+
+    def write(self, data_df: pd.DataFrame):
+        if len(data_df) > 0:
+            values = data_df.to_numpy(dtype=np.float32)
+            self.write_numpy_to_dense_tensor(self.file, values[:, 1:], values[:, 0])
+
+    def size(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+output_formats = {
+    "csv": CsvOutput,
+    "parquet": ParquetOutput,
+    "libsvm": LibsvmOutput,
+    "recordio-protobuf": RecordioProtobufOutput,
+}
+
+
+def host_shards(num_shards: int, hosts: list, current_host: str):
+    """The number of shards current_host writes, so that the hosts write num_shards in total."""
+    position = sorted(hosts).index(current_host)
+    return max(1, num_shards // len(hosts) + int(position < num_shards % len(hosts)))
+
+
+class ShardedOutput:
+    """Spreads the rows written to one split over several output files.
+
+    With num_shards the rows go round robin over that many files, so their row
+    counts differ by at most one. With shard_bytes a file is closed once it reaches
+    about that size and the next one is started, sizing each write from the bytes
+    per row written so far.
+    """
+    probe_rows = 1000
+
+    def __init__(self, path_prefix: str, output_class, compression="snappy", num_shards=1, shard_bytes=None):
+        self.path_prefix = path_prefix
+        self.output_class = output_class
+        self.compression = compression
+        self.shard_bytes = shard_bytes
+        self.sharded = bool(shard_bytes) or num_shards > 1
+        self.num_opened = 0
+        self.paths = []
+        self.num_rows = 0
+        self.shard_rows = 0
+        self.bytes_per_row = None
+        self.outputs = [self.open_next() for _ in range(1 if shard_bytes else num_shards)]
+
+    def open_next(self):
+        suffix = f"_{self.num_opened:05d}" if self.sharded else ""
+        self.num_opened += 1
+        self.paths.append(f"{self.path_prefix}{suffix}.{self.output_class.extension}")
+        return self.output_class(self.paths[-1], self.compression)
+
+    def write(self, data_df: pd.DataFrame):
+        if self.shard_bytes:
+            self.write_rolling(data_df)
+        elif len(self.outputs) == 1:
+            self.outputs[0].write(data_df)
+        else:
+            shards = (self.num_rows + np.arange(len(data_df))) % len(self.outputs)
+            for shard, output in enumerate(self.outputs):
+                output.write(data_df[shards == shard])
+        self.num_rows += len(data_df)
+
+    def write_rolling(self, data_df: pd.DataFrame):
+        start = 0
+        while start < len(data_df):
+            output = self.outputs[0]
+            if output.size() >= self.shard_bytes:
+                output.close()
+                self.outputs = [self.open_next()]
+                self.shard_rows = 0
+                continue
+            rows = self.probe_rows
+            if self.bytes_per_row:
+                rows = max(1, int((self.shard_bytes - output.size()) / self.bytes_per_row))
+            stop = min(len(data_df), start + rows)
+            output.write(data_df.iloc[start:stop])
+            self.shard_rows += stop - start
+            if output.size() > 0:
+                self.bytes_per_row = output.size() / self.shard_rows
+            start = stop
+
+    def close(self):
+        for output in self.outputs:
+            output.close()
+
+
+def open_split_outputs(base_dir: str, current_host=None, output_format="csv", compression="snappy",
+                       num_shards=1, shard_bytes=None):
+    """Opens the train, validation and test outputs of output_format, see ShardedOutput for the sharding."""
+    output_class = output_formats[output_format]
+    tmp_id = uuid.uuid4().hex[:8]
+    return [
+        ShardedOutput(f"{base_dir}/{split}/{split}_{current_host}_{tmp_id}", output_class, compression,
+                      num_shards, shard_bytes)
+        for split in ["train", "validation", "test"]
+    ]
+
+
+def hash_split_labels(data_df: pd.DataFrame, val_size=0.2, test_size=0.05):
+    """Assigns rows to train (0), validation (1) or test (2) from a hash of their values.
+
+    A row's label only depends on the row itself, so it is the same whether the rows
+    are split at once, in streamed batches or across any number of hosts. Like the
+    two train_test_split calls, val_size of the rows are held out and test_size of
+    those go to test.
+    """
+    positions = pd.util.hash_pandas_object(data_df, index=False).to_numpy() / 2.0**64
+    labels = np.zeros(len(data_df), dtype=np.int8)
+    labels[positions < val_size] = 1
+    labels[positions < val_size * test_size] = 2
+    return labels
+
+
 def save_files(base_dir: str, data_df: pd.DataFrame, data_fg: pd.DataFrame,
-               val_size=0.2, test_size=0.05, current_host=None):
-        
+               val_size=0.2, test_size=0.05, current_host=None, split_method="random",
+               output_options=None):
+    """Splits and writes the data, returning the paths of the files written."""
     logger.info(f"Splitting {len(data_df)} rows of data into train, val, test.")
 
-    train_df, val_df = train_test_split(data_df, test_size=val_size, random_state=42)
-    val_df, test_df = train_test_split(val_df, test_size=test_size, random_state=42)
+    with report.stage("split", rows_in=len(data_df)) as stage:
+        if split_method == "hash":
+            labels = hash_split_labels(data_df, val_size, test_size)
+            train_df, val_df, test_df = (data_df[labels == label] for label in range(3))
+        else:
+            from sklearn.model_selection import train_test_split
 
-    logger.info(f"Writing out datasets to {base_dir}")
-    tmp_id = uuid.uuid4().hex[:8]
-    train_df.to_csv(f"{base_dir}/train/train_{current_host}_{tmp_id}.csv", header=False, index=False)
-    val_df.to_csv(f"{base_dir}/validation/validation_{current_host}_{tmp_id}.csv", header=False, index=False)
+            train_df, val_df = train_test_split(data_df, test_size=val_size, random_state=42)
+            val_df, test_df = train_test_split(val_df, test_size=test_size, random_state=42)
+        stage["rows_out"] = len(train_df) + len(val_df) + len(test_df)
 
-    # Save test data without header
-    test_df.to_csv(f"{base_dir}/test/test_{current_host}_{tmp_id}.csv", header=False, index=False)
+    logger.info(f"Writing out datasets to {base_dir}")
+    outputs = open_split_outputs(base_dir, current_host, **(output_options or {}))
+    with report.stage("write", rows_in=len(data_df)) as stage:
+        stage["rows_out"] = 0
+        for output, split_df in zip(outputs, [train_df, val_df, test_df]):
+            output.write(split_df)
+            output.close()
+            stage["rows_out"] += len(split_df)
 
-    return
+    # Parquet outputs only create files when they have rows
+    return [path for output in outputs for path in output.paths if os.path.exists(path)]
 
 def _read_json(path):  # type: (str) -> dict
     """Read a JSON file.
@@ -183,6 +716,214 @@ def _read_json(path):  # type: (str) -> dict
     with open(path, "r") as f:
         return json.load(f)
 
+def file_sha256(path: str):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def zone_cache_key(zones_file: str):
+    """Names the cached zone matrix after the content hash of the zones file."""
+    return f"zone_matrix_v{zone_matrix_version}_{file_sha256(zones_file)}.npy"
+
+
+def _split_s3_uri(s3_uri: str):
+    bucket, _, prefix = s3_uri[len("s3://"):].partition("/")
+    return bucket, prefix
+
+
+def fetch_cached_zone_matrix(zone_cache: str, cache_key: str, zones_dir: str):
+    """Returns the local path of the cached zone matrix, or None on a cache miss."""
+    if not zone_cache.startswith("s3://"):
+        cached_file = os.path.join(zone_cache, cache_key)
+        return cached_file if os.path.exists(cached_file) else None
+
+    bucket, prefix = _split_s3_uri(zone_cache)
+    cached_file = os.path.join(zones_dir, cache_key)
+    try:
+        boto3.client("s3").download_file(bucket, os.path.join(prefix, cache_key), cached_file)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return None
+        raise
+    return cached_file
+
+
+def store_cached_zone_matrix(zone_matrix: np.ndarray, zone_cache: str, cache_key: str, zones_dir: str):
+    if not zone_cache.startswith("s3://"):
+        os.makedirs(zone_cache, exist_ok=True)
+        save_zone_matrix(zone_matrix, os.path.join(zone_cache, cache_key))
+        return
+
+    bucket, prefix = _split_s3_uri(zone_cache)
+    cached_file = os.path.join(zones_dir, cache_key)
+    save_zone_matrix(zone_matrix, cached_file)
+    logger.info(f"Uploading zone matrix to {zone_cache}")
+    boto3.client("s3").upload_file(cached_file, bucket, os.path.join(prefix, cache_key))
+
+
+def read_manifest(manifest: str):
+    """Reads the processed-input manifest, returning its latest entry for each input key.
+
+    The manifest is a local directory or s3:// prefix of JSON files. Every run and
+    host adds a file of its own instead of updating a shared one, so hosts never
+    overwrite each other's entries.
+    """
+    documents = []
+    if manifest.startswith("s3://"):
+        bucket, prefix = _split_s3_uri(manifest)
+        s3 = boto3.client("s3")
+        for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                if obj["Key"].endswith(".json"):
+                    documents.append(json.loads(s3.get_object(Bucket=bucket, Key=obj["Key"])["Body"].read()))
+    else:
+        for path in glob.glob(os.path.join(manifest, "*.json")):
+            documents.append(_read_json(path))
+
+    entries = {}
+    for entry in sorted((entry for document in documents for entry in document["inputs"]),
+                        key=lambda entry: entry["processed_at"]):
+        entries[entry["key"]] = entry
+    return entries
+
+
+def write_manifest(manifest: str, entries: list, current_host=None):
+    name = f"manifest_{current_host}_{uuid.uuid4().hex[:8]}.json"
+    document = json.dumps({"inputs": entries}, indent=2)
+    if not manifest.startswith("s3://"):
+        os.makedirs(manifest, exist_ok=True)
+        with open(os.path.join(manifest, name), "w") as f:
+            f.write(document)
+        return
+
+    bucket, prefix = _split_s3_uri(manifest)
+    boto3.client("s3").put_object(Bucket=bucket, Key=os.path.join(prefix, name), Body=document.encode())
+
+
+def list_output_shards(output_uri: str):
+    """Lists the files under output_uri as paths relative to it."""
+    if not output_uri.startswith("s3://"):
+        return {
+            os.path.relpath(path, output_uri)
+            for path in glob.glob(os.path.join(output_uri, "**"), recursive=True) if os.path.isfile(path)
+        }
+
+    bucket, prefix = _split_s3_uri(output_uri)
+    shards = set()
+    for page in boto3.client("s3").get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            shards.add(os.path.relpath(obj["Key"], prefix))
+    return shards
+
+
+def delete_output_shards(output_uri: str, shards: list):
+    """Deletes output shards, given as paths relative to output_uri, of an input file that changed."""
+    if not output_uri.startswith("s3://"):
+        for shard in shards:
+            path = os.path.join(output_uri, shard)
+            if os.path.exists(path):
+                os.remove(path)
+        return
+
+    bucket, prefix = _split_s3_uri(output_uri)
+    s3 = boto3.client("s3")
+    for shard in shards:
+        s3.delete_object(Bucket=bucket, Key=os.path.join(prefix, shard))
+
+
+def get_zone_matrix(zones_file: str, zone_cache=None):
+    """Loads the zone matrix for the zones file.
+
+    A zone_matrix.npy shipped next to the zones file wins. Otherwise the matrix is
+    looked up in zone_cache by the hash of the zones file, and only on a miss is the
+    zip extracted and the shapefile parsed, after which the cache is filled.
+    """
+    zones_dir = os.path.dirname(zones_file)
+    zone_matrix_file = os.path.join(zones_dir, zone_matrix_file_name)
+    if os.path.exists(zone_matrix_file):
+        return load_zone_matrix(zone_matrix_file)
+
+    if not os.path.exists(zones_file):
+        raise Exception(f"Zones file {zones_file} does not exist")
+
+    if zone_cache:
+        with report.stage("zone_cache"):
+            cache_key = zone_cache_key(zones_file)
+            cached_file = fetch_cached_zone_matrix(zone_cache, cache_key, zones_dir)
+        if cached_file:
+            return load_zone_matrix(cached_file)
+        logger.info(f"Zone matrix {cache_key} not found in {zone_cache}")
+
+    # Extract and load taxi zones geopandas dataframe
+    with report.stage("unzip"):
+        extract_zones(zones_file, zones_dir)
+    with report.stage("load_zones") as stage:
+        zone_df = load_zones(zones_dir)
+        stage["rows_out"] = len(zone_df)
+    with report.stage("zone_matrix", rows_in=len(zone_df)) as stage:
+        zone_matrix = build_zone_matrix(build_zone_lookup(zone_df))
+        stage["rows_out"] = len(zone_matrix)
+
+    if zone_cache:
+        store_cached_zone_matrix(zone_matrix, zone_cache, cache_key, zones_dir)
+    return zone_matrix
+
+
+def process_incremental(base_dir: str, input_dir: str, input_file_list: list, zone_matrix: np.ndarray,
+                        manifest: str, output_uri=None, current_host=None, split_method="random",
+                        output_options=None):
+    """Processes only the input files that are new or changed since the runs in the manifest.
+
+    Each such file is processed on its own, so the manifest can record the output
+    shards it produced next to its size and sha256 checksum. When a file changes,
+    its old shards are deleted from base_dir and output_uri and replaced. The
+    shards of unchanged files stay where earlier runs uploaded them.
+
+    The manifest is written before the ProcessingOutputs upload the shards, so an
+    entry only counts once all its shards are found in output_uri, or in base_dir
+    without one. Files of a run that failed before the upload are processed again.
+    """
+    processed = read_manifest(manifest)
+    published = list_output_shards(output_uri or base_dir) if processed else set()
+    entries = []
+    for file in sorted(input_file_list):
+        key = os.path.relpath(file, input_dir)
+        size = os.path.getsize(file)
+        checksum = file_sha256(file)
+        previous = processed.get(key)
+        if previous and previous["size"] == size and previous["checksum"] == checksum:
+            if published.issuperset(previous["shards"]):
+                logger.info(f"Skipping unchanged input file {key}")
+                continue
+            logger.info(f"Output shards of input file {key} were never uploaded, processing it again")
+        if previous:
+            logger.info(f"Input file {key} changed, deleting its output shards")
+            # Left in base_dir when there is no output_uri, they would be uploaded again
+            delete_output_shards(base_dir, previous["shards"])
+            if output_uri:
+                delete_output_shards(output_uri, previous["shards"])
+
+        logger.info(f"Processing input file {key}")
+        data_df, data_fg = clean_data(enrich_data(load_data([file]), zone_matrix))
+        shards = save_files(base_dir, data_df, data_fg, current_host=current_host, split_method=split_method,
+                            output_options=output_options)
+        entries.append({
+            "key": key,
+            "size": size,
+            "checksum": checksum,
+            "shards": [os.path.relpath(shard, base_dir) for shard in shards],
+            "processed_at": time.time(),
+        })
+
+    if not entries:
+        logger.info("No new or changed input files")
+        return
+    write_manifest(manifest, entries, current_host)
+
+
 def main(base_dir: str, args: argparse.Namespace):
     # Input data files
     input_dir = os.path.join(base_dir, "input/data")
@@ -200,24 +941,83 @@ def main(base_dir: str, args: argparse.Namespace):
     # Input zones file
     zones_dir = os.path.join(base_dir, "input/zones")
     zones_file = os.path.join(zones_dir, "taxi_zones.zip")
-    if not os.path.exists(zones_file):
-        raise Exception(f"Zones file {zones_file} does not exist")
 
-    # Extract and load taxi zones geopandas dataframe
-    extract_zones(zones_file, zones_dir)
-    zone_df = load_zones(zones_dir)
+    zone_matrix = get_zone_matrix(zones_file, args.zone_cache)
+
+    output_options = {
+        "output_format": args.output_format,
+        "compression": args.parquet_compression,
+        "num_shards": host_shards(args.num_shards, hosts["hosts"], current_host),
+        "shard_bytes": args.shard_bytes,
+    }
+    if args.manifest:
+        return process_incremental(base_dir, input_dir, input_file_list, zone_matrix, args.manifest,
+                                   args.output_uri, current_host, args.split_method, output_options)
 
     # Load input files
     data_df = load_data(input_file_list)
-    data_df = enrich_data(data_df, zone_df)
+    data_df = enrich_data(data_df, zone_matrix)
     data_df, data_fg = clean_data(data_df)
-    
-    return save_files(base_dir, data_df, data_fg, current_host=current_host)
+
+    return save_files(base_dir, data_df, data_fg, current_host=current_host, split_method=args.split_method,
+                      output_options=output_options)
+
+
+@contextlib.contextmanager
+def instrumented(report_dir: str, current_host=None, profile=None, run_args=None):
+    """Writes the stage report of the enclosed run, and its profile if requested, to report_dir.
+
+    The files are written even when the run fails, as report_{current_host}.json and
+    profile_{current_host}.prof/.txt for cProfile or profile_{current_host}.html for
+    pyinstrument.
+    """
+    profiler = None
+    if profile == "cprofile":
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif profile == "pyinstrument":
+        profiler = require("pyinstrument", "pyinstrument").Profiler()
+        profiler.start()
+    try:
+        yield report
+    finally:
+        os.makedirs(report_dir, exist_ok=True)
+        if profile == "cprofile":
+            import pstats
+
+            profiler.disable()
+            profiler.dump_stats(os.path.join(report_dir, f"profile_{current_host}.prof"))
+            with open(os.path.join(report_dir, f"profile_{current_host}.txt"), "w") as f:
+                pstats.Stats(profiler, stream=f).sort_stats("cumulative").print_stats(50)
+        elif profile == "pyinstrument":
+            profiler.stop()
+            with open(os.path.join(report_dir, f"profile_{current_host}.html"), "w") as f:
+                f.write(profiler.output_html())
+        run_report = dict(host=current_host, args=run_args, **report.to_dict())
+        report_file = os.path.join(report_dir, f"report_{current_host}.json")
+        with open(report_file, "w") as f:
+            json.dump(run_report, f, indent=2)
+        logger.info(f"Wrote stage report to {report_file}")
 
 
 if __name__ == "__main__":
     logger.info("Starting preprocessing.")
     args = parse_args()
-    base_dir = args.base_dir
-    main(base_dir, args)
+    if args.wheelhouse:
+        # pip reads these for every install, so missing packages never reach out to PyPI
+        os.environ["PIP_NO_INDEX"] = "1"
+        os.environ["PIP_FIND_LINKS"] = args.wheelhouse
+    if args.build_zone_matrix:
+        zones_dir = os.path.dirname(os.path.abspath(args.build_zone_matrix))
+        extract_zones(args.build_zone_matrix, zones_dir)
+        zone_matrix = build_zone_matrix(build_zone_lookup(load_zones(zones_dir)))
+        save_zone_matrix(zone_matrix, os.path.join(zones_dir, zone_matrix_file_name))
+    else:
+        base_dir = args.base_dir
+        current_host = _read_json("/opt/ml/config/resourceconfig.json")["current_host"]
+        with instrumented(args.report_dir or os.path.join(base_dir, "report"), current_host, args.profile,
+                          vars(args)):
+            main(base_dir, args)
     logger.info("Done")
\ No newline at end of file
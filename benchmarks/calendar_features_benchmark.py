@@ -0,0 +1,121 @@
+"""Times preprocess.calendar_features against the Series.dt path it replaced.
+
+Random trip timestamps are generated as datetime64 columns (as loaded from parquet)
+and as strings in the TLC format (as read from CSV). For each, the old path of
+pd.to_datetime without a format followed by separate .dt.hour/.dt.weekday/.dt.month
+and .dt.seconds passes is timed against parse_datetimes + calendar_features, and
+both results are checked to be equal. With --script mlops the timestamps are also
+written to a CSV file, and reading it with pd.read_csv before the old path is timed
+against load_data before the new one, e.g.
+
+    python benchmarks/calendar_features_benchmark.py --rows 2000000 --repeat 3
+    python benchmarks/calendar_features_benchmark.py --script mlops
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from common import load_preprocess
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--script", choices=["processing", "mlops"], default="processing")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    return parser.parse_args()
+
+
+def make_timestamps(rows):
+    rng = np.random.default_rng(42)
+    start = np.datetime64("2018-01-01T00:00:00", "s")
+    pickup = start + rng.integers(0, 365 * 86400, rows).astype("timedelta64[s]")
+    dropoff = pickup + rng.integers(-600, 3 * 86400, rows).astype("timedelta64[s]")
+    return pd.Series(pickup.astype("datetime64[ns]")), pd.Series(dropoff.astype("datetime64[ns]"))
+
+
+def dt_features(pickup, dropoff):
+    pickup = pd.to_datetime(pickup)
+    dropoff = pd.to_datetime(dropoff)
+    return {
+        "hour": pickup.dt.hour,
+        "weekday": pickup.dt.weekday,
+        "month": pickup.dt.month,
+        "duration_minutes": (dropoff - pickup).dt.seconds / 60,
+    }
+
+
+def fused_features(preprocess, pickup, dropoff):
+    return preprocess.calendar_features(preprocess.parse_datetimes(pickup), preprocess.parse_datetimes(dropoff))
+
+
+def write_csv(path, pickup, dropoff, datetime_format):
+    """Writes a CSV with the columns load_data of the MLOps script reads."""
+    rows = len(pickup)
+    pd.DataFrame({
+        "lpep_pickup_datetime": pickup,
+        "lpep_dropoff_datetime": dropoff,
+        "passenger_count": np.ones(rows),
+        "PULocationID": np.ones(rows, dtype=np.int64),
+        "DOLocationID": np.ones(rows, dtype=np.int64),
+        "fare_amount": np.ones(rows),
+    }).to_csv(path, index=False, date_format=datetime_format)
+
+
+def best_time(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main():
+    args = parse_args()
+    preprocess = load_preprocess(args.script)
+    pickup, dropoff = make_timestamps(args.rows)
+    inputs = {
+        "datetime64": (pickup, dropoff),
+        "string": (pickup.dt.strftime(preprocess.datetime_format), dropoff.dt.strftime(preprocess.datetime_format)),
+    }
+
+    for name, (pickup, dropoff) in inputs.items():
+        dt_time, expected = best_time(lambda: dt_features(pickup, dropoff), args.repeat)
+        fused_time, actual = best_time(lambda: fused_features(preprocess, pickup, dropoff), args.repeat)
+        for feature, values in expected.items():
+            np.testing.assert_array_equal(np.asarray(actual[feature]), values.to_numpy(), err_msg=feature)
+        print(f"{name}: .dt path {dt_time:.3f}s, fused {fused_time:.3f}s, "
+              f"speedup {dt_time / fused_time:.1f}x ({args.rows} rows)")
+
+    if args.script == "mlops":
+        work_dir = tempfile.mkdtemp()
+        try:
+            csv_file = os.path.join(work_dir, "trips.csv")
+            write_csv(csv_file, *inputs["datetime64"], preprocess.datetime_format)
+
+            def read_dt():
+                trips = pd.read_csv(csv_file)
+                return dt_features(trips["lpep_pickup_datetime"], trips["lpep_dropoff_datetime"])
+
+            def read_fused():
+                trips = preprocess.load_data([csv_file])
+                return fused_features(preprocess, trips["lpep_pickup_datetime"], trips["lpep_dropoff_datetime"])
+
+            dt_time, expected = best_time(read_dt, args.repeat)
+            fused_time, actual = best_time(read_fused, args.repeat)
+            for feature, values in expected.items():
+                np.testing.assert_array_equal(np.asarray(actual[feature]), values.to_numpy(), err_msg=feature)
+            print(f"csv: read + .dt path {dt_time:.3f}s, load_data + fused {fused_time:.3f}s, "
+                  f"speedup {dt_time / fused_time:.1f}x ({args.rows} rows)")
+        finally:
+            shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
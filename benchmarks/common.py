@@ -0,0 +1,18 @@
+"""Helpers shared by the benchmark and check scripts."""
+import importlib.util
+import os
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+SCRIPTS = {
+    "processing": "1. Amazon SageMaker Processing/preprocess.py",
+    "mlops": "5. MLOps SageMaker Project/model-preprocess-workflow-seedcode-v1.0/pipelines/preprocess/preprocess.py",
+}
+
+
+def load_preprocess(script: str = "processing"):
+    """Imports one of the preprocess scripts as a module without running its main()."""
+    spec = importlib.util.spec_from_file_location(f"preprocess_{script}", os.path.join(REPO_DIR, SCRIPTS[script]))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,106 @@
+"""Checks that the compact dtype plan of the preprocess scripts leaves model quality unchanged.
+
+The input files are preprocessed twice, once with preprocess.dtype_plan and once
+without it (the wide pandas defaults). Both tables are split like save_files. An
+XGBoost model with the hyperparameters of the training pipeline is trained on each,
+and the test RMSE is compared. The script also reports the memory of both enriched
+tables and exits non-zero when the RMSE moves by more than --tolerance, e.g.
+
+    python benchmarks/dtype_plan_check.py --input 'data/green_tripdata_2018-1*.parquet' \\
+        --zones "0. Setup/input_zones/taxi_zones.zip"
+"""
+import argparse
+import glob
+import math
+import os
+import shutil
+import sys
+import tempfile
+
+from common import load_preprocess
+
+# Hyperparameters of the TrainNYCTaxiModel training step
+HYPERPARAMETERS = {
+    "objective": "reg:squarederror",
+    "max_depth": 9,
+    "eta": 0.2,
+    "gamma": 4,
+    "min_child_weight": 20,
+    "subsample": 0.8,
+    "seed": 42,
+}
+NUM_ROUND = 50
+EARLY_STOPPING_ROUNDS = 10
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--script", choices=["processing", "mlops"], default="processing")
+    parser.add_argument("--input", required=True, help="glob of trip data files")
+    parser.add_argument("--zones", required=True, help="path of taxi_zones.zip")
+    parser.add_argument("--tolerance", type=float, default=0.01, help="allowed relative RMSE change")
+    return parser.parse_args()
+
+
+def prepare(preprocess, files, zone_matrix, plan):
+    preprocess.dtype_plan = plan
+    trip_df = preprocess.enrich_data(preprocess.load_data(files), zone_matrix)
+    memory = trip_df.memory_usage(deep=True).sum()
+    data_df, _ = preprocess.clean_data(trip_df)
+    return data_df, memory
+
+
+def test_rmse(data_df):
+    import xgboost
+    from sklearn.model_selection import train_test_split
+
+    train_df, val_df = train_test_split(data_df, test_size=0.2, random_state=42)
+    val_df, test_df = train_test_split(val_df, test_size=0.05, random_state=42)
+
+    def dmatrix(df):
+        return xgboost.DMatrix(df.iloc[:, 1:].values, label=df.iloc[:, 0].values)
+
+    dval = dmatrix(val_df)
+    model = xgboost.train(
+        HYPERPARAMETERS, dmatrix(train_df), NUM_ROUND, evals=[(dval, "validation")],
+        early_stopping_rounds=EARLY_STOPPING_ROUNDS, verbose_eval=False,
+    )
+    predictions = model.predict(dmatrix(test_df), iteration_range=(0, model.best_iteration + 1))
+    errors = predictions - test_df.iloc[:, 0].values.astype("float64")
+    return math.sqrt((errors * errors).mean())
+
+
+def main():
+    args = parse_args()
+    files = sorted(glob.glob(args.input))
+    if not files:
+        raise Exception(f"No input files match {args.input}")
+
+    preprocess = load_preprocess(args.script)
+    zones_dir = tempfile.mkdtemp()
+    try:
+        zones_file = os.path.join(zones_dir, "taxi_zones.zip")
+        shutil.copy(args.zones, zones_file)
+        zone_matrix = preprocess.get_zone_matrix(zones_file)
+    finally:
+        shutil.rmtree(zones_dir)
+
+    compact_plan = dict(preprocess.dtype_plan)
+    results = {}
+    for name, plan in [("wide", {}), ("compact", compact_plan)]:
+        data_df, memory = prepare(preprocess, files, zone_matrix, plan)
+        results[name] = (test_rmse(data_df), memory, len(data_df))
+        print(f"{name}: test rmse {results[name][0]:.4f}, enriched table {memory / 2**20:.1f} MiB, "
+              f"{results[name][2]} rows")
+
+    wide_rmse, wide_memory, _ = results["wide"]
+    compact_rmse, compact_memory, _ = results["compact"]
+    change = abs(compact_rmse - wide_rmse) / wide_rmse
+    print(f"memory ratio {compact_memory / wide_memory:.2f}, relative rmse change {change:.4%}")
+    if change > args.tolerance:
+        print(f"rmse changed by more than {args.tolerance:.2%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
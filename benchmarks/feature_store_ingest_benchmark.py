@@ -0,0 +1,135 @@
+"""Benchmarks preprocess.FeatureStoreIngester offline against a local feature store stand-in.
+
+LocalFeatureStoreRuntime takes the place of the sagemaker-featurestore-runtime
+client. Its put_record sleeps for a simulated request latency, throttles requests
+beyond --max_rps and fails a share of them with transient errors. Batches of
+feature group rows are streamed through the ingester, which reports records/sec
+and PutRecord latency percentiles. The script checks that every row arrived
+exactly once, and that a put_record raising an unexpected exception fails the
+ingestion instead of leaving it blocked on a full queue, e.g.
+
+    python benchmarks/feature_store_ingest_benchmark.py --rows 20000 --workers 8 16 32 --max_rps 2000
+"""
+import argparse
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from botocore.exceptions import ClientError
+
+from common import load_preprocess
+
+
+class LocalFeatureStoreRuntime:
+    """Stands in for the put_record method of the sagemaker-featurestore-runtime client."""
+
+    def __init__(self, latency_ms=5.0, max_rps=None, error_rate=0.0, seed=0, crash_after=None):
+        self.latency_ms = latency_ms
+        self.max_rps = max_rps
+        self.error_rate = error_rate
+        self.rng = np.random.default_rng(seed)
+        self.lock = threading.Lock()
+        self.tokens = max_rps or 0
+        self.refilled = time.perf_counter()
+        self.records = {}
+        self.throttled = 0
+        # Requests after which put_record raises an exception that is not a ClientError
+        self.crash_after = crash_after
+        self.requests = 0
+
+    def _error(self, code):
+        return ClientError({"Error": {"Code": code, "Message": code}}, "PutRecord")
+
+    def put_record(self, FeatureGroupName, Record):
+        with self.lock:
+            self.requests += 1
+            if self.crash_after is not None and self.requests > self.crash_after:
+                raise RuntimeError("connection pool is closed")
+            if self.max_rps:
+                # Token bucket holding at most one second of requests
+                now = time.perf_counter()
+                self.tokens = min(self.max_rps, self.tokens + (now - self.refilled) * self.max_rps)
+                self.refilled = now
+                if self.tokens < 1:
+                    self.throttled += 1
+                    raise self._error("ThrottlingException")
+                self.tokens -= 1
+            latency = self.rng.lognormal(np.log(self.latency_ms / 1000), 0.5)
+            failed = self.rng.random() < self.error_rate
+        time.sleep(latency)
+        if failed:
+            raise self._error("ServiceUnavailable")
+        record = {feature["FeatureName"]: feature["ValueAsString"] for feature in Record}
+        with self.lock:
+            self.records.setdefault((FeatureGroupName, record["FS_ID"]), []).append(record)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--batch_rows", type=int, default=5000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[4, 16, 32])
+    parser.add_argument("--queue_rows", type=int, default=20000)
+    parser.add_argument("--latency_ms", type=float, default=5.0)
+    parser.add_argument("--max_rps", type=float, default=None)
+    parser.add_argument("--error_rate", type=float, default=0.001)
+    return parser.parse_args()
+
+
+def make_rows(preprocess, rows):
+    rng = np.random.default_rng(42)
+    data_fg = pd.DataFrame({
+        name: rng.random(rows, dtype=np.float32) for name in preprocess.cols_fg if name not in ("FS_ID", "FS_time")
+    })
+    data_fg["FS_ID"] = np.arange(rows) + 1000
+    data_fg["FS_time"] = pd.Categorical.from_codes(np.zeros(rows, dtype=np.int8), [float(int(time.time()))])
+    return data_fg[preprocess.cols_fg]
+
+
+def check_worker_failure(preprocess, data_fg, args):
+    """Ingests through a client that crashes, with a queue far smaller than the rows submitted."""
+    client = LocalFeatureStoreRuntime(latency_ms=0.1, crash_after=500)
+    ingester = preprocess.FeatureStoreIngester("benchmark", client, num_workers=4, queue_rows=1000)
+    outcome = []
+
+    def ingest():
+        try:
+            for start in range(0, len(data_fg), args.batch_rows):
+                ingester.submit(data_fg.iloc[start:start + args.batch_rows])
+            ingester.close()
+        except Exception as e:
+            outcome.append(e)
+
+    thread = threading.Thread(target=ingest, daemon=True)
+    thread.start()
+    thread.join(timeout=60)
+    assert not thread.is_alive(), "ingestion hung after a worker failed"
+    assert outcome and isinstance(outcome[0].__cause__, RuntimeError), f"the worker failure was not raised: {outcome}"
+    print(f"worker failure: raised {outcome[0]!r} after {client.requests} requests")
+
+
+def main():
+    args = parse_args()
+    preprocess = load_preprocess("processing")
+    data_fg = make_rows(preprocess, args.rows)
+
+    for workers in args.workers:
+        client = LocalFeatureStoreRuntime(args.latency_ms, args.max_rps, args.error_rate)
+        ingester = preprocess.FeatureStoreIngester("benchmark", client, num_workers=workers,
+                                                   queue_rows=args.queue_rows)
+        for start in range(0, len(data_fg), args.batch_rows):
+            ingester.submit(data_fg.iloc[start:start + args.batch_rows])
+        metrics = ingester.close()
+
+        counts = [len(records) for records in client.records.values()]
+        assert len(counts) == args.rows and max(counts) == 1, "rows were lost or duplicated"
+        print(f"{workers} workers: {metrics['records_per_sec']:.0f} records/sec, "
+              f"p50 {metrics['p50_latency_ms']:.1f} ms, p99 {metrics['p99_latency_ms']:.1f} ms, "
+              f"{metrics['retries']} retries, {client.throttled} throttled")
+
+    check_worker_failure(preprocess, data_fg, args)
+
+
+if __name__ == "__main__":
+    main()
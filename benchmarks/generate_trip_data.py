@@ -0,0 +1,236 @@
+"""Generates synthetic NYC TLC green or yellow taxi trip files for benchmarking.
+
+The files have the column names and types of the TLC trip record files, e.g.
+lpep_pickup_datetime and PULocationID for green taxis, and one file per month
+named like the TLC files, e.g. green_tripdata_2018-01.parquet. Values follow
+realistic distributions: pickups peak in the evening rush hour, durations and
+speeds are lognormal, fares follow the meter and a few zones get most trips.
+A share of the rows has the vendor fields missing, as in the TLC data, and a
+share are outliers such as refunds, zero passengers, dropoffs before pickups or
+trips lasting days. Rows are generated and written in chunks, so 100M rows need
+no more memory than one chunk, e.g.
+
+    python benchmarks/generate_trip_data.py --rows 10M --months 3 --output data/10M
+    python benchmarks/generate_trip_data.py --rows 1M --taxi_type yellow --format csv --output data/yellow
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Timestamp format of the TLC CSV files
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+COLUMNS = {
+    "green": [
+        "VendorID", "lpep_pickup_datetime", "lpep_dropoff_datetime", "store_and_fwd_flag", "RatecodeID",
+        "PULocationID", "DOLocationID", "passenger_count", "trip_distance", "fare_amount", "extra", "mta_tax",
+        "tip_amount", "tolls_amount", "ehail_fee", "improvement_surcharge", "total_amount", "payment_type",
+        "trip_type", "congestion_surcharge",
+    ],
+    "yellow": [
+        "VendorID", "tpep_pickup_datetime", "tpep_dropoff_datetime", "passenger_count", "trip_distance",
+        "RatecodeID", "store_and_fwd_flag", "PULocationID", "DOLocationID", "payment_type", "fare_amount",
+        "extra", "mta_tax", "tip_amount", "tolls_amount", "improvement_surcharge", "total_amount",
+        "congestion_surcharge", "airport_fee",
+    ],
+}
+
+# Share of pickups in each hour of the day
+HOUR_WEIGHTS = np.array([
+    3.0, 2.2, 1.6, 1.2, 1.0, 1.1, 2.0, 3.4, 4.4, 4.4, 4.2, 4.3,
+    4.6, 4.7, 5.0, 5.4, 5.7, 6.3, 6.6, 6.2, 5.6, 5.2, 4.7, 3.9,
+])
+HOUR_WEIGHTS = HOUR_WEIGHTS / HOUR_WEIGHTS.sum()
+
+# Taxi zone IDs run from 1 to 263, 264 and 265 are unknown locations
+NUM_ZONES = 265
+
+OUTLIER_KINDS = ["refund", "huge_fare", "no_passengers", "negative_duration", "long_duration", "no_distance"]
+
+
+def parse_rows(value: str):
+    """Parses a row count like 1000000, 1M or 2.5K."""
+    multipliers = {"K": 10**3, "M": 10**6, "B": 10**9}
+    value = value.strip().upper()
+    if value[-1] in multipliers:
+        return int(float(value[:-1]) * multipliers[value[-1]])
+    return int(value)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=parse_rows, default="1M", help="total rows, e.g. 1M, 10M or 100M")
+    parser.add_argument("--output", required=True, help="directory to write the files to")
+    parser.add_argument("--taxi_type", choices=sorted(COLUMNS), default="green")
+    parser.add_argument("--format", choices=["parquet", "csv"], default="parquet")
+    parser.add_argument("--year", type=int, default=2018)
+    parser.add_argument("--months", type=int, default=1, help="number of monthly files, starting in January")
+    parser.add_argument("--chunk_rows", type=parse_rows, default="1M",
+                        help="rows generated at a time, and the row group size of parquet files")
+    parser.add_argument("--null_rate", type=float, default=0.01, help="share of rows missing the vendor fields")
+    parser.add_argument("--outlier_rate", type=float, default=0.005)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def zone_weights(rng):
+    """Zipf like pickup and dropoff popularity over the zones in a random order."""
+    weights = 1 / np.arange(1, NUM_ZONES + 1)
+    weights = weights[rng.permutation(NUM_ZONES)]
+    # Unknown locations are rare
+    weights[-2:] = weights.mean() / 10
+    return weights / weights.sum()
+
+
+def generate_trips(rng, taxi_type: str, year: int, month: int, rows: int, zones: np.ndarray,
+                   null_rate=0.01, outlier_rate=0.005):
+    """Returns rows trips picked up in the given month as a DataFrame with the TLC columns."""
+    prefix = "lpep" if taxi_type == "green" else "tpep"
+    month_start = np.datetime64(f"{year}-{month:02d}-01", "s")
+    days = pd.Period(year=year, month=month, freq="M").days_in_month
+    seconds = (
+        rng.integers(0, days, rows) * 86400
+        + rng.choice(24, rows, p=HOUR_WEIGHTS) * 3600
+        + rng.integers(0, 3600, rows)
+    )
+    pickup = month_start + seconds.astype("timedelta64[s]")
+    duration = np.clip(rng.lognormal(np.log(600), 0.7, rows), 30, 4 * 3600).astype(np.int64)
+    speed_mph = np.clip(rng.lognormal(np.log(11), 0.4, rows), 2, 60)
+    distance = np.round(duration / 3600 * speed_mph, 2)
+
+    rate_code = rng.choice([1, 2, 5], rows, p=[0.97, 0.01, 0.02]).astype(np.float64)
+    fare = np.round((2.5 + 2.5 * distance + 0.5 * duration / 120) * 2) / 2
+    fare = np.where(rate_code == 2, 52.0, fare)
+    payment_type = rng.choice([1, 2, 3, 4], rows, p=[0.55, 0.43, 0.015, 0.005])
+    extra = rng.choice([0.0, 0.5, 1.0], rows, p=[0.45, 0.35, 0.2])
+    mta_tax = np.full(rows, 0.5)
+    tip = np.where(payment_type == 1, np.round(fare * rng.uniform(0.1, 0.25, rows), 2), 0.0)
+    tolls = np.where(rng.random(rows) < 0.04, 5.76, 0.0)
+    improvement_surcharge = np.full(rows, 0.3)
+    congestion = np.where(rng.random(rows) < 0.35, 2.75, 0.0) if year >= 2019 else np.full(rows, np.nan)
+
+    df = pd.DataFrame({
+        "VendorID": rng.choice([1, 2], rows, p=[0.2, 0.8]),
+        f"{prefix}_pickup_datetime": pickup,
+        f"{prefix}_dropoff_datetime": pickup + duration.astype("timedelta64[s]"),
+        "store_and_fwd_flag": np.where(rng.random(rows) < 0.005, "Y", "N").astype(object),
+        "RatecodeID": rate_code,
+        "PULocationID": rng.choice(NUM_ZONES, rows, p=zones) + 1,
+        "DOLocationID": rng.choice(NUM_ZONES, rows, p=zones) + 1,
+        "passenger_count": rng.choice([0, 1, 2, 3, 4, 5, 6], rows,
+                                      p=[0.005, 0.8, 0.09, 0.025, 0.01, 0.045, 0.025]).astype(np.float64),
+        "trip_distance": distance,
+        "fare_amount": fare,
+        "extra": extra,
+        "mta_tax": mta_tax,
+        "tip_amount": tip,
+        "tolls_amount": tolls,
+        "ehail_fee": np.full(rows, np.nan),
+        "improvement_surcharge": improvement_surcharge,
+        "payment_type": payment_type.astype(np.float64),
+        "trip_type": rng.choice([1.0, 2.0], rows, p=[0.97, 0.03]),
+        "congestion_surcharge": congestion,
+        "airport_fee": np.where(rng.random(rows) < 0.08, 1.25, 0.0) if year >= 2022 else np.full(rows, np.nan),
+    })
+
+    # Rows sent without the vendor's trip details, as in the TLC files
+    missing = rng.random(rows) < null_rate
+    for name in ["store_and_fwd_flag", "RatecodeID", "passenger_count", "payment_type", "trip_type",
+                 "congestion_surcharge"]:
+        df.loc[missing, name] = None if name == "store_and_fwd_flag" else np.nan
+
+    outliers = np.flatnonzero(rng.random(rows) < outlier_rate)
+    kinds = rng.choice(OUTLIER_KINDS, len(outliers))
+    for kind in OUTLIER_KINDS:
+        index = outliers[kinds == kind]
+        if kind == "refund":
+            for name in ["fare_amount", "extra", "mta_tax", "tip_amount", "improvement_surcharge"]:
+                df.loc[index, name] = -df.loc[index, name]
+        elif kind == "huge_fare":
+            df.loc[index, "fare_amount"] = np.round(rng.uniform(200, 5000, len(index)), 2)
+        elif kind == "no_passengers":
+            df.loc[index, "passenger_count"] = 0.0
+        elif kind == "negative_duration":
+            df.loc[index, f"{prefix}_dropoff_datetime"] = (
+                df.loc[index, f"{prefix}_pickup_datetime"] - pd.to_timedelta(rng.integers(60, 3600, len(index)), "s")
+            )
+        elif kind == "long_duration":
+            df.loc[index, f"{prefix}_dropoff_datetime"] = (
+                df.loc[index, f"{prefix}_pickup_datetime"] + pd.to_timedelta(rng.integers(1, 4, len(index)), "D")
+            )
+        elif kind == "no_distance":
+            df.loc[index, "trip_distance"] = 0.0
+
+    df["total_amount"] = np.round(
+        df["fare_amount"] + df["extra"] + df["mta_tax"] + df["tip_amount"] + df["tolls_amount"]
+        + df["improvement_surcharge"] + df["congestion_surcharge"].fillna(0), 2
+    )
+    columns = COLUMNS[taxi_type]
+    df = df[columns]
+    # The TLC parquet files store timestamps in microseconds
+    for name in [f"{prefix}_pickup_datetime", f"{prefix}_dropoff_datetime"]:
+        df[name] = df[name].astype("datetime64[us]")
+    return df
+
+
+class ParquetFileWriter:
+    def __init__(self, path: str):
+        self.path = path
+        self.writer = None
+
+    def write(self, df: pd.DataFrame):
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table, row_group_size=len(df))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class CsvFileWriter:
+    def __init__(self, path: str):
+        self.path = path
+        self.header = True
+
+    def write(self, df: pd.DataFrame):
+        df.to_csv(self.path, mode="w" if self.header else "a", header=self.header, index=False,
+                  date_format=DATETIME_FORMAT)
+        self.header = False
+
+    def close(self):
+        pass
+
+
+writers = {"parquet": ParquetFileWriter, "csv": CsvFileWriter}
+
+
+def main():
+    args = parse_args()
+    os.makedirs(args.output, exist_ok=True)
+    zones = zone_weights(np.random.default_rng(args.seed))
+    start = time.perf_counter()
+    for i, month in enumerate(range(1, args.months + 1)):
+        # The first months get the remainder rows
+        month_rows = args.rows // args.months + (i < args.rows % args.months)
+        path = os.path.join(args.output, f"{args.taxi_type}_tripdata_{args.year}-{month:02d}.{args.format}")
+        writer = writers[args.format](path)
+        for chunk, chunk_start in enumerate(range(0, month_rows, args.chunk_rows)):
+            # Seeded per month and chunk, so the same arguments always generate the same files
+            rng = np.random.default_rng([args.seed, month, chunk])
+            rows = min(args.chunk_rows, month_rows - chunk_start)
+            writer.write(generate_trips(rng, args.taxi_type, args.year, month, rows, zones,
+                                        args.null_rate, args.outlier_rate))
+        writer.close()
+        print(f"wrote {month_rows} rows to {path}")
+    print(f"generated {args.rows} rows in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
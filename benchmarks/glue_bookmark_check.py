@@ -0,0 +1,100 @@
+"""Checks the incremental runs of glue/taxi_etl.py on local PySpark with glue/local/run_local.py.
+
+Monthly green trip files are written to a local catalog table, one partition_0
+directory per month. The job then runs with job bookmarks enabled, and the
+script checks the rows each run appends to the output dataset:
+
+- a run with --push_down_predicate reads only the partitions it selects
+- the next run reads the partitions the predicate skipped, and nothing twice
+- a run without new files appends nothing
+- a month added later is the only one read by the following run
+
+For example:
+
+    python benchmarks/glue_bookmark_check.py --rows 20000
+
+Needs pyspark and a Java runtime.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+import pyarrow.dataset as ds
+
+from common import REPO_DIR
+from generate_trip_data import ParquetFileWriter, generate_trips, zone_weights
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=20000, help="rows per month")
+    parser.add_argument("--year", type=int, default=2018)
+    return parser.parse_args()
+
+
+def write_month(table_dir: str, year: int, month: int, rows: int):
+    partition_dir = os.path.join(table_dir, f"{year}-{month:02d}")
+    os.makedirs(partition_dir)
+    writer = ParquetFileWriter(os.path.join(partition_dir, f"green_tripdata_{year}-{month:02d}.parquet"))
+    rng = np.random.default_rng([0, month])
+    writer.write(generate_trips(rng, "green", year, month, rows, zone_weights(np.random.default_rng(0))))
+    writer.close()
+
+
+def run_job(work_dir: str, output_dir: str, *job_args):
+    subprocess.check_call([
+        sys.executable, os.path.join(REPO_DIR, "glue/local/run_local.py"),
+        "--catalog", os.path.join(work_dir, "catalog.json"), "--bookmark_dir", os.path.join(work_dir, "bookmarks"),
+        os.path.join(REPO_DIR, "glue/taxi_etl.py"),
+        "--JOB_NAME", "taxi_etl", "--output_path", output_dir, "--taxi_types", "green",
+        "--job-bookmark-option", "job-bookmark-enable", *job_args,
+    ])
+
+
+def month_counts(output_dir: str):
+    """Rows of the output dataset per pickup_month partition."""
+    if not os.path.exists(output_dir):
+        return {}
+    table = ds.dataset(output_dir, format="parquet", partitioning="hive").to_table(columns=["pickup_month"])
+    months, counts = np.unique(table.column("pickup_month").to_numpy(), return_counts=True)
+    return dict(zip(months.tolist(), counts.tolist()))
+
+
+def check(step: str, output_dir: str, expected: dict):
+    counts = month_counts(output_dir)
+    assert counts == expected, f"{step}: rows per month {counts}, expected {expected}"
+    print(f"{step}: {counts}")
+
+
+def main():
+    args = parse_args()
+    work_dir = tempfile.mkdtemp()
+    try:
+        table_dir = os.path.join(work_dir, "lab1green")
+        with open(os.path.join(work_dir, "catalog.json"), "w") as f:
+            json.dump({"nycitytaxianalysis": {"lab1green": {"path": table_dir, "format": "parquet"}}}, f)
+        output_dir = os.path.join(work_dir, "output")
+        for month in [1, 2]:
+            write_month(table_dir, args.year, month, args.rows)
+
+        run_job(work_dir, output_dir, "--push_down_predicate", f"partition_0 >= '{args.year}-02'")
+        check("predicate run", output_dir, {2: args.rows})
+        run_job(work_dir, output_dir)
+        check("bookmarked run", output_dir, {1: args.rows, 2: args.rows})
+        run_job(work_dir, output_dir)
+        check("run without new files", output_dir, {1: args.rows, 2: args.rows})
+        write_month(table_dir, args.year, 3, args.rows)
+        run_job(work_dir, output_dir)
+        check("run after a new month", output_dir, {1: args.rows, 2: args.rows, 3: args.rows})
+        print("bookmarked runs read every file exactly once")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Checks preprocess.OfflineStoreWriter against a local directory standing in for S3.
+
+The input files are preprocessed and the feature group rows are written in batches
+to a temporary offline store directory. The directory is then read back, and the
+script checks that:
+
+- every row arrived exactly once, with the feature values PutRecord would store
+  from the strings it sends
+- each row sits in the year/month/day/hour partition of its event time
+- the write_time, api_invocation_time and is_deleted columns are present
+
+For example:
+
+    python benchmarks/offline_store_check.py --input 'data/green_tripdata_2018-1*.parquet' \\
+        --zones "0. Setup/input_zones/taxi_zones.zip"
+"""
+import argparse
+import glob
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pyarrow.dataset as ds
+
+from common import load_preprocess
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", required=True, help="glob of trip data parquet files")
+    parser.add_argument("--zones", required=True, help="path of taxi_zones.zip")
+    parser.add_argument("--batch_rows", type=int, default=50000)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    files = sorted(glob.glob(args.input))
+    if not files:
+        raise Exception(f"No input files match {args.input}")
+
+    preprocess = load_preprocess("processing")
+    work_dir = tempfile.mkdtemp()
+    try:
+        zones_file = os.path.join(work_dir, "taxi_zones.zip")
+        shutil.copy(args.zones, zones_file)
+        zone_matrix = preprocess.get_zone_matrix(zones_file)
+        _, data_fg = preprocess.clean_data(preprocess.enrich_data(preprocess.load_data(files), zone_matrix))
+
+        offline_uri = os.path.join(work_dir, "offline-store", "data")
+        writer = preprocess.OfflineStoreWriter("check", offline_uri)
+        start = time.perf_counter()
+        for batch_start in range(0, len(data_fg), args.batch_rows):
+            writer.submit(data_fg.iloc[batch_start:batch_start + args.batch_rows])
+        metrics = writer.close()
+        print(f"wrote {metrics['records']} rows in {metrics['files']} files, "
+              f"{metrics['records'] / (time.perf_counter() - start):.0f} rows/sec")
+
+        # The offline store table has a month feature, so the year=/month=/day=/hour= directories are
+        # checked from the file paths rather than read as hive partition columns
+        dataset = ds.dataset(offline_uri, format="parquet")
+        stored = dataset.to_table().to_pandas()
+        assert len(stored) == len(data_fg), f"{len(stored)} rows stored, {len(data_fg)} expected"
+        assert stored["FS_ID"].is_unique, "rows were duplicated"
+        expected = data_fg.set_index("FS_ID", drop=False).loc[stored["FS_ID"]]
+        for name in preprocess.cols_fg:
+            # FeatureStoreIngester sends each value as astype(str), which the feature store parses
+            sent = expected[name].astype(str).to_numpy()
+            np.testing.assert_array_equal(stored[name].to_numpy(), sent.astype(stored[name].dtype), err_msg=name)
+
+        for fragment in dataset.get_fragments():
+            event_times = fragment.to_table(columns=["FS_time"]).column("FS_time").to_numpy()
+            partitions = {time.strftime("year=%Y/month=%m/day=%d/hour=%H", time.gmtime(t)) for t in event_times}
+            partition = os.path.relpath(os.path.dirname(fragment.path), offline_uri)
+            assert partitions == {partition}, f"{fragment.path} holds rows of {partitions}"
+
+        for name in ["write_time", "api_invocation_time", "is_deleted"]:
+            assert name in stored.columns, f"{name} is missing"
+        assert not stored["is_deleted"].any()
+        print("offline store layout and contents match")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
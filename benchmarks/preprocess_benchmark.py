@@ -0,0 +1,199 @@
+"""Measures preprocess throughput and peak memory per stage on local trip files.
+
+load_data, enrich_data, clean_data and save_files run in a fresh interpreter on
+the input files, e.g. ones written by generate_trip_data.py, and each stage
+reports its wall time, rows/sec and peak RSS. The peak is reset before each
+stage through /proc/self/clear_refs on Linux, and is the process peak so far
+elsewhere. Pass --rev more than once to compare revisions, and --history to
+append the results to a JSON lines file and compare them with the previous run
+on the same input, e.g.
+
+    python benchmarks/generate_trip_data.py --rows 10M --output data/10M
+    python benchmarks/preprocess_benchmark.py --input 'data/10M/*.parquet' --history benchmarks/history.jsonl
+    python benchmarks/preprocess_benchmark.py --input 'data/10M/*.parquet' --rev HEAD~1 --rev HEAD
+
+The mlops script reads CSV, so benchmark it on files generated with --format csv.
+Revisions that still pip install at import time change the packages of the running
+environment, so benchmark those in a throwaway virtualenv or container.
+"""
+import argparse
+import glob
+import importlib.util
+import inspect
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import REPO_DIR, SCRIPTS
+from startup_benchmark import script_source
+
+STAGES = ["zones", "load_data", "enrich_data", "clean_data", "save_files"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", required=True, help="glob of trip data files")
+    parser.add_argument("--zones", default=os.path.join(REPO_DIR, "0. Setup/input_zones/taxi_zones.zip"))
+    parser.add_argument("--script", choices=sorted(SCRIPTS), default="processing")
+    parser.add_argument("--rev", action="append", default=None,
+                        help="git revision to benchmark, defaults to the working tree")
+    parser.add_argument("--history", default=None, help="JSON lines file the results are appended to")
+    # Runs the stages of one script in this process, in a work directory, and prints their measurements
+    parser.add_argument("--run_stages", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--work_dir", default=None, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def peak_rss_mb():
+    """Peak resident set size in MiB since the last reset_peak_rss()."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def measure(results: dict, stage: str, rows_in: int, function, *args, **kwargs):
+    reset_peak_rss()
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    results[stage] = {"seconds": time.perf_counter() - start, "rows_in": rows_in, "peak_rss_mb": peak_rss_mb()}
+    return result
+
+
+def run_stages(script_file: str, files: list, zones_file: str, work_dir: str):
+    """Runs the preprocess stages of script_file the way its main() does in memory."""
+    spec = importlib.util.spec_from_file_location("preprocess", script_file)
+    preprocess = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(preprocess)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    zones_dir = os.path.join(work_dir, "zones")
+    os.makedirs(zones_dir)
+    shutil.copy(zones_file, zones_dir)
+    zones_file = os.path.join(zones_dir, os.path.basename(zones_file))
+    results = {}
+    if hasattr(preprocess, "get_zone_matrix"):
+        zones = measure(results, "zones", None, preprocess.get_zone_matrix, zones_file)
+    else:
+        # Revisions before the zone matrix joined the GeoDataFrame of the zones
+        def load_zones():
+            preprocess.extract_zones(zones_file, zones_dir)
+            return preprocess.load_zones(zones_dir)
+
+        zones = measure(results, "zones", None, load_zones)
+
+    data_df = measure(results, "load_data", None, preprocess.load_data, files)
+    num_rows = len(data_df)
+    results["load_data"]["rows_in"] = num_rows
+    data_df = measure(results, "enrich_data", num_rows, preprocess.enrich_data, data_df, zones)
+    data_df, data_fg = measure(results, "clean_data", num_rows, preprocess.clean_data, data_df)
+
+    output_dir = os.path.join(work_dir, "output")
+    for split in ["train", "validation", "test"]:
+        os.makedirs(os.path.join(output_dir, split))
+    kwargs = {"current_host": "benchmark"}
+    if "fg_name" in inspect.signature(preprocess.save_files).parameters:
+        kwargs["fg_name"] = None
+    measure(results, "save_files", len(data_df), preprocess.save_files, output_dir, data_df, data_fg, **kwargs)
+    return {"input_rows": num_rows, "cleaned_rows": len(data_df), "stages": results}
+
+
+def revision_id(script: str, rev: str):
+    """The commit benchmarked, marked dirty when the working tree changes the script."""
+    commit = subprocess.check_output(["git", "rev-parse", "--short", rev or "HEAD"], cwd=REPO_DIR, text=True)
+    if rev is None and subprocess.check_output(["git", "status", "--porcelain", script], cwd=REPO_DIR, text=True):
+        return commit.strip() + "-dirty"
+    return commit.strip()
+
+
+def benchmark(script: str, rev: str, files: list, zones_file: str):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        script_file = os.path.join(tmp_dir, "preprocess.py")
+        with open(script_file, "w") as f:
+            f.write(script_source(script, rev))
+        work_dir = os.path.join(tmp_dir, "work")
+        output = subprocess.check_output(
+            [sys.executable, os.path.realpath(__file__), "--run_stages", script_file, "--input", json.dumps(files),
+             "--zones", zones_file, "--work_dir", work_dir],
+            text=True,
+        )
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def previous_result(history: str, result: dict):
+    """The last result in history for the same script and input files and rows."""
+    if not history or not os.path.exists(history):
+        return None
+    previous = None
+    with open(history) as f:
+        for line in f:
+            entry = json.loads(line)
+            if all(entry[key] == result[key] for key in ["script", "input", "input_rows"]):
+                previous = entry
+    return previous
+
+
+def print_result(result: dict, previous=None):
+    print(f"{result['rev']}: {result['input_rows']} rows in, {result['cleaned_rows']} rows after cleaning")
+    for stage in STAGES:
+        measured = result["stages"][stage]
+        line = f"  {stage:<12} {measured['seconds']:8.2f}s {measured['peak_rss_mb']:8.0f} MiB peak"
+        if measured["rows_in"]:
+            line += f" {measured['rows_in'] / measured['seconds']:12,.0f} rows/sec"
+            if previous:
+                before = previous["stages"][stage]
+                line += f"  {before['seconds'] / measured['seconds']:.2f}x speedup vs {previous['rev']}"
+        print(line)
+    total = sum(measured["seconds"] for measured in result["stages"].values())
+    print(f"  {'total':<12} {total:8.2f}s {max(m['peak_rss_mb'] for m in result['stages'].values()):8.0f} MiB peak "
+          f"{result['input_rows'] / total:12,.0f} rows/sec")
+
+
+def main():
+    args = parse_args()
+    if args.run_stages:
+        print(json.dumps(run_stages(args.run_stages, json.loads(args.input), args.zones, args.work_dir)))
+        return
+
+    files = sorted(glob.glob(args.input))
+    if not files:
+        raise Exception(f"No input files match {args.input}")
+    script = SCRIPTS[args.script]
+    for rev in args.rev or [None]:
+        result = {
+            "script": args.script,
+            "rev": revision_id(script, rev),
+            "input": [os.path.basename(file) for file in files],
+            "host": platform.node(),
+            "cpu_count": os.cpu_count(),
+            "timestamp": time.time(),
+        }
+        result.update(benchmark(script, rev, files, os.path.abspath(args.zones)))
+        previous = previous_result(args.history, result)
+        print_result(result, previous)
+        if args.history:
+            with open(args.history, "a") as f:
+                f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
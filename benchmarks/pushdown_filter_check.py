@@ -0,0 +1,75 @@
+"""Checks that preprocess.pushdown_filter never drops a row clean_data would keep.
+
+The input files are loaded, enriched and cleaned once as they are, and once with
+the outlier bounds pushed down into the parquet scan. Both runs must keep the same
+rows, by FS_ID, with the same features. This is checked for the default bounds and
+for overrides with open sides, which let rows with null values through once
+load_data fills them with 0. For example:
+
+    python benchmarks/generate_trip_data.py --rows 1M --null_rate 0.05 --output data/1M
+    python benchmarks/pushdown_filter_check.py --input 'data/1M/*.parquet' --zones "0. Setup/input_zones/taxi_zones.zip"
+"""
+import argparse
+import glob
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pyarrow.dataset as ds
+
+from common import load_preprocess
+
+# Outlier bound overrides checked besides the defaults
+BOUNDS_OVERRIDES = [
+    {},
+    {"passenger_count": [None, 5]},
+    {"passenger_count": [-1, 3.5]},
+    {"fare_amount": [None, 150]},
+    {"fare_amount": [-10, None], "duration_minutes": [None, 60]},
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", required=True, help="glob of trip data parquet files")
+    parser.add_argument("--zones", required=True, help="path of taxi_zones.zip")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    files = sorted(glob.glob(args.input))
+    if not files:
+        raise Exception(f"No input files match {args.input}")
+
+    preprocess = load_preprocess("processing")
+    work_dir = tempfile.mkdtemp()
+    try:
+        zones_file = os.path.join(work_dir, "taxi_zones.zip")
+        shutil.copy(args.zones, zones_file)
+        zone_matrix = preprocess.get_zone_matrix(zones_file)
+        schema = ds.dataset(files, format="parquet").schema
+        for overrides in BOUNDS_OVERRIDES:
+            bounds = preprocess.get_outlier_bounds(json.dumps(overrides))
+            _, expected = preprocess.clean_data(
+                preprocess.enrich_data(preprocess.load_data(files), zone_matrix, 0), bounds
+            )
+            row_filter = preprocess.pushdown_filter(bounds, schema)
+            _, pushed = preprocess.clean_data(
+                preprocess.enrich_data(preprocess.load_data(files, row_filter), zone_matrix, 0), bounds
+            )
+            assert len(pushed) == len(expected), (
+                f"{overrides}: {len(pushed)} rows kept with pushed down filters, {len(expected)} without"
+            )
+            np.testing.assert_array_equal(pushed["FS_ID"].to_numpy(), expected["FS_ID"].to_numpy())
+            for name in preprocess.cols:
+                np.testing.assert_array_equal(pushed[name].to_numpy(), expected[name].to_numpy(), err_msg=name)
+            print(f"{overrides or 'default bounds'}: both keep the same {len(expected)} rows")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Measures how long the preprocess scripts take to start.
+
+Each sample starts a fresh interpreter and imports the script without running main(),
+which is where the old scripts ran pip. It reports the wall time and which heavy
+packages the import loaded. Pass --rev more than once to compare revisions, e.g.
+
+    python benchmarks/startup_benchmark.py --rev HEAD~1 --rev HEAD
+
+--feature_group also times get_session, the rest of the path to processing the first
+rows when the job ingests into a feature group, which some revisions reach by pip
+installing sagemaker. Run it with the --python of a throwaway virtualenv that lacks
+the packages to time the path with the install, e.g.
+
+    python -m venv /tmp/bare && /tmp/bare/bin/pip install numpy pandas pyarrow boto3
+    python benchmarks/startup_benchmark.py --feature_group --python /tmp/bare/bin/python --repeat 1
+
+Revisions that pip install change the packages of that environment, so recreate it
+before each of their samples.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import REPO_DIR, SCRIPTS
+
+HEAVY_MODULES = ["geopandas", "sagemaker", "sklearn", "pandas", "pyarrow", "numpy"]
+
+IMPORT_SCRIPT = """
+import importlib.util, inspect, json, sys
+spec = importlib.util.spec_from_file_location("preprocess", sys.argv[1])
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+if sys.argv[2] == "feature_group":
+    # Older revisions also take the default bucket
+    parameters = inspect.signature(module.get_session).parameters
+    module.get_session("us-east-1", *(["bucket"] if len(parameters) > 1 else []))
+print(json.dumps([name for name in sys.argv[3:] if name in sys.modules]))
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--script", choices=sorted(SCRIPTS), default="processing")
+    parser.add_argument("--rev", action="append", default=None,
+                        help="git revision to benchmark, defaults to the working tree")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--feature_group", action="store_true", help="also time get_session")
+    parser.add_argument("--python", default=sys.executable, help="interpreter to start the script with")
+    return parser.parse_args()
+
+
+def script_source(script: str, rev: str):
+    if rev is None:
+        with open(os.path.join(REPO_DIR, script)) as f:
+            return f.read()
+    return subprocess.check_output(["git", "show", f"{rev}:{script}"], cwd=REPO_DIR, text=True)
+
+
+def time_startup(script_file: str, repeat: int, python=sys.executable, feature_group=False):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = subprocess.check_output(
+            [python, "-c", IMPORT_SCRIPT, script_file, "feature_group" if feature_group else "import"]
+            + HEAVY_MODULES,
+            text=True,
+        )
+        samples.append(time.perf_counter() - start)
+    return samples, json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    args = parse_args()
+    script = SCRIPTS[args.script]
+    for rev in args.rev or [None]:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            script_file = os.path.join(tmp_dir, "preprocess.py")
+            with open(script_file, "w") as f:
+                f.write(script_source(script, rev))
+            samples, loaded = time_startup(script_file, args.repeat, args.python, args.feature_group)
+        print(
+            f"{rev or 'working tree'}: median {statistics.median(samples):.3f}s "
+            f"min {min(samples):.3f}s over {len(samples)} runs, loaded {', '.join(loaded)}"
+        )
+
+
+if __name__ == "__main__":
+    main()
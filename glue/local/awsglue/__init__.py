@@ -0,0 +1,7 @@
+"""Local stand-in for the parts of the AWS Glue library the ETL scripts in glue/ use.
+
+It runs the scripts on PySpark without a Glue endpoint. The Data Catalog is a
+JSON file mapping database and table names to local directories, and job
+bookmarks are kept in JSON files. Run the scripts through glue/local/run_local.py,
+which puts this package on the path.
+"""
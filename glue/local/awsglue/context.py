@@ -0,0 +1,135 @@
+import functools
+import json
+import logging
+import os
+
+from pyspark.sql import SparkSession
+from pyspark.sql.functions import lit
+from pyspark.sql.types import StructType
+
+from awsglue.dynamicframe import DynamicFrame
+
+spark_formats = {"glueparquet": "parquet"}
+
+
+def catalog_table(database: str, table_name: str):
+    """Looks up a table in the JSON catalog file GLUE_LOCAL_CATALOG points to.
+
+    The file maps databases to tables, and each table to a local "path" and a
+    "format", e.g. {"nycitytaxianalysis": {"lab1green": {"path": "data/green",
+    "format": "parquet"}}}. Subdirectories of the path are the values of the
+    partition_0 partition column, as the crawler names unnamed partitions.
+    """
+    with open(os.environ["GLUE_LOCAL_CATALOG"]) as f:
+        catalog = json.load(f)
+    try:
+        return catalog[database][table_name]
+    except KeyError:
+        raise Exception(f"Table {database}.{table_name} is not in the local catalog")
+
+
+def read_catalog(glue_context, database, table_name, transformation_ctx="", push_down_predicate=""):
+    """Reads the files of a catalog table that are new since the bookmark of transformation_ctx.
+
+    Partitions the push_down_predicate rejects are never listed, and their
+    files stay unread in the bookmark.
+    """
+    spark = glue_context.spark_session
+    table = catalog_table(database, table_name)
+    partitions = sorted(
+        entry for entry in os.listdir(table["path"]) if os.path.isdir(os.path.join(table["path"], entry))
+    )
+    if push_down_predicate and partitions:
+        # Evaluated by Spark SQL, like Glue evaluates it on the catalog partitions
+        selected = spark.createDataFrame([(p,) for p in partitions], "partition_0 string")
+        partitions = sorted(row.partition_0 for row in selected.filter(push_down_predicate).collect())
+
+    bookmark = glue_context.bookmark if transformation_ctx else None
+    frames = []
+    for partition in partitions:
+        partition_dir = os.path.join(table["path"], partition)
+        files = [
+            os.path.join(partition_dir, name) for name in sorted(os.listdir(partition_dir))
+            if not name.startswith((".", "_")) and os.path.isfile(os.path.join(partition_dir, name))
+        ]
+        if bookmark is not None:
+            files = [file for file in files if bookmark.is_new(transformation_ctx, file)]
+            for file in files:
+                bookmark.mark(transformation_ctx, file)
+        if files:
+            reader = spark.read.format(spark_formats.get(table["format"], table["format"]))
+            if table["format"] == "csv":
+                reader = reader.option("header", True).option("inferSchema", True)
+            df = reader.load(files)
+            # The crawler lower cases column names
+            df = df.toDF(*[name.lower() for name in df.columns])
+            frames.append(df.withColumn("partition_0", lit(partition)))
+
+    if frames:
+        df = functools.reduce(lambda a, b: a.unionByName(b, allowMissingColumns=True), frames)
+    else:
+        # A run without new files reads a frame without columns, as Glue does
+        df = spark.createDataFrame([], StructType([]))
+    return df
+
+
+class DataFrameReader:
+    def __init__(self, glue_context):
+        self.glue_context = glue_context
+
+    def from_catalog(self, database, table_name, transformation_ctx="", additional_options=None, **kwargs):
+        """Reads a catalog table as a Spark DataFrame.
+
+        Glue documents create_data_frame.from_catalog for streaming sources. It takes no
+        push_down_predicate and job bookmarks do not apply to it, so both are rejected
+        here instead of being emulated for batch reads.
+        """
+        if "push_down_predicate" in kwargs:
+            raise Exception("create_data_frame.from_catalog takes no push_down_predicate, "
+                            "read with create_dynamic_frame.from_catalog")
+        if transformation_ctx and self.glue_context.bookmark is not None:
+            raise Exception("Job bookmarks do not apply to create_data_frame.from_catalog, "
+                            "read with create_dynamic_frame.from_catalog")
+        return read_catalog(self.glue_context, database, table_name)
+
+
+class DynamicFrameReader:
+    def __init__(self, glue_context):
+        self.glue_context = glue_context
+
+    def from_catalog(self, database, table_name, transformation_ctx="", push_down_predicate="", **kwargs):
+        df = read_catalog(self.glue_context, database, table_name, transformation_ctx, push_down_predicate)
+        return DynamicFrame(df, self.glue_context, transformation_ctx)
+
+
+class DynamicFrameWriter:
+    def __init__(self, glue_context):
+        self.glue_context = glue_context
+
+    def from_options(self, frame, connection_type, connection_options, format=None, format_options=None,
+                     transformation_ctx="", **kwargs):
+        writer = frame.toDF().write.mode("append")
+        if (format_options or {}).get("compression"):
+            writer = writer.option("compression", format_options["compression"])
+        if connection_options.get("partitionKeys"):
+            writer = writer.partitionBy(*connection_options["partitionKeys"])
+        writer.format(spark_formats.get(format, format)).save(connection_options["path"])
+        return frame
+
+
+class GlueContext:
+    def __init__(self, sc):
+        self.spark_session = SparkSession(sc)
+        self.create_data_frame = DataFrameReader(self)
+        self.create_dynamic_frame = DynamicFrameReader(self)
+        self.write_dynamic_frame = DynamicFrameWriter(self)
+        # Set by Job.init when job bookmarks are enabled
+        self.bookmark = None
+
+    def get_logger(self):
+        """A Python logger standing in for the log4j logger of the Glue driver."""
+        logger = logging.getLogger("awsglue")
+        if not logger.handlers:
+            logger.addHandler(logging.StreamHandler())
+            logger.setLevel(logging.INFO)
+        return logger
@@ -0,0 +1,17 @@
+class DynamicFrame:
+    """Wraps a Spark DataFrame, which stands in for the DynamicFrame records."""
+
+    def __init__(self, dataframe, glue_ctx, name=""):
+        self._df = dataframe
+        self.glue_ctx = glue_ctx
+        self.name = name
+
+    def toDF(self):
+        return self._df
+
+    def count(self):
+        return self._df.count()
+
+    @classmethod
+    def fromDF(cls, dataframe, glue_ctx, name):
+        return cls(dataframe, glue_ctx, name)
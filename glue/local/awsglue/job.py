@@ -0,0 +1,59 @@
+import json
+import os
+import sys
+
+from awsglue.utils import getResolvedOptions
+
+
+class JobBookmark:
+    """The files each transformation_ctx has read, by path and modification time.
+
+    Like a Glue job bookmark on an S3 source, a file is read again only once it
+    changed. Files read in a run are only marked once the job commits.
+    """
+
+    def __init__(self, bookmark_file: str, save=True):
+        self.bookmark_file = bookmark_file
+        self.save = save
+        self.files = {}
+        if os.path.exists(bookmark_file):
+            with open(bookmark_file) as f:
+                self.files = json.load(f)
+        self.pending = {}
+
+    def is_new(self, transformation_ctx: str, path: str):
+        return self.files.get(transformation_ctx, {}).get(path) != os.path.getmtime(path)
+
+    def mark(self, transformation_ctx: str, path: str):
+        self.pending.setdefault(transformation_ctx, {})[path] = os.path.getmtime(path)
+
+    def commit(self):
+        for transformation_ctx, files in self.pending.items():
+            self.files.setdefault(transformation_ctx, {}).update(files)
+        self.pending = {}
+        if self.save:
+            os.makedirs(os.path.dirname(os.path.abspath(self.bookmark_file)), exist_ok=True)
+            with open(self.bookmark_file, "w") as f:
+                json.dump(self.files, f, indent=2)
+
+
+class Job:
+    def __init__(self, glue_context):
+        self.glue_context = glue_context
+
+    def init(self, job_name, args=None):
+        """Loads the bookmark of job_name when the job runs with --job-bookmark-option job-bookmark-enable.
+
+        job-bookmark-pause reads from the bookmark without moving it.
+        """
+        option = "job-bookmark-disable"
+        if "--job-bookmark-option" in sys.argv:
+            option = getResolvedOptions(sys.argv, ["job-bookmark-option"])["job-bookmark-option"]
+        if option != "job-bookmark-disable":
+            bookmark_dir = os.environ.get("GLUE_LOCAL_BOOKMARK_DIR", ".glue_bookmarks")
+            self.glue_context.bookmark = JobBookmark(os.path.join(bookmark_dir, f"{job_name}.json"),
+                                                     save=option == "job-bookmark-enable")
+
+    def commit(self):
+        if self.glue_context.bookmark is not None:
+            self.glue_context.bookmark.commit()
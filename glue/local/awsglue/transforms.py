@@ -0,0 +1,18 @@
+from pyspark.sql.functions import col
+
+from awsglue.dynamicframe import DynamicFrame
+
+__all__ = ["ApplyMapping"]
+
+
+class ApplyMapping:
+    @classmethod
+    def apply(cls, frame, mappings, transformation_ctx="", **kwargs):
+        """Selects and casts the mapped columns. Mappings of columns the frame lacks are skipped, as in Glue."""
+        df = frame.toDF()
+        columns = [
+            col(source).cast(target_type).alias(target)
+            for source, source_type, target, target_type in mappings
+            if source in df.columns
+        ]
+        return DynamicFrame(df.select(*columns), frame.glue_ctx, transformation_ctx)
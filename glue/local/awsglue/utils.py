@@ -0,0 +1,14 @@
+class GlueArgumentError(Exception):
+    pass
+
+
+def getResolvedOptions(args, options):
+    """Returns the values of the --name value pairs in args for the given option names."""
+    values = {}
+    for name, value in zip(args, args[1:]):
+        if name.startswith("--"):
+            values[name[2:]] = value
+    missing = [option for option in options if option not in values]
+    if missing:
+        raise GlueArgumentError(f"the following arguments are required: {', '.join('--' + o for o in missing)}")
+    return {option: values[option] for option in options}
@@ -0,0 +1,44 @@
+"""Runs a Glue ETL script of the glue folder locally on PySpark, with the awsglue stand-in next to this file.
+
+Catalog tables are local directories listed in a JSON catalog file (see
+awsglue/context.py), and job bookmarks are kept in --bookmark_dir. The
+arguments after the script are passed to it as Glue job parameters, e.g.
+
+    python glue/local/run_local.py --catalog catalog.json glue/taxi_etl.py --JOB_NAME taxi_etl \\
+        --output_path /tmp/taxi --push_down_predicate "partition_0 >= '2019'" \\
+        --job-bookmark-option job-bookmark-enable
+
+Needs pyspark and a Java runtime. Each run is a new process and Spark session,
+as each Glue job run is.
+"""
+import argparse
+import os
+import runpy
+import sys
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--catalog", required=True, help="JSON file mapping catalog tables to local directories")
+    parser.add_argument("--bookmark_dir", default=".glue_bookmarks")
+    parser.add_argument("--master", default="local[*]")
+    parser.add_argument("script")
+    parser.add_argument("script_args", nargs=argparse.REMAINDER)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    os.environ["GLUE_LOCAL_CATALOG"] = os.path.abspath(args.catalog)
+    os.environ["GLUE_LOCAL_BOOKMARK_DIR"] = os.path.abspath(args.bookmark_dir)
+    # Read by the SparkContext() the scripts create. Glue runs in UTC
+    os.environ.setdefault(
+        "PYSPARK_SUBMIT_ARGS", f"--master {args.master} --conf spark.sql.session.timeZone=UTC pyspark-shell"
+    )
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    sys.argv = [args.script] + args.script_args
+    runpy.run_path(args.script, run_name="__main__")
+
+
+if __name__ == "__main__":
+    main()
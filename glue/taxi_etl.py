@@ -0,0 +1,362 @@
+"""Glue ETL job transforming the taxi trips of several taxi types into one dataset.
+
+Each taxi type is read from its lab 1 Data Catalog table, mapped to the common
+column names and tagged with its type. The types are unioned and written once,
+so one job and one Spark cluster produce the whole dataset, instead of a
+greentaxi_etl.py and a yellowtaxi_etl.py job each.
+
+The dataset is written in Hive style partitions, by default
+type=<taxi type>/pickup_year=<year>/pickup_month=<month>/, so readers filtering on
+them skip the other partitions. Each partition is written by one task in files
+of about --target_file_mb, instead of one small file per task and partition.
+
+--column_profile model-columns keeps only the columns the SageMaker
+processing job reads. They are projected right after the read, so later stages,
+the shuffle and the output carry none of the others. The full profile, the
+default, keeps every column for analytics.
+
+With --enrich true the job also does the work of enrich_data and clean_data in
+1. Amazon SageMaker Processing/preprocess.py: it joins the zone centroids on the
+pickup and drop off location IDs, derives the calendar features, removes the
+outliers and writes only the model columns. It reads the model-columns
+profile. The processing job then reads the dataset with --input_enriched and
+only splits and writes it. The zone centroid table is the zone_centroids.csv
+preprocess.py --build_zone_matrix writes.
+
+Runs with --job-bookmark-option job-bookmark-enable only read the files added
+to the catalog tables since the last successful run, and append their trips to
+the dataset. --push_down_predicate limits the partitions listed at all, e.g. to
+the months of a backfill. glue/local/run_local.py runs the job on PySpark
+against local directories, bookmarks included.
+
+Job parameters:
+    --output_path       S3 path the Parquet dataset is written to
+    --taxi_types        comma separated taxi types, default green,yellow
+    --database          Data Catalog database, default nycitytaxianalysis
+    --taxi_type_config  JSON object overriding the settings of TAXI_TYPES, e.g.
+                        {"green": {"table_name": "lab1green2019"}}
+    --partition_keys    comma separated partition columns, default type,pickup_year,pickup_month,
+                        or an empty string for a flat dataset
+    --target_file_mb    approximate size of the written files, default 128
+    --bytes_per_row     compressed Parquet bytes per row, used to turn --target_file_mb into rows
+                        per file, default 24
+    --column_profile    columns to keep, a profile of COLUMN_PROFILES, default full
+    --enrich            true to write the enriched and cleaned model columns, default false
+    --zone_centroids_path
+                        S3 path of zone_centroids.csv, required with --enrich true
+    --outlier_bounds    JSON object overriding the bounds of OUTLIER_BOUNDS, e.g. {"fare_amount": [0, 500]}
+    --push_down_predicate
+                        Spark SQL predicate on the partition_0 partition column of the catalog tables,
+                        e.g. "partition_0 >= '2019'", default none
+"""
+import json
+import math
+import sys
+
+from awsglue.transforms import ApplyMapping
+from awsglue.utils import getResolvedOptions
+from pyspark import StorageLevel
+from pyspark.context import SparkContext
+from awsglue.context import GlueContext
+from awsglue.job import Job
+from pyspark.sql.functions import (
+    broadcast, coalesce, col, dayofweek, hour, lit, month, pmod, sqrt, to_timestamp, unix_timestamp, year
+)
+
+# Catalog table and source datetime columns of each taxi type
+TAXI_TYPES = {
+    "green": {
+        "table_name": "lab1green",
+        "pickup_datetime": "lpep_pickup_datetime",
+        "dropoff_datetime": "lpep_dropoff_datetime",
+    },
+    "yellow": {
+        "table_name": "lab1yellow",
+        "pickup_datetime": "tpep_pickup_datetime",
+        "dropoff_datetime": "tpep_dropoff_datetime",
+    },
+}
+
+DEFAULT_OPTIONS = {
+    "taxi_types": "green,yellow",
+    "database": "nycitytaxianalysis",
+    "taxi_type_config": "{}",
+    "partition_keys": "type,pickup_year,pickup_month",
+    "target_file_mb": "128",
+    "bytes_per_row": "24",
+    "enrich": "false",
+    "zone_centroids_path": "",
+    "outlier_bounds": "{}",
+    "push_down_predicate": "",
+    "column_profile": "full",
+}
+
+# Common columns kept by each --column_profile, None keeps them all. model-columns are the
+# columns preprocess.py reads, as use_cols
+COLUMN_PROFILES = {
+    "full": None,
+    "model-columns": [
+        "fare_amount",
+        "pickup_datetime",
+        "dropoff_datetime",
+        "passenger_count",
+        "pulocationid",
+        "dolocationid",
+    ],
+}
+
+# Outliers removed with --enrich true, as exclusive (lower, upper) bounds like clean_data in
+# preprocess.py. None leaves that side unbounded.
+OUTLIER_BOUNDS = {
+    "fare_amount": (0, 200),
+    "passenger_count": (0, None),
+    "duration_minutes": (0, 120),
+    "geo_distance": (0, 121),
+}
+
+# Columns written with --enrich true, the cols of preprocess.py
+MODEL_COLUMNS = [
+    "fare_amount",
+    "passenger_count",
+    "pickup_latitude",
+    "pickup_longitude",
+    "dropoff_latitude",
+    "dropoff_longitude",
+    "geo_distance",
+    "hour",
+    "weekday",
+    "month",
+]
+
+
+def resolve_options(argv):
+    """Resolves the job parameters, falling back to DEFAULT_OPTIONS for those not passed."""
+    optional = [name for name in DEFAULT_OPTIONS if f"--{name}" in argv]
+    options = dict(DEFAULT_OPTIONS)
+    options.update(getResolvedOptions(argv, ["JOB_NAME", "output_path"] + optional))
+    return options
+
+
+def taxi_type_configs(options):
+    """Returns the settings of every taxi type to process, in the order given."""
+    overrides = json.loads(options["taxi_type_config"])
+    configs = {}
+    for taxi_type in options["taxi_types"].split(","):
+        taxi_type = taxi_type.strip()
+        config = dict(TAXI_TYPES.get(taxi_type, {}))
+        config.update(overrides.get(taxi_type, {}))
+        if "table_name" not in config:
+            raise Exception(f"Unknown taxi type {taxi_type}, pass its settings in --taxi_type_config")
+        configs[taxi_type] = config
+    return configs
+
+
+def column_mappings(config, columns=None):
+    """The (source, type, common, type) mappings, as ApplyMapping takes them, from the source
+    columns of a taxi type to the common columns.
+
+    With columns, only the mappings to those common columns are kept.
+    """
+    if "mappings" in config:
+        mappings = [tuple(mapping) for mapping in config["mappings"]]
+    else:
+        mappings = [
+            ("vendorid", "long", "vendorid", "long"),
+            (config["pickup_datetime"], "string", "pickup_datetime", "string"),
+            (config["dropoff_datetime"], "string", "dropoff_datetime", "string"),
+            ("passenger_count", "long", "passenger_count", "long"),
+            ("trip_distance", "double", "trip_distance", "double"),
+            ("ratecodeid", "long", "ratecodeid", "long"),
+            ("store_and_fwd_flag", "string", "store_and_fwd_flag", "string"),
+            ("pulocationid", "long", "pulocationid", "long"),
+            ("dolocationid", "long", "dolocationid", "long"),
+            ("payment_type", "long", "payment_type", "long"),
+            ("fare_amount", "double", "fare_amount", "double"),
+            ("extra", "double", "extra", "double"),
+            ("mta_tax", "double", "mta_tax", "double"),
+            ("tip_amount", "double", "tip_amount", "double"),
+            ("tolls_amount", "double", "tolls_amount", "double"),
+            ("improvement_surcharge", "double", "improvement_surcharge", "double"),
+            ("total_amount", "double", "total_amount", "double"),
+            ("congestion_surcharge", "double", "congestion_surcharge", "double"),
+            ("partition_0", "string", "partition_0", "string"),
+        ]
+    if columns is not None:
+        mappings = [mapping for mapping in mappings if mapping[2] in columns]
+    return mappings
+
+
+def read_taxi_type(glueContext, database, taxi_type, config, push_down_predicate="", columns=None):
+    """Reads the catalog table of a taxi type as a Spark DataFrame of the common columns.
+
+    columns projects the mapping to those common columns, None keeps them all,
+    before the frame becomes a DataFrame. The read is bookmarked under
+    read_<taxi type>. Returns None when the bookmark or the push_down_predicate
+    leaves no files to read.
+    """
+    source = glueContext.create_dynamic_frame.from_catalog(
+        database=database,
+        table_name=config["table_name"],
+        transformation_ctx=f"read_{taxi_type}",
+        push_down_predicate=push_down_predicate,
+    )
+    mapped = ApplyMapping.apply(
+        frame=source,
+        mappings=column_mappings(config, columns),
+        transformation_ctx=f"mapping_{taxi_type}",
+    )
+    trips = mapped.toDF()
+    # A read without files has no columns
+    if not trips.columns:
+        return None
+    return trips.withColumn("type", lit(taxi_type))
+
+
+def union_taxi_types(frames):
+    """Unions the DataFrames of the taxi types by column name.
+
+    A column a taxi type lacks, e.g. congestion_surcharge before 2019, is null for it.
+    """
+    trips = frames[0]
+    for frame in frames[1:]:
+        trips = trips.unionByName(frame, allowMissingColumns=True)
+    return trips
+
+
+def add_partition_columns(trips):
+    """Adds the pickup_year and pickup_month partition columns.
+
+    They are named apart from the month feature preprocess derives from the pickup time.
+    """
+    pickup = to_timestamp(col("pickup_datetime"))
+    return trips.withColumn("pickup_year", year(pickup)).withColumn("pickup_month", month(pickup))
+
+
+def read_zone_centroids(spark, zone_centroids_path):
+    """Reads the zone centroid table, one row per location_id with its coordinates."""
+    return spark.read.csv(zone_centroids_path, header=True, inferSchema=True).select(
+        col("location_id").cast("long"),
+        col("latitude").cast("double"),
+        col("longitude").cast("double"),
+        col("centroid_x").cast("double"),
+        col("centroid_y").cast("double"),
+    )
+
+
+def outlier_bounds(overrides):
+    """OUTLIER_BOUNDS with the bounds given in the --outlier_bounds JSON object replaced."""
+    bounds = dict(OUTLIER_BOUNDS)
+    for column, (lower, upper) in json.loads(overrides).items():
+        if column not in bounds:
+            raise Exception(f"Unknown outlier bound column {column}")
+        bounds[column] = (lower, upper)
+    return bounds
+
+
+def enrich_trips(trips, zone_centroids, bounds, keep_columns):
+    """Derives the model columns of the trips and removes the outliers, like enrich_data and clean_data.
+
+    The zone table has a few hundred rows, so it is broadcast to every task instead
+    of shuffling the trips for the joins. Trips with an unknown location have no
+    zone and are dropped, as clean_data drops them for their missing features.
+    Missing values are 0 first, as load_data fills them, and the duration is the
+    time of day part of dropoff - pickup, as the seconds of a pandas Timedelta.
+    keep_columns, e.g. the partition columns, are written along the model columns.
+    """
+    epoch = lit("1970-01-01 00:00:00").cast("timestamp")
+    pickup = coalesce(col("pickup_datetime").cast("timestamp"), epoch)
+    dropoff = coalesce(col("dropoff_datetime").cast("timestamp"), epoch)
+    trips = trips.select(
+        coalesce(col("fare_amount"), lit(0)).cast("float").alias("fare_amount"),
+        coalesce(col("passenger_count"), lit(0)).cast("int").alias("passenger_count"),
+        coalesce(col("pulocationid"), lit(0)).alias("pulocationid"),
+        coalesce(col("dolocationid"), lit(0)).alias("dolocationid"),
+        hour(pickup).alias("hour"),
+        # Monday is 0 as in pandas, Spark counts from Sunday as 1
+        pmod(dayofweek(pickup) + 5, 7).alias("weekday"),
+        month(pickup).alias("month"),
+        (pmod(unix_timestamp(dropoff) - unix_timestamp(pickup), 86400) / 60).cast("float").alias("duration_minutes"),
+        *keep_columns,
+    )
+
+    for prefix, location in [("pickup", "pulocationid"), ("dropoff", "dolocationid")]:
+        zones = zone_centroids.select(*[col(name).alias(f"{prefix}_{name}") for name in zone_centroids.columns])
+        trips = trips.join(broadcast(zones), col(location) == col(f"{prefix}_location_id"))
+    delta_x = col("dropoff_centroid_x") - col("pickup_centroid_x")
+    delta_y = col("dropoff_centroid_y") - col("pickup_centroid_y")
+    trips = trips.withColumn("geo_distance", (sqrt(delta_x * delta_x + delta_y * delta_y) / 1000).cast("float"))
+    for name in ["pickup_latitude", "pickup_longitude", "dropoff_latitude", "dropoff_longitude"]:
+        trips = trips.withColumn(name, col(name).cast("float"))
+
+    for column, (lower, upper) in bounds.items():
+        if lower is not None:
+            trips = trips.filter(col(column) > lower)
+        if upper is not None:
+            trips = trips.filter(col(column) < upper)
+    return trips.select(*MODEL_COLUMNS, *keep_columns).dropna()
+
+
+def write_trips(trips, output_path, partition_keys, target_file_rows):
+    """Appends the trips to output_path as snappy Parquet files of at most target_file_rows rows.
+
+    With partition_keys, all rows of a partition are shuffled to one task, which
+    writes them to as few files as the row limit allows. A flat dataset is
+    repartitioned into just enough tasks for the limit. Its rows are cached while
+    they are counted, so the read, enrichment and joins run once, not again for
+    the write.
+    """
+    cached = None
+    if partition_keys:
+        trips = trips.repartition(*partition_keys)
+    else:
+        cached = trips.persist(StorageLevel.MEMORY_AND_DISK)
+        trips = cached.repartition(max(1, math.ceil(cached.count() / target_file_rows)))
+    writer = trips.write.mode("append").option("maxRecordsPerFile", target_file_rows).option("compression", "snappy")
+    if partition_keys:
+        writer = writer.partitionBy(*partition_keys)
+    writer.parquet(output_path)
+    if cached is not None:
+        cached.unpersist()
+
+
+def main():
+    options = resolve_options(sys.argv)
+    sc = SparkContext()
+    glueContext = GlueContext(sc)
+    job = Job(glueContext)
+    job.init(options["JOB_NAME"], options)
+    enrich = options["enrich"].lower() == "true"
+    if enrich:
+        if not options["zone_centroids_path"]:
+            raise Exception("--zone_centroids_path is required with --enrich true")
+        # Timestamps are read as UTC, so durations are not shifted by daylight saving time
+        glueContext.spark_session.conf.set("spark.sql.session.timeZone", "UTC")
+
+    if options["column_profile"] not in COLUMN_PROFILES:
+        raise Exception(f"Unknown column profile {options['column_profile']}, one of {', '.join(COLUMN_PROFILES)}")
+    columns = COLUMN_PROFILES["model-columns" if enrich else options["column_profile"]]
+
+    frames = []
+    for taxi_type, config in taxi_type_configs(options).items():
+        frame = read_taxi_type(glueContext, options["database"], taxi_type, config, options["push_down_predicate"],
+                               columns)
+        if frame is None:
+            glueContext.get_logger().info(f"No new {taxi_type} trips to process")
+        else:
+            frames.append(frame)
+    if not frames:
+        job.commit()
+        return
+    partition_keys = [key.strip() for key in options["partition_keys"].split(",") if key.strip()]
+    target_file_rows = int(float(options["target_file_mb"]) * 2**20 / float(options["bytes_per_row"]))
+    trips = add_partition_columns(union_taxi_types(frames))
+    if enrich:
+        zone_centroids = read_zone_centroids(glueContext.spark_session, options["zone_centroids_path"])
+        trips = enrich_trips(trips, zone_centroids, outlier_bounds(options["outlier_bounds"]), partition_keys)
+    write_trips(trips, options["output_path"], partition_keys, target_file_rows)
+
+    job.commit()
+
+
+if __name__ == "__main__":
+    main()
@@ -14,11 +14,18 @@ spark = glueContext.spark_session
 job = Job(glueContext)
 job.init(args["JOB_NAME"], args)
 
+# Optional predicate on the partition_0 partition column, e.g. "partition_0 >= '2019'", so only those
+# partitions are read. With job bookmarks enabled, runs also skip the files earlier runs read.
+push_down_predicate = ""
+if "--push_down_predicate" in sys.argv:
+    push_down_predicate = getResolvedOptions(sys.argv, ["push_down_predicate"])["push_down_predicate"]
+
 # Script generated for node S3 bucket
 S3bucket_node1 = glueContext.create_dynamic_frame.from_catalog(
     database="nycitytaxianalysis",
     table_name="lab1yellow",              # <-- change the table name to the table you created in lab 1
     transformation_ctx="S3bucket_node1",
+    push_down_predicate=push_down_predicate,
 )
 
 # Script generated for node ApplyMapping